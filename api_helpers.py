@@ -1,6 +1,13 @@
 """API Helpers for Stream Tweeter."""
 
-from model import StreamSession, SentTweet, TwitchClip
+import datetime
+from sqlalchemy import tuple_
+from model import (StreamSession, StreamDataRollup, SentTweet, TwitchClip,
+                   dump_datetime)
+
+# Default and maximum number of sent tweets returned per page.
+SENT_TWEETS_PAGE_SIZE = 50
+SENT_TWEETS_MAX_PAGE_SIZE = 100
 
 
 def create_streams_payload(user, dt=None, limit=5):
@@ -32,24 +39,61 @@ def create_streams_payload(user, dt=None, limit=5):
     return payload
 
 
-def create_senttweets_payload(user, started, ended):
-    """Creates payload for returning tweets created between given times."""
+def create_senttweets_payload(user, started, ended, after=None,
+                              limit=SENT_TWEETS_PAGE_SIZE):
+    """Creates payload for returning tweets created between given times.
+    Returns up to limit tweets after the given cursor, oldest first, and a
+    link to the next page if there are more."""
 
     payload = {}
 
-    tweets = [tweet.serialize
-              for tweet
-              in user.sent_tweets.filter(SentTweet.created_at.between(
-                  started, ended
-              ))]
+    query = SentTweet.query.filter(
+        SentTweet.user_id == user.user_id,
+        SentTweet.created_at.between(started, ended)
+    )
+    if after:
+        query = query.filter(tuple_(SentTweet.created_at, SentTweet.tweet_id)
+                             > tuple_(*after))
+
+    # Fetch one extra row to learn if there's another page.
+    page = query.order_by(SentTweet.created_at, SentTweet.tweet_id) \
+        .limit(limit + 1).all()
 
+    tweets = [tweet.serialize for tweet in page[:limit]]
     payload["tweets"] = tweets
 
+    if len(page) > limit:
+        cursor = encode_tweet_cursor(page[limit - 1])
+        started_ts = dump_datetime(started)
+        ended_ts = dump_datetime(ended)
+        payload["next"] = (f"/api/sent-tweets?startedAt={started_ts}"
+                           f"&endedAt={ended_ts}&after={cursor}&limit={limit}")
+
     return payload
 
 
-def create_streamdata_payload(user, stream_id):
-    """Returns data points for given stream id if found for user."""
+def encode_tweet_cursor(tweet):
+    """Creates a cursor string from a tweet's created_at and tweet_id."""
+
+    micros = round(tweet.created_at.replace(
+        tzinfo=datetime.timezone.utc).timestamp() * 1000000)
+    return "{}_{}".format(micros, tweet.tweet_id)
+
+
+def decode_tweet_cursor(cursor):
+    """Returns the (created_at, tweet_id) stored in a cursor string.
+    Raises ValueError if the cursor is malformed."""
+
+    micros, tweet_id = cursor.split("_")
+    created_at = datetime.datetime(1970, 1, 1) + \
+        datetime.timedelta(microseconds=int(micros))
+    return (created_at, int(tweet_id))
+
+
+def create_streamdata_payload(user, stream_id, resolution=None):
+    """Returns data points for given stream id if found for user.
+    With a resolution ("5m" or "1h"), returns one aggregated point per
+    bucket instead of every raw data point."""
 
     payload = {}
 
@@ -61,9 +105,16 @@ def create_streamdata_payload(user, stream_id):
     if not stream_session:
         return payload
 
-    data_points = [data_point.serialize
-                   for data_point
-                   in stream_session.data]
+    if resolution:
+        bucket_seconds = StreamDataRollup.RESOLUTIONS[resolution]
+        data_points = [rollup.serialize
+                       for rollup
+                       in StreamDataRollup.get_session_rollups(
+                           stream_id, bucket_seconds)]
+    else:
+        data_points = [data_point.serialize
+                       for data_point
+                       in stream_session.data]
     
     payload["data"] = data_points
     return payload
@@ -16,7 +16,9 @@ export class StreamSessionChartContainer extends Component {
   componentWillMount() {
     // Fetch data here
 
-    let url = `/api/streams/data/${this.props.streamId}`;
+    // Charts use pre-aggregated points; long sessions use larger buckets.
+    let resolution = chartResolution(this.props.startedAt, this.props.endedAt);
+    let url = `/api/streams/data/${this.props.streamId}?resolution=${resolution}`;
 
     fetch(url, {
       credentials: "same-origin"
@@ -61,5 +63,16 @@ export class StreamSessionChartContainer extends Component {
 }
 
 StreamSessionChartContainer.propTypes = {
-  streamId: PropTypes.number.isRequired
+  streamId: PropTypes.number.isRequired,
+  startedAt: PropTypes.number.isRequired,
+  endedAt: PropTypes.number
 };
+
+// Sessions longer than this are charted by the hour, others by 5 minutes.
+const HOURLY_CHART_SECONDS = 24 * 60 * 60;
+
+// Returns the API resolution for a session; live sessions run until now.
+function chartResolution(startedAt, endedAt) {
+  let end = endedAt || Math.floor(Date.now() / 1000);
+  return end - startedAt > HOURLY_CHART_SECONDS ? "1h" : "5m";
+}
@@ -1,6 +1,6 @@
 import React, { Component } from "react";
 import PropTypes from "prop-types";
-import { ListGroupItem, Row } from "react-bootstrap";
+import { Button, ListGroupItem, Row } from "react-bootstrap";
 import { convertTimeStampToDateTime } from "./services/log";
 import { SentTweetsContainer } from "./SentTweetsContainer";
 import { StreamSessionChartContainer } from "./StreamSessionChartContainer";
@@ -9,8 +9,11 @@ export class StreamSessionContainer extends Component {
   constructor(props) {
     super(props);
     this.state = {
-      tweets: ""
+      tweets: "",
+      next: null,
+      loading: false
     };
+    this.handleLoadMore = this.handleLoadMore.bind(this);
   }
 
   componentWillMount() {
@@ -18,17 +21,31 @@ export class StreamSessionContainer extends Component {
       this.props.stream.startedAt
     }&endedAt=${this.props.stream.endedAt}`;
 
+    this.fetchTweets(url, []);
+  }
+
+  // Tweets are paginated; the next page is only loaded when asked for.
+  fetchTweets(url, tweets) {
+    this.setState({ loading: true });
     fetch(url, {
       credentials: "same-origin"
     })
       .then(response => response.json())
       .then(data => {
         this.setState({
-          tweets: data.tweets
+          tweets: tweets.concat(data.tweets),
+          next: data.next || null,
+          loading: false
         });
       });
   }
 
+  handleLoadMore() {
+    if (this.state.next && !this.state.loading) {
+      this.fetchTweets(this.state.next, this.state.tweets);
+    }
+  }
+
   render() {
     let tweetsContainer = <div />;
     if (this.state.tweets.length > 0) {
@@ -37,6 +54,19 @@ export class StreamSessionContainer extends Component {
       tweetsContainer = <h4 className="no-tweets">No tweets sent!</h4>;
     }
 
+    let loadMoreButton = <div />;
+    if (this.state.next) {
+      loadMoreButton = (
+        <Button
+          className="load-more-tweets"
+          disabled={this.state.loading}
+          onClick={this.handleLoadMore}
+        >
+          {this.state.loading ? "Loading..." : "Load more tweets"}
+        </Button>
+      );
+    }
+
     return (
       <ListGroupItem>
         <ListGroupItem>
@@ -44,10 +74,15 @@ export class StreamSessionContainer extends Component {
             Stream Started:{" "}
             {convertTimeStampToDateTime(this.props.stream.startedAt)}
           </h4>
-          <StreamSessionChartContainer streamId={this.props.stream.streamId} />
+          <StreamSessionChartContainer
+            streamId={this.props.stream.streamId}
+            startedAt={this.props.stream.startedAt}
+            endedAt={this.props.stream.endedAt}
+          />
         </ListGroupItem>
         <ListGroupItem className="sent-tweets-container">
           <Row>{tweetsContainer}</Row>
+          <Row>{loadMoreButton}</Row>
         </ListGroupItem>
       </ListGroupItem>
     );
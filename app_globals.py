@@ -1,3 +1,19 @@
 """Globals for Yet Another Twitch Toolkit."""
+import os
+from concurrent.futures import ThreadPoolExecutor
 from flask_apscheduler import APScheduler
+from scheduling_engine import (SchedulingEngine, SPREAD_SECONDS,
+                               JITTER_SECONDS, TASK_WORKERS)
+from partitioning import Partition
+from stream_data_writer import StreamDataWriter
 scheduler = APScheduler()
+engine = SchedulingEngine(spread=SPREAD_SECONDS, jitter=JITTER_SECONDS)
+# Runs the engine's due tasks; the tick jobs only dequeue them.
+engine_executor = ThreadPoolExecutor(max_workers=TASK_WORKERS,
+                                     thread_name_prefix="engine")
+partition = Partition()
+stream_data_writer = StreamDataWriter()
+
+# When set, worker.py processes own all scheduled work and the web process
+# only records state in the db for them to pick up.
+SCHEDULE_IN_WORKERS = os.environ.get("SCHEDULE_IN_WORKERS") == "1"
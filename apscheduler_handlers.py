@@ -1,32 +1,86 @@
 """APScheduler job handlers."""
 import datetime
-import random
-from app_globals import scheduler
+import time
+import calendar
+from app_globals import (scheduler, engine, partition, stream_data_writer,
+                         SCHEDULE_IN_WORKERS)
+from scheduling_engine import TICK_SECONDS
 import apscheduler_jobs as jobs
 import twitch_helpers
 import template_helpers
 import model
 
+# Id of the job that fetches data for every live user in batches.
+FETCH_ALL_JOB_ID = "fetch_data_all"
+
+# Per-user jobs, with ids like "send_tweets4", stored before the engine and
+# batched polling. They're removed from the jobstore when the engine starts.
+LEGACY_JOB_TYPES = {"fetch_data", "send_tweets", "renew_webhook"}
+
+# Twitch tokens expiring within twitch_tokens.REFRESH_MARGIN_SECONDS are
+# refreshed this often.
+REFRESH_TOKENS_JOB_ID = "refresh_twitch_tokens"
+REFRESH_TOKENS_SECONDS = 5 * 60
+
+# Webhook subscriptions last 10 days; renew every 9.
+RENEW_WEBHOOK_SECONDS = 9 * 24 * 60 * 60
+# Renewals loaded at startup are spread over this many seconds.
+RENEW_WEBHOOK_SPREAD_SECONDS = 60 * 60
+
+# Webhook renewals are reconciled when users move between workers, and at
+# least this often to pick up users who started or stopped tweeting.
+RENEW_WEBHOOK_SYNC_SECONDS = 60 * 60
+
+# When sync_webhook_renewals last ran in this process.
+renewals_synced_at = 0
+
+# sync_engine_tasks reports the busiest second this far ahead.
+LOAD_REPORT_SECONDS = 5 * 60
+
+# Workers renew their lease every HEARTBEAT_SECONDS; a worker whose lease
+# is older than LEASE_SECONDS is considered gone and its users move.
+HEARTBEAT_SECONDS = 15
+LEASE_SECONDS = 45
+
+# Twitch recommends allowing 15 seconds for a new clip to appear.
+CLIP_CONFIRM_ATTEMPTS = 3
+CLIP_CONFIRM_DELAY = 5
+# Clip checks only matter for a few seconds, so they're kept out of the
+# persistent jobstore.
+CLIP_CONFIRM_JOBSTORE = "memory"
+
 
 def start_fetching_twitch_data(user_id):
     """Begin fetching data about a user's stream."""
 
-    # Do the first run of the task immediately
+    # Poll the user until their stream shows up or is found offline twice,
+    # even if Twitch doesn't list it yet.
     user = model.User.get_user_from_id(user_id)
+    user.update_fetching(True)
+
+    # Do the first run of the task immediately
     stream_data = twitch_helpers.serialize_twitch_stream_data(user)
     print(stream_data)
     if stream_data:
         twitch_helpers.write_twitch_stream_data(user, stream_data)
 
+    # The batched job picks the user up from here on.
+    print("Fetching data for user: {}".format(user_id))
+    if schedules_locally():
+        start_fetching_all_twitch_data()
+
+
+def start_fetching_all_twitch_data():
+    """Begin the batched fetch_data job if it isn't already running."""
+
+    if scheduler.get_job(FETCH_ALL_JOB_ID):
+        return
+
     # Start job on 60 second interval
     interval = 60
-    print("Fetching data for user: {}".format(user_id))
-    job_type = "fetch_data"
-    job_id = job_type + str(user_id)
-    scheduler.add_job(func=jobs.fetch_twitch_data,
-                      id=job_id,
+    scheduler.add_job(func=jobs.fetch_all_twitch_data,
+                      id=FETCH_ALL_JOB_ID,
                       trigger="interval",
-                      args=[user_id],
                       replace_existing=True,
                       seconds=interval)
 
@@ -34,17 +88,12 @@ def start_fetching_twitch_data(user_id):
 def renew_webhook(user_id):
     """Begin renewing webhook subscription for user's stream on interval."""
 
-    interval = 9
-    job_type = "renew_webhook"
-    job_id = job_type + str(user_id)
+    # Workers pick up renewals for tweeting users on their next sync.
+    if not schedules_locally():
+        return
 
-    # Start job on 9 day interval
-    scheduler.add_job(func=jobs.renew_stream_webhook,
-                      id=job_id,
-                      trigger="interval",
-                      args=[user_id],
-                      replace_existing=True,
-                      days=interval)
+    # Start task on 9 day interval
+    engine.schedule("renew_webhook", user_id, RENEW_WEBHOOK_SECONDS)
 
 
 def stop_renew_webhook(user_id):
@@ -56,43 +105,67 @@ def stop_renew_webhook(user_id):
 
 
 def stop_fetching_twitch_data(user_id):
-    """End the currently running fetch_data job for the user."""
+    """Stop fetching data about a user's stream."""
     # Save end timestamp of stream session to close session.
+    # Closing the session also drops the user from the batched job.
     user = model.User.get_user_from_id(user_id)
+    user.update_fetching(False)
     model.StreamSession.end_stream_session(user, datetime.datetime.utcnow())
-
-    user_id = str(user_id)
-    job_type = "fetch_data"
-    stop_job(job_type, user_id)
+    twitch_helpers.LIVE_SESSIONS.close(user_id)
 
 
 def start_tweeting(user_id, interval):
     """Start tweeting for the given user on the specified interval."""
 
+    # Workers start tweeting for live users on their next sync.
+    if not schedules_locally():
+        return
+
     user = model.User.get_user_from_id(user_id)
     if user.is_tweeting:
-        templates = [template.contents for template in user.templates]
-        random_template = random.choice(templates)
-
-        tweet_copy = template_helpers.populate_tweet_template(
-            random_template, user_id
-        )
-        if tweet_copy:
-            template_helpers.publish_to_twitter(tweet_copy, user_id)
-
-        # Sets up job for tweeting at regular interval.
-        job_type = "send_tweets"
-        job_id = job_type + str(user_id)
-        scheduler.add_job(func=jobs.send_tweets,
-                          id=job_id,
-                          trigger="interval",
-                          args=[user_id],
-                          replace_existing=True,
-                          minutes=interval)
+        random_template = model.Template.get_random_template(user_id)
+        if random_template:
+            tweet_copy = template_helpers.populate_tweet_template(
+                random_template.contents, user_id,
+                template_id=random_template.template_id
+            )
+            if tweet_copy:
+                # Repeated go-live notices in the same slot tweet once.
+                run_slot = engine.run_slot(time.time(), interval * 60)
+                template_helpers.publish_to_twitter(
+                    tweet_copy, user_id,
+                    tweet_key=template_helpers.get_tweet_key(user_id,
+                                                             run_slot)
+                )
+        else:
+            print("User {} has no templates.".format(user_id))
+
+        # Sets up task for tweeting at regular interval.
+        engine.schedule("send_tweets", user_id, interval * 60)
     else:
         print("\nTweet Job not started; disabled by User {}".format(user_id))
 
 
+def schedule_clip_confirmation(contents, user_id, clip_slug, attempt=1,
+                               tweet_key=None):
+    """Check for a submitted clip shortly, then tweet with it under
+    tweet_key (the clip's own key by default)."""
+
+    job_type = "confirm_clip"
+    job_id = job_type + clip_slug
+    run_date = (datetime.datetime.now() +
+                datetime.timedelta(seconds=CLIP_CONFIRM_DELAY))
+    scheduler.add_job(func=jobs.confirm_clip_and_tweet,
+                      id=job_id,
+                      trigger="date",
+                      run_date=run_date,
+                      args=[contents, user_id, clip_slug, attempt,
+                            tweet_key],
+                      jobstore=CLIP_CONFIRM_JOBSTORE,
+                      replace_existing=True,
+                      misfire_grace_time=60)
+
+
 def stop_tweeting(user_id):
     """End the currently running send_tweets job for the user."""
     user_id = str(user_id)
@@ -102,7 +175,161 @@ def stop_tweeting(user_id):
 
 def stop_job(job_type, user_id):
     """Given a job type and user_id, stop the job."""
-    try:
-        scheduler.delete_job(job_type + user_id)
-    except Exception:
-        pass
+    engine.unschedule(job_type, user_id)
+
+
+def remove_legacy_jobs(job_types=LEGACY_JOB_TYPES):
+    """Delete the per-user jobs of job_types left in the jobstore from
+    before the engine. Returns the number of jobs removed."""
+
+    removed = 0
+    for job in scheduler.get_jobs():
+        job_type = job.id.rstrip("0123456789")
+        if job_type in job_types and job_type != job.id:
+            scheduler.delete_job(job.id)
+            removed += 1
+    if removed:
+        print("Removed {} legacy per-user jobs.".format(removed))
+    return removed
+
+
+def start_scheduling_engine():
+    """Load recurring tasks from the db and start the shard tick jobs.
+    Call once after the scheduler has started."""
+
+    remove_legacy_jobs()
+
+    with model.db.app.app_context():
+        sync_engine_tasks(sync_renewals=True)
+
+    # Polling jobs buffer their data points through the writer.
+    stream_data_writer.start(model.db.app)
+    # Tweets are queued by jobs and posted by the publisher threads.
+    template_helpers.tweet_publisher.start(model.db.app)
+
+    for shard_index in range(engine.shard_count):
+        scheduler.add_job(func=jobs.run_engine_tick,
+                          id="engine_tick" + str(shard_index),
+                          trigger="interval",
+                          args=[shard_index],
+                          replace_existing=True,
+                          coalesce=True,
+                          max_instances=1,
+                          seconds=TICK_SECONDS)
+
+    start_fetching_all_twitch_data()
+
+    scheduler.add_job(func=jobs.refresh_expiring_twitch_tokens,
+                      id=REFRESH_TOKENS_JOB_ID,
+                      trigger="interval",
+                      replace_existing=True,
+                      coalesce=True,
+                      max_instances=1,
+                      seconds=REFRESH_TOKENS_SECONDS)
+
+
+def sync_engine_tasks(sync_renewals=False):
+    """Reconcile the engine's tweet tasks, and webhook renewals if
+    sync_renewals is set, with the db for the users this process owns.
+    Adds tasks for newly owned users and drops the rest."""
+
+    now = time.time()
+
+    # Sessions ended by other processes drop out of the registry here.
+    twitch_helpers.LIVE_SESSIONS.load(model.StreamSession.get_open_sessions())
+
+    # Live users who are tweeting: tweet one interval after their last
+    # tweet, or right away if that time has passed.
+    live_users = [user for user in model.User.get_live_tweeting_users()
+                  if partition.owns(user.user_id)]
+    last_tweet_times = model.SentTweet.get_last_tweet_times(
+        [user.user_id for user in live_users]
+    )
+    for user in live_users:
+        if engine.is_scheduled("send_tweets", user.user_id):
+            continue
+        interval = (user.tweet_interval or 30) * 60
+        first_run = now
+        last_tweet_at = last_tweet_times.get(user.user_id)
+        if last_tweet_at:
+            last_tweet_ts = calendar.timegm(last_tweet_at.utctimetuple())
+            first_run = max(now, last_tweet_ts + interval)
+        engine.schedule("send_tweets", user.user_id, interval,
+                        first_run=first_run)
+
+    live_user_ids = {user.user_id for user in live_users}
+    for user_id in engine.scheduled_user_ids("send_tweets") - live_user_ids:
+        engine.unschedule("send_tweets", user_id)
+
+    if sync_renewals:
+        sync_webhook_renewals(now)
+
+    print("Engine has {} scheduled tasks.".format(len(engine)))
+    report_engine_load()
+
+
+def sync_webhook_renewals(now):
+    """Reconcile the engine's webhook renewals with the tweeting users this
+    process owns."""
+
+    global renewals_synced_at
+    renewals_synced_at = now
+
+    # We don't know when each webhook was last renewed, so spread the
+    # renewals over the next hour rather than sending them all at once.
+    # Tweets are spread over the engine's default window.
+    tweeting_user_ids = {user_id
+                         for user_id in model.User.get_tweeting_user_ids()
+                         if partition.owns(user_id)}
+    for user_id in tweeting_user_ids:
+        if engine.is_scheduled("renew_webhook", user_id):
+            continue
+        engine.schedule("renew_webhook", user_id,
+                        RENEW_WEBHOOK_SECONDS, first_run=now,
+                        spread=RENEW_WEBHOOK_SPREAD_SECONDS)
+
+    for user_id in (engine.scheduled_user_ids("renew_webhook") -
+                    tweeting_user_ids):
+        engine.unschedule("renew_webhook", user_id)
+
+
+def report_engine_load(horizon=LOAD_REPORT_SECONDS):
+    """Print how many task runs are due per second over the next horizon
+    seconds. Returns the per-second counts."""
+
+    load = engine.load_by_second(horizon)
+    busy_seconds = [count for count in load if count]
+    print("Engine load over next {}s: {} runs, peak {}/s, {} busy seconds."
+          .format(horizon, sum(load), max(load or [0]), len(busy_seconds)))
+    return load
+
+
+def rebalance_partition():
+    """Renew this worker's lease and take ownership of its share of users
+    based on the workers that are alive."""
+
+    worker_id = partition.worker_id
+    model.WorkerLease.heartbeat(worker_id)
+    model.WorkerLease.remove_expired(LEASE_SECONDS * 10)
+
+    worker_ids = model.WorkerLease.get_live_worker_ids(LEASE_SECONDS)
+    rebalanced = partition.update(worker_ids)
+    if rebalanced:
+        print("Worker {} rebalanced across {} workers.".format(
+            worker_id, len(partition.ring.nodes)
+        ))
+
+    # Also picks up streams and settings the web process wrote since the
+    # last sync. Renewals only change with ownership or tweeting settings,
+    # so they're checked less often.
+    sync_engine_tasks(
+        sync_renewals=(rebalanced or time.time() - renewals_synced_at >=
+                       RENEW_WEBHOOK_SYNC_SECONDS)
+    )
+
+
+def schedules_locally():
+    """Return True if this process runs scheduled work.
+    False in the web process when worker.py processes own the work."""
+
+    return not SCHEDULE_IN_WORKERS or partition.worker_id is not None
@@ -1,43 +1,107 @@
 """APScheduler job functions."""
 
-import random
-from model import User, db
+import time
+from model import StreamSession, User, Template, TwitchToken, db
 import twitch_helpers
+import twitch_poller
+import twitch_tokens
 import template_helpers
+import apscheduler_handlers as ap_handlers
+from app_globals import (engine, engine_executor, partition,
+                         stream_data_writer)
 
 
-def fetch_twitch_data(user_id):
-    """Job: Grab data about user's stream. Write it to db."""
+def fetch_all_twitch_data():
+    """Job: Grab data about every open stream in batches. Write it to db."""
     try:
         with db.app.app_context():
-            print("Fetching stream info for {} now.".format(user_id))
-            user = User.get_user_from_id(user_id)
-            stream_data = twitch_helpers.serialize_twitch_stream_data(user)
-            print(stream_data)
-            if stream_data:
-                twitch_helpers.write_twitch_stream_data(user, stream_data)
+            users = [user for user in User.get_users_to_poll()
+                     if partition.owns(user.user_id)]
+            print("Fetching stream info for {} users now.".format(len(users)))
+            all_stream_data = twitch_poller.poll_twitch_streams_data(users)
+            # Another process may have closed or replaced sessions since
+            # the last sync; only append data to sessions still open.
+            twitch_helpers.LIVE_SESSIONS.load(
+                StreamSession.get_open_sessions())
+            for user in users:
+                stream_data = all_stream_data.get(user.user_id)
+                if not stream_data:
+                    continue
+                # One user's bad data point shouldn't stop the others.
+                try:
+                    twitch_helpers.write_twitch_stream_data(
+                        user, stream_data, writer=stream_data_writer
+                    )
+                except Exception as e:
+                    print(e)
+                    db.session.rollback()
     except Exception as e:
         print(e)
 
 
-def send_tweets(user_id):
-    """Job: Sends a random tweet to user's Twitter account."""
+def send_tweets(user_id, run_slot=None):
+    """Job: Sends a random tweet to user's Twitter account.
+    At most one tweet is queued per run_slot, even if this job runs twice.
+    Without a run_slot (jobs stored before the engine), the slot is the
+    user's current tweet interval."""
     try:
         with db.app.app_context():
-            user = User.get_user_from_id(user_id)
-            templates = [template.contents for template in user.templates]
-            random_template = random.choice(templates)
+            if run_slot is None:
+                user = User.get_user_from_id(user_id)
+                run_slot = engine.run_slot(time.time(),
+                                           (user.tweet_interval or 30) * 60)
+            tweet_key = template_helpers.get_tweet_key(user_id, run_slot)
+
+            random_template = Template.get_random_template(user_id)
+            if not random_template:
+                print("User {} has no templates.".format(user_id))
+                return
 
             tweet_copy = template_helpers.populate_tweet_template(
-                random_template, user_id
+                random_template.contents, user_id,
+                template_id=random_template.template_id
             )
             if tweet_copy:
-                template_helpers.publish_to_twitter(tweet_copy, user_id)
+                template_helpers.publish_to_twitter(tweet_copy, user_id,
+                                                    tweet_key=tweet_key)
+    except Exception as e:
+        print(e)
+
+
+def confirm_clip_and_tweet(contents, user_id, clip_slug, attempt,
+                           tweet_key=None):
+    """Job: Checks if a submitted clip exists, then queues the tweet.
+    Reschedules itself until the clip is found or attempts run out."""
+    # One tweet per clip (or per run it was made for), even if this job
+    # runs twice.
+    tweet_key = tweet_key or "clip-" + clip_slug
+    try:
+        with db.app.app_context():
+            new_clip, clip_url = twitch_helpers.confirm_twitch_clip(
+                clip_slug, user_id
+            )
+
+            # If new clip is created, append to tweet and save clip id.
+            if new_clip:
+                contents += "\n{}".format(clip_url)
+                template_helpers.queue_tweet(contents, user_id,
+                                             clip_id=new_clip.clip_id,
+                                             idempotency_key=tweet_key)
+            elif attempt < ap_handlers.CLIP_CONFIRM_ATTEMPTS:
+                ap_handlers.schedule_clip_confirmation(contents, user_id,
+                                                       clip_slug,
+                                                       attempt + 1,
+                                                       tweet_key)
+            else:
+                print("Clip {} not found. Tweeting without it."
+                      .format(clip_slug))
+                template_helpers.queue_tweet(contents, user_id,
+                                             idempotency_key=tweet_key)
     except Exception as e:
         print(e)
 
 
-def renew_stream_webhook(user_id):
+def renew_stream_webhook(user_id, run_slot=None):
     """Job: Renews webhook for user's stream."""
     try:
         with db.app.app_context():
@@ -49,6 +113,54 @@ def renew_stream_webhook(user_id):
 
 
 
+def refresh_expiring_twitch_tokens():
+    """Job: Refreshes Twitch tokens that are about to expire, so polls and
+    clips don't wait on a refresh after a 401."""
+    try:
+        with db.app.app_context():
+            tokens = TwitchToken.get_expiring(
+                twitch_tokens.REFRESH_MARGIN_SECONDS,
+                max_failures=twitch_tokens.MAX_REFRESH_FAILURES
+            )
+            users = [token.user for token in tokens
+                     if partition.owns(token.user_id)]
+            if users:
+                refreshed = twitch_helpers.token_manager.refresh_many(users)
+                print("Refreshed {} of {} expiring Twitch tokens."
+                      .format(refreshed, len(users)))
+    except Exception as e:
+        print(e)
+
+
+def run_engine_tick(shard_index):
+    """Job: Hands every engine task that is due in the given shard to the
+    task threads, so the tick isn't held up by a slow user."""
+    due = engine.pop_due_runs(shard_index)
+    for task_type, runs in due.items():
+        task = ENGINE_TASKS.get(task_type)
+        if task is None:
+            print("Unknown engine task: {}".format(task_type))
+            continue
+        for user_id, run_slot in runs:
+            # Each task catches and prints its own errors.
+            engine_executor.submit(task, user_id, run_slot)
+
+
+def rebalance_workers():
+    """Job: Renews this worker's lease and syncs its share of users."""
+    try:
+        with db.app.app_context():
+            ap_handlers.rebalance_partition()
+    except Exception as e:
+        print(e)
+
+
+# Engine task types and the job that runs each one for a user and run slot.
+ENGINE_TASKS = {
+    "send_tweets": send_tweets,
+    "renew_webhook": renew_stream_webhook
+}
+
 
 if __name__ == "__main__":
     # Interact with db if we run this module directly.
@@ -0,0 +1,94 @@
+"""Benchmark Twitch login user lookups as the users table grows.
+
+Fills a scratch database with fake users, up to 1M, and times the lookup
+authorize_twitch does at each size, next to the old load-every-user check.
+
+    createdb yattk_benchmark
+    python benchmark_login.py [postgresql:///yattk_benchmark]
+
+The script drops and recreates every table in the database it's given."""
+
+import sys
+import time
+import random
+from flask import Flask
+from model import connect_to_db, db, User
+
+SIZES = [1000, 10000, 100000, 1000000]
+# The old check loads every user, so only time it this far.
+FULL_SCAN_MAX_USERS = 100000
+LOOKUPS = 200
+INSERT_BATCH = 10000
+
+
+def add_users(start, end):
+    """Insert fake users with Twitch IDs start to end - 1."""
+
+    table = User.__table__
+    for batch_start in range(start, end, INSERT_BATCH):
+        batch_end = min(batch_start + INSERT_BATCH, end)
+        db.session.execute(table.insert().values([
+            {"twitch_id": str(twitch_id),
+             "twitch_username": "user" + str(twitch_id),
+             "email": "user{}@example.com".format(twitch_id)}
+            for twitch_id in range(batch_start, batch_end)
+        ]))
+    db.session.commit()
+    db.session.execute("ANALYZE users")
+
+
+def time_lookups(lookup, user_count, lookups=LOOKUPS):
+    """Return the median milliseconds for lookup(twitch_id) on random
+    existing users."""
+
+    timings = []
+    for _ in range(lookups):
+        twitch_id = str(random.randrange(user_count))
+        started = time.perf_counter()
+        lookup(twitch_id)
+        timings.append((time.perf_counter() - started) * 1000)
+        db.session.remove()
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def indexed_lookup(twitch_id):
+    """What authorize_twitch does now."""
+
+    return User.get_user_from_twitch_id(twitch_id)
+
+
+def full_scan_lookup(twitch_id):
+    """What authorize_twitch used to do."""
+
+    twitch_ids = {user.twitch_id for user in User.query.all()}
+    if twitch_id in twitch_ids:
+        return User.get_user_from_twitch_id(twitch_id)
+
+
+def run(db_uri):
+    """Print lookup times for each size in SIZES."""
+
+    app = Flask(__name__)
+    connect_to_db(app, db_uri, show_sql=False)
+    db.drop_all()
+    db.create_all()
+
+    print("{:>9} {:>12} {:>14}".format("users", "indexed ms", "full scan ms"))
+    user_count = 0
+    for size in SIZES:
+        add_users(user_count, size)
+        user_count = size
+
+        indexed = time_lookups(indexed_lookup, user_count)
+        if user_count <= FULL_SCAN_MAX_USERS:
+            full_scan = "{:14.2f}".format(
+                time_lookups(full_scan_lookup, user_count, lookups=5))
+        else:
+            full_scan = "{:>14}".format("-")
+        print("{:9d} {:12.3f} {}".format(user_count, indexed, full_scan))
+
+
+if __name__ == "__main__":
+    run(sys.argv[1] if len(sys.argv) > 1 else
+        "postgresql:///yattk_benchmark")
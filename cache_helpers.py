@@ -0,0 +1,77 @@
+"""In-memory cache helpers for Stream Tweeter."""
+
+import time
+import threading
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """Thread-safe LRU cache whose entries expire after ttl seconds."""
+
+    def __init__(self, maxsize=1000, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return the cached value for key, or default if missing or stale."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return default
+            # Mark as most recently used.
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        """Store value for key, evicting the least recently used entry."""
+
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """Remove key from the cache if present."""
+
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Remove every entry and reset the counters."""
+
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def missing(self, keys):
+        """Return the keys that have no fresh entry, without counting them."""
+
+        now = time.monotonic()
+        with self._lock:
+            return [key for key in keys
+                    if key not in self._entries
+                    or self._entries[key][1] < now]
+
+    @property
+    def stats(self):
+        """Return hit/miss counters and current size."""
+
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "size": len(self._entries)}
+
+    def __len__(self):
+        return len(self._entries)
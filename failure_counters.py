@@ -0,0 +1,96 @@
+"""Failure counters shared by the threads, or processes, checking streams.
+
+Counters map a key, such as a user_id, to a count that can be incremented
+and reset atomically. LocalCounter keeps counts in this process.
+PostgresCounter keeps them in the db, so every worker process sees the same
+counts."""
+
+import os
+import threading
+
+# "local" or "postgres". Processes only share counts through the db, so
+# default to it when scheduled work runs in worker processes.
+FAILURE_COUNTER_BACKEND = os.environ.get(
+    "FAILURE_COUNTER_BACKEND",
+    "postgres" if os.environ.get("SCHEDULE_IN_WORKERS") == "1" else "local"
+)
+
+
+class LocalCounter(object):
+    """In-process counters. Keys are spread over striped locks, so threads
+    updating different users rarely wait on each other."""
+
+    def __init__(self, stripes=16):
+        self._stripes = [({}, threading.Lock()) for _ in range(stripes)]
+
+    def _stripe(self, key):
+        """Return the (counts, lock) pair that holds key."""
+
+        return self._stripes[hash(key) % len(self._stripes)]
+
+    def increment(self, key, amount=1):
+        """Add amount to key's count. Returns the new count."""
+
+        counts, lock = self._stripe(key)
+        with lock:
+            counts[key] = counts.get(key, 0) + amount
+            return counts[key]
+
+    def get(self, key):
+        """Return key's count."""
+
+        counts, lock = self._stripe(key)
+        with lock:
+            return counts.get(key, 0)
+
+    def reset(self, key):
+        """Set key's count back to 0."""
+
+        self.reset_many([key])
+
+    def reset_many(self, keys):
+        """Set each key's count back to 0."""
+
+        for key in keys:
+            counts, lock = self._stripe(key)
+            with lock:
+                counts.pop(key, None)
+
+
+class PostgresCounter(object):
+    """Counters stored in the db through table, a model with increment,
+    get_count and reset classmethods (model.FailureCount). Needs an app
+    context."""
+
+    def __init__(self, name, table):
+        self.name = name
+        self.table = table
+
+    def increment(self, key, amount=1):
+        """Add amount to key's count. Returns the new count."""
+
+        return self.table.increment(self.name, key, amount)
+
+    def get(self, key):
+        """Return key's count."""
+
+        return self.table.get_count(self.name, key)
+
+    def reset(self, key):
+        """Set key's count back to 0."""
+
+        self.reset_many([key])
+
+    def reset_many(self, keys):
+        """Set each key's count back to 0."""
+
+        if keys:
+            self.table.reset(self.name, keys)
+
+
+def create_counter(name, table, backend=None):
+    """Create the counter called name using the configured backend."""
+
+    if (backend or FAILURE_COUNTER_BACKEND) == "postgres":
+        return PostgresCounter(name, table)
+    return LocalCounter()
@@ -0,0 +1,103 @@
+"""In-memory registry of the stream session each live user is on.
+
+Polls compare new stream data with the user's record: while the Twitch
+stream is the same, its session is known and only the data point is
+written. The db is asked about sessions only when a stream starts, or
+after the registry is reloaded."""
+
+import threading
+
+
+class LiveSession(object):
+    """Current session and last polled values for one live user."""
+
+    __slots__ = ("stream_id", "twitch_session_id", "game_id", "game_name",
+                 "stream_title", "viewer_count")
+
+    def __init__(self, stream_id, twitch_session_id, stream_data=None):
+        self.stream_id = stream_id
+        self.twitch_session_id = twitch_session_id
+        self.game_id = None
+        self.game_name = None
+        self.stream_title = None
+        self.viewer_count = None
+        if stream_data:
+            self.update(stream_data)
+
+    def __repr__(self):
+        """Print helpful information."""
+
+        return "<LiveSession stream_id={}, twitch_session_id='{}'>" \
+            .format(self.stream_id, self.twitch_session_id)
+
+    def update(self, stream_data):
+        """Keep the latest polled values."""
+
+        self.game_id = stream_data.get("game_id")
+        self.game_name = stream_data.get("game_name")
+        self.stream_title = stream_data.get("stream_title")
+        self.viewer_count = stream_data.get("viewer_count")
+
+
+class LiveSessionRegistry(object):
+    """Thread-safe map of user_id to LiveSession."""
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """Return the user's LiveSession, or None if they aren't live."""
+
+        with self._lock:
+            return self._sessions.get(int(user_id))
+
+    def get_current(self, user_id, twitch_session_id):
+        """Return the user's LiveSession if it's for twitch_session_id."""
+
+        live_session = self.get(user_id)
+        if (live_session and
+                live_session.twitch_session_id == twitch_session_id):
+            return live_session
+        return None
+
+    def open(self, user_id, stream_id, twitch_session_id, stream_data=None):
+        """Record the session the user is live on. Returns its record."""
+
+        live_session = LiveSession(stream_id, twitch_session_id, stream_data)
+        with self._lock:
+            self._sessions[int(user_id)] = live_session
+        return live_session
+
+    def close(self, user_id):
+        """Forget the user's session once it has ended."""
+
+        with self._lock:
+            self._sessions.pop(int(user_id), None)
+
+    def load(self, stream_sessions):
+        """Replace the registry with the given open StreamSessions. Records
+        for sessions that are still open keep their last polled values."""
+
+        with self._lock:
+            sessions = {}
+            for stream_session in stream_sessions:
+                user_id = stream_session.user_id
+                live_session = self._sessions.get(user_id)
+                if (live_session is None or
+                        live_session.stream_id != stream_session.stream_id):
+                    live_session = LiveSession(
+                        stream_session.stream_id,
+                        stream_session.twitch_session_id
+                    )
+                sessions[user_id] = live_session
+            self._sessions = sessions
+
+    def clear(self):
+        """Forget every session."""
+
+        with self._lock:
+            self._sessions = {}
+
+    def __len__(self):
+        return len(self._sessions)
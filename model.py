@@ -1,11 +1,14 @@
 """Models and database functions for Yet Another Twitch Toolkit."""
 
 import os
+import uuid
 import datetime
 from datetime import timezone
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import backref
-from sqlalchemy import desc, func
+from sqlalchemy.orm import backref, joinedload
+from sqlalchemy.orm.session import make_transient_to_detached
+from sqlalchemy import case, desc, func, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 
 db = SQLAlchemy()
 
@@ -28,6 +31,9 @@ class User(db.Model):
     twitter_id = db.Column(db.Text)
     tweet_interval = db.Column(db.Integer)
     is_tweeting = db.Column(db.Boolean, default=True)
+    # Set when a stream.online notification comes in, so the user is polled
+    # even before Twitch lists the stream; cleared when fetching stops.
+    fetching_since = db.Column(db.DateTime)
 
     is_active = True
     is_authenticated = True
@@ -51,6 +57,59 @@ class User(db.Model):
 
         return cls.query.filter_by(twitch_id=twitch_id).first()
 
+    @classmethod
+    def register_twitch_user(cls, twitch_id, email, twitch_username,
+                             twitch_displayname):
+        """Create a user for a Twitch account unless one exists.
+        Returns (user, created). Safe to call concurrently for the same
+        Twitch ID; only one call creates the user."""
+
+        table = cls.__table__
+        statement = pg_insert(table).values(
+            twitch_id=twitch_id,
+            email=email,
+            twitch_username=twitch_username,
+            twitch_displayname=twitch_displayname
+        ).on_conflict_do_nothing(
+            index_elements=["twitch_id"]
+        ).returning(table.c.user_id)
+
+        user_id = db.session.execute(statement).scalar()
+        db.session.commit()
+
+        if user_id is None:
+            return cls.get_user_from_twitch_id(twitch_id), False
+        return cls.query.get(user_id), True
+
+    @classmethod
+    def get_live_tweeting_users(cls):
+        """Find the user_id and tweet_interval of tweeting users who have an
+        open stream session. Reads only those columns."""
+
+        return db.session.query(cls.user_id, cls.tweet_interval) \
+            .join(StreamSession) \
+            .filter(StreamSession.ended_at.is_(None),
+                    cls.is_tweeting.is_(True)) \
+            .distinct().all()
+
+    @classmethod
+    def get_users_to_poll(cls):
+        """Find the users whose streams are polled: those with an open
+        stream session, and those still waiting for their stream to show
+        up after going live."""
+
+        open_user_ids = db.session.query(StreamSession.user_id) \
+            .filter(StreamSession.ended_at.is_(None))
+        return cls.query.filter(cls.fetching_since.isnot(None) |
+                                cls.user_id.in_(open_user_ids)).all()
+
+    @classmethod
+    def get_tweeting_user_ids(cls):
+        """Find the ids of users who have tweeting enabled."""
+
+        return [row.user_id for row in
+                db.session.query(cls.user_id).filter_by(is_tweeting=True)]
+
     def get_id(self):
         """Return a unicode string; for flask-login."""
         return str(self.user_id)
@@ -72,22 +131,37 @@ class User(db.Model):
         self.tweet_interval = int(tweet_interval)
         db.session.commit()
 
+    def update_twitch_username(self, twitch_username):
+        """Updates the stored Twitch login for user."""
+
+        self.twitch_username = twitch_username
+        db.session.commit()
+
     def update_twitch_access_token(self,
                                    access_token,
                                    refresh_token,
                                    expires_in):
         """Updates the Twitch access token and info for user."""
+        expires_at = None
+        if expires_in:
+            expires_at = datetime.datetime.utcnow() + \
+                datetime.timedelta(seconds=int(expires_in))
+
         my_token = self.twitch_token
         if my_token:
             my_token.access_token = access_token
             my_token.refresh_token = refresh_token
             my_token.expires_in = expires_in
+            my_token.expires_at = expires_at
+            my_token.refresh_failures = 0
+            my_token.next_refresh_at = None
         else:
             new_token = TwitchToken(
                 user_id=self.user_id,
                 access_token=access_token,
                 refresh_token=refresh_token,
-                expires_in=expires_in
+                expires_in=expires_in,
+                expires_at=expires_at
             )
             db.session.add(new_token)
         db.session.commit()
@@ -128,6 +202,13 @@ class User(db.Model):
         temp_to_edit.contents = new_contents
         db.session.commit()
     
+    def update_fetching(self, is_fetching):
+        """Enrolls or drops user from stream polling."""
+
+        self.fetching_since = datetime.datetime.utcnow() if is_fetching \
+            else None
+        db.session.commit()
+
     def update_is_tweeting(self, is_tweeting):
         """Updates is_tweeting setting for user."""
 
@@ -151,10 +232,50 @@ class TwitchToken(db.Model):
                               unique=True,
                               nullable=False)
     expires_in = db.Column(db.Integer)
+    # When the access token expires, from expires_in at the time it was
+    # issued. Tokens stored before this was recorded have none.
+    expires_at = db.Column(db.DateTime)
+    # Refreshes that failed in a row, e.g. for a revoked token, and when
+    # to try again. Reset when a new token is stored.
+    refresh_failures = db.Column(db.Integer,
+                                 nullable=False,
+                                 default=0,
+                                 server_default="0")
+    next_refresh_at = db.Column(db.DateTime)
 
     user = db.relationship("User",
                            backref=backref("twitch_token", uselist=False))
 
+    @classmethod
+    def get_expiring(cls, within_seconds, limit=100, max_failures=None):
+        """Get the tokens that expire in the next within_seconds, soonest
+        first, with their users loaded. Tokens stored before expiry was
+        tracked come first, since refreshing them records it. Tokens
+        waiting to retry a failed refresh, or that failed max_failures
+        times, are left out so they can't crowd out the rest."""
+
+        now = datetime.datetime.utcnow()
+        cutoff = now + datetime.timedelta(seconds=within_seconds)
+        # Refreshing reads user.twitch_token, so load that side as well.
+        query = cls.query.options(
+            joinedload(cls.user).joinedload(User.twitch_token)
+        ).filter(
+            cls.expires_at.is_(None) | (cls.expires_at <= cutoff),
+            cls.next_refresh_at.is_(None) | (cls.next_refresh_at <= now)
+        )
+        if max_failures is not None:
+            query = query.filter(cls.refresh_failures < max_failures)
+        return query.order_by(cls.expires_at.nullsfirst()) \
+            .limit(limit).all()
+
+    def mark_refresh_failed(self, retry_seconds):
+        """Records a failed refresh; the next is tried in retry_seconds."""
+
+        self.refresh_failures = (self.refresh_failures or 0) + 1
+        self.next_refresh_at = datetime.datetime.utcnow() + \
+            datetime.timedelta(seconds=retry_seconds)
+        db.session.commit()
+
 
 class TwitterToken(db.Model):
     """Twitter access token for a user."""
@@ -202,6 +323,13 @@ class Template(db.Model):
 
         return cls.query.filter_by(template_id=template_id).first()
 
+    @classmethod
+    def get_random_template(cls, user_id):
+        """Pick one of the user's templates at random, or None."""
+
+        return cls.query.filter_by(user_id=user_id) \
+            .order_by(func.random()).first()
+
 
 class BaseTemplate(db.Model):
     """Base templates used to create templates for user upon user creation."""
@@ -284,6 +412,18 @@ class SentTweet(db.Model):
         db.session.commit()
         return new_sent_tweet
 
+    @classmethod
+    def get_last_tweet_times(cls, user_ids):
+        """Get a dictionary of user_id to the time of their latest tweet."""
+
+        if not user_ids:
+            return {}
+
+        rows = db.session.query(cls.user_id, func.max(cls.created_at)) \
+            .filter(cls.user_id.in_(user_ids)) \
+            .group_by(cls.user_id).all()
+        return dict(rows)
+
 
 class StreamSession(db.Model):
     """A Twitch Stream session."""
@@ -334,64 +474,95 @@ class StreamSession(db.Model):
         return serialized
 
     @classmethod
-    def save_stream_session(cls, user, stream_data):
-        """Adds a new stream session linked to user."""
-
-        print("\nATTEMPTING TO SAVE NEW TWITCH SESSION.")
+    def save_stream_session(cls, user, stream_data, writer=None):
+        """Adds a new stream session linked to user.
+        If a StreamDataWriter is given, the data point is buffered
+        instead of committed right away."""
 
         t_session_id = stream_data["stream_id"]
-        twitch_session = cls.get_session_from_twitch_session_id(t_session_id)
-
-        # If no stream session exists for the Twitch session id, 
-        # then this is a new stream. Ensure all prior sessions are closed
-        # if the ended_at is null.
-
-        # TODO: TEST THIS!!
-        if not twitch_session:
-            cls.end_all_user_sessions_now(user)
-
-        # If a stream session is open and matches the current Twitch
-        # stream ID, continue to use that session.
-        # Otherwise, if the matched session has ended, create a new session.
-        if (not twitch_session) or (twitch_session and twitch_session.ended_at):
-            print("\nSAVING NEW TWITCH SESSION.")
-            user_id = user.user_id
-            started_at = stream_data["started_at"]
-            new_session = StreamSession(user_id=user_id,
-                                        twitch_session_id=t_session_id,
-                                        started_at=started_at)
-            db.session.add(new_session)
-            db.session.commit()
-            twitch_session = new_session
-        else:
-            print("\nOPEN SESSION FOUND. APPENDING TO CURRENT SESSION.")
+        print("\nSAVING TWITCH SESSION {}.".format(t_session_id))
+
+        # One statement: close the user's sessions for any other Twitch
+        # stream, then reuse the open session for this Twitch stream or
+        # create it. ux_stream_sessions_open allows one open session per
+        # Twitch stream, so a stream that ended gets a new session.
+        table = cls.__table__
+        closed = table.update().where(
+            (table.c.user_id == user.user_id) &
+            table.c.ended_at.is_(None) &
+            (table.c.twitch_session_id != t_session_id)
+        ).values(
+            ended_at=datetime.datetime.utcnow()
+        ).returning(table.c.stream_id).cte("closed")
+
+        upsert = pg_insert(table).values(user_id=user.user_id,
+                                         twitch_session_id=t_session_id,
+                                         started_at=stream_data["started_at"])
+        upsert = upsert.on_conflict_do_update(
+            index_elements=[table.c.twitch_session_id],
+            index_where=table.c.ended_at.is_(None),
+            # A no-op update, so RETURNING gives the existing row.
+            set_={"twitch_session_id": upsert.excluded.twitch_session_id}
+        ).returning(*table.c).cte("upserted")
+
+        closed_count = select([func.count()]).select_from(closed).as_scalar()
+        row = db.session.execute(
+            select([upsert, closed_count.label("closed_count")])
+        ).first()
+
+        twitch_session = cls(stream_id=row.stream_id,
+                             user_id=row.user_id,
+                             twitch_session_id=row.twitch_session_id,
+                             started_at=row.started_at,
+                             ended_at=row.ended_at)
+        make_transient_to_detached(twitch_session)
+        twitch_session = db.session.merge(twitch_session, load=False)
 
         # Also add an entry in stream_data to store snapshot.
-        StreamDatum.save_stream_data(twitch_session, stream_data)
+        # save_stream_data commits the session change with the data point.
+        if writer:
+            writer.add(StreamDatum.create_row(twitch_session.stream_id,
+                                              stream_data))
+            db.session.commit()
+        else:
+            StreamDatum.save_stream_data(twitch_session, stream_data)
 
         return twitch_session
 
     @classmethod
     def end_all_user_sessions_now(cls, user):
         """Ends all currently open sessions for the user."""
-        for stream_session in cls.query.filter_by(user_id=user.user_id,
-                                                  ended_at=None):
-            stream_session.ended_at = datetime.datetime.utcnow()
-            db.session.commit()
+
+        cls.close_user_sessions(user, datetime.datetime.utcnow())
+        db.session.commit()
 
     @classmethod
     def end_stream_session(cls, user, timestamp):
-        """Update a closed steam session with the time it was found to end."""
+        """Update a closed steam session with the time it was found to end.
+        Returns the most recent session closed."""
 
-        current_session = cls.get_user_current_session(user)
-        if current_session:
-            current_session.ended_at = timestamp
-            db.session.commit()
-            return current_session
+        stream_ids = cls.close_user_sessions(user, timestamp)
+        db.session.commit()
+        if stream_ids:
+            return cls.query.get(max(stream_ids))
         else:
             print("All sessions ended.")
             return None
 
+    @classmethod
+    def close_user_sessions(cls, user, timestamp):
+        """Set ended_at on every open session for the user in one UPDATE.
+        Returns the ids of the sessions closed; the caller commits."""
+
+        table = cls.__table__
+        result = db.session.execute(
+            table.update().where(
+                (table.c.user_id == user.user_id) &
+                table.c.ended_at.is_(None)
+            ).values(ended_at=timestamp).returning(table.c.stream_id)
+        )
+        return [row.stream_id for row in result]
+
     @classmethod
     def get_session_from_twitch_session_id(cls, twitch_session_id):
         """Gets the corresponding Twitch Session based on Twitch Session id."""
@@ -408,6 +579,25 @@ class StreamSession(db.Model):
             .order_by(cls.stream_id.desc()).first()
         return most_recent_session
 
+    @classmethod
+    def get_open_sessions(cls):
+        """Get the user_id, stream_id and twitch_session_id of every open
+        session."""
+
+        return db.session.query(cls.user_id, cls.stream_id,
+                                cls.twitch_session_id) \
+            .filter(cls.ended_at.is_(None)).all()
+
+    @classmethod
+    def get_user_latest_session(cls, user_id):
+        """Get the user's open session, or else their most recent one.
+        Each lookup reads one row through ix_user_started, however many
+        sessions the user has."""
+
+        query = cls.query.filter_by(user_id=user_id) \
+            .order_by(cls.started_at.desc())
+        return query.filter_by(ended_at=None).first() or query.first()
+
 
 class StreamDatum(db.Model):
     """Data gathered from Twitch when user is live."""
@@ -453,26 +643,214 @@ class StreamDatum(db.Model):
     def save_stream_data(cls, session, stream_data):
         """Saves stream data for user."""
 
-        timestamp = stream_data["timestamp"]
-        stream_id = session.stream_id
-        game_id = stream_data["game_id"]
-        game_name = stream_data["game_name"]
-        stream_title = stream_data["stream_title"]
-        viewer_count = stream_data["viewer_count"]
-
-        new_data = cls(timestamp=timestamp,
-                       stream_id=stream_id,
-                       game_id=game_id,
-                       game_name=game_name,
-                       stream_title=stream_title,
-                       viewer_count=viewer_count)
+        row = cls.create_row(session.stream_id, stream_data)
+        new_data = cls(**row)
         db.session.add(new_data)
+        StreamDataRollup.update_from_rows(db.session, [row])
         db.session.commit()
 
+    @staticmethod
+    def create_row(stream_id, stream_data):
+        """Creates a dictionary of stream_data column values."""
+
+        return {"timestamp": stream_data["timestamp"],
+                "stream_id": stream_id,
+                "game_id": stream_data["game_id"],
+                "game_name": stream_data["game_name"],
+                "stream_title": stream_data["stream_title"],
+                "viewer_count": stream_data["viewer_count"]}
+
 # Adds index to stream_sessions table; will be filtering by started_at for
 # API calls
 db.Index('ix_user_started', StreamSession.user_id, StreamSession.started_at)
 
+# Reading or counting a session's data points.
+db.Index('ix_stream_data_stream_timestamp',
+         StreamDatum.stream_id, StreamDatum.timestamp)
+
+# Lookups of a user's open sessions, and of sessions by Twitch stream.
+db.Index('ix_stream_sessions_user_ended',
+         StreamSession.user_id, StreamSession.ended_at)
+db.Index('ix_stream_sessions_twitch_session',
+         StreamSession.twitch_session_id)
+# One open session per Twitch stream; save_stream_session upserts on it.
+db.Index('ux_stream_sessions_open',
+         StreamSession.twitch_session_id,
+         unique=True,
+         postgresql_where=StreamSession.ended_at.is_(None))
+
+# Backs keyset pagination of a user's sent tweets by (created_at, tweet_id).
+db.Index('ix_sent_tweets_user_created',
+         SentTweet.user_id, SentTweet.created_at, SentTweet.tweet_id)
+
+
+class StreamDataRollup(db.Model):
+    """Viewer and stream info aggregated per session per time bucket."""
+
+    __tablename__ = "stream_data_rollups"
+
+    stream_id = db.Column(db.Integer,
+                          db.ForeignKey("stream_sessions.stream_id"),
+                          primary_key=True)
+    # Bucket size in seconds.
+    resolution = db.Column(db.Integer, primary_key=True)
+    bucket_start = db.Column(db.DateTime, primary_key=True)
+    last_timestamp = db.Column(db.DateTime, nullable=False)
+    num_points = db.Column(db.Integer, nullable=False)
+    sum_viewers = db.Column(db.BigInteger, nullable=False)
+    min_viewers = db.Column(db.Integer, nullable=False)
+    max_viewers = db.Column(db.Integer, nullable=False)
+    # Game and title at the start and end of the bucket.
+    first_game_name = db.Column(db.String(50), nullable=False)
+    game_name = db.Column(db.String(50), nullable=False)
+    first_stream_title = db.Column(db.String(140), nullable=False)
+    stream_title = db.Column(db.String(140), nullable=False)
+    # Changes between consecutive data points within the bucket.
+    game_changes = db.Column(db.Integer, nullable=False)
+    title_changes = db.Column(db.Integer, nullable=False)
+
+    # Resolution names accepted by the API and their bucket sizes.
+    RESOLUTIONS = {"5m": 5 * 60, "1h": 60 * 60}
+
+    def __repr__(self):
+        """Print helpful information."""
+
+        return "<StreamDataRollup stream_id={}, resolution={}, bucket={}>" \
+            .format(self.stream_id, self.resolution, self.bucket_start)
+
+    @property
+    def serialize(self):
+        """Return serializable format of rollup, shaped like a data point."""
+
+        serialized = {
+            "timestamp": dump_datetime(self.bucket_start),
+            "viewers": round(self.sum_viewers / self.num_points),
+            "minViewers": self.min_viewers,
+            "maxViewers": self.max_viewers,
+            "gameName": self.game_name,
+            "streamTitle": self.stream_title,
+            "gameChanges": self.game_changes,
+            "titleChanges": self.title_changes
+        }
+
+        return serialized
+
+    @classmethod
+    def update_from_rows(cls, connection, rows):
+        """Folds stream_data rows into every resolution's rollups.
+        connection may be a session or engine connection; the caller
+        commits."""
+
+        buckets = {}
+        for row in sorted(rows, key=lambda row: row["timestamp"]):
+            for resolution in cls.RESOLUTIONS.values():
+                key = (row["stream_id"], resolution,
+                       bucket_start_for(row["timestamp"], resolution))
+                bucket = buckets.get(key)
+                if bucket is None:
+                    buckets[key] = {
+                        "stream_id": key[0],
+                        "resolution": key[1],
+                        "bucket_start": key[2],
+                        "last_timestamp": row["timestamp"],
+                        "num_points": 1,
+                        "sum_viewers": row["viewer_count"],
+                        "min_viewers": row["viewer_count"],
+                        "max_viewers": row["viewer_count"],
+                        "first_game_name": row["game_name"],
+                        "game_name": row["game_name"],
+                        "first_stream_title": row["stream_title"],
+                        "stream_title": row["stream_title"],
+                        "game_changes": 0,
+                        "title_changes": 0
+                    }
+                    continue
+                bucket["last_timestamp"] = row["timestamp"]
+                bucket["num_points"] += 1
+                bucket["sum_viewers"] += row["viewer_count"]
+                bucket["min_viewers"] = min(bucket["min_viewers"],
+                                            row["viewer_count"])
+                bucket["max_viewers"] = max(bucket["max_viewers"],
+                                            row["viewer_count"])
+                if row["game_name"] != bucket["game_name"]:
+                    bucket["game_changes"] += 1
+                    bucket["game_name"] = row["game_name"]
+                if row["stream_title"] != bucket["stream_title"]:
+                    bucket["title_changes"] += 1
+                    bucket["stream_title"] = row["stream_title"]
+
+        if not buckets:
+            return
+
+        # Merge into existing buckets; a change between the stored last
+        # point and the first new point counts as one more change.
+        table = cls.__table__
+        stmt = pg_insert(table).values(list(buckets.values()))
+        excluded = stmt.excluded
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.stream_id,
+                            table.c.resolution,
+                            table.c.bucket_start],
+            set_={
+                "last_timestamp": excluded.last_timestamp,
+                "num_points": table.c.num_points + excluded.num_points,
+                "sum_viewers": table.c.sum_viewers + excluded.sum_viewers,
+                "min_viewers": func.least(table.c.min_viewers,
+                                          excluded.min_viewers),
+                "max_viewers": func.greatest(table.c.max_viewers,
+                                             excluded.max_viewers),
+                "game_name": excluded.game_name,
+                "stream_title": excluded.stream_title,
+                "game_changes": (table.c.game_changes +
+                                 excluded.game_changes +
+                                 case([(table.c.game_name !=
+                                           excluded.first_game_name, 1)],
+                                         else_=0)),
+                "title_changes": (table.c.title_changes +
+                                  excluded.title_changes +
+                                  case([(table.c.stream_title !=
+                                            excluded.first_stream_title, 1)],
+                                          else_=0))
+            }
+        )
+        connection.execute(stmt)
+
+    @classmethod
+    def rebuild_for_session(cls, stream_id):
+        """Recomputes a session's rollups from its raw data points."""
+
+        cls.query.filter_by(stream_id=stream_id).delete()
+        data_points = StreamDatum.query.filter_by(stream_id=stream_id) \
+            .order_by(StreamDatum.timestamp).all()
+        rows = [{"timestamp": data_point.timestamp,
+                 "stream_id": data_point.stream_id,
+                 "game_name": data_point.game_name,
+                 "stream_title": data_point.stream_title,
+                 "viewer_count": data_point.viewer_count}
+                for data_point in data_points]
+        cls.update_from_rows(db.session, rows)
+        db.session.commit()
+
+    @classmethod
+    def get_session_rollups(cls, stream_id, resolution):
+        """Gets a session's rollups for resolution seconds, oldest first.
+        Rebuilds them from raw data when they don't account for every data
+        point, e.g. for sessions recorded, or live, before rollups."""
+
+        # Counted first, so points written meanwhile only make the
+        # rollups look more complete.
+        num_data_points = StreamDatum.query.filter_by(stream_id=stream_id) \
+            .count()
+        rollups = cls.query.filter_by(stream_id=stream_id,
+                                      resolution=resolution) \
+            .order_by(cls.bucket_start).all()
+        if sum(rollup.num_points for rollup in rollups) < num_data_points:
+            cls.rebuild_for_session(stream_id)
+            rollups = cls.query.filter_by(stream_id=stream_id,
+                                          resolution=resolution) \
+                .order_by(cls.bucket_start).all()
+        return rollups
+
 
 class TwitchClip(db.Model):
     """Clips auto-generated for Tweets."""
@@ -507,18 +885,14 @@ class TwitchClip(db.Model):
         return serialized
 
     @classmethod
-    def save_twitch_clip(cls, slug, user_id):
-        """Saves Clip to db using a given slug and user id."""
-        user = User.get_user_from_id(user_id)
+    def save_twitch_clip(cls, slug, user_id, stream_id=None):
+        """Saves Clip to db using a given slug and user id.
+        The clip goes to stream_id if given, else the user's current open
+        session, or else their most recent session."""
 
-        # First try to get the current open session.
-        current_session = StreamSession.get_user_current_session(user)
-        # If one doesn't exist, fall back to most recent session.
-        if current_session is None:
-            last_session = user.sessions[-1]
-            stream_id = last_session.stream_id
-        else:
-            stream_id = current_session.stream_id
+        if stream_id is None:
+            stream_id = StreamSession.get_user_latest_session(user_id) \
+                .stream_id
 
         new_clip = TwitchClip(slug=slug, stream_id=stream_id)
         db.session.add(new_clip)
@@ -551,6 +925,230 @@ class StreamSessionUserFeedback(db.Model):
             .format(self.feedback_id, self.stream_id)
 
 
+class WorkerLease(db.Model):
+    """Heartbeat lease held by a running worker process."""
+
+    __tablename__ = "worker_leases"
+
+    worker_id = db.Column(db.Text, primary_key=True)
+    heartbeat_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        """Print helpful information."""
+
+        return "<WorkerLease worker_id='{}', heartbeat_at={}>" \
+            .format(self.worker_id, self.heartbeat_at)
+
+    @classmethod
+    def heartbeat(cls, worker_id):
+        """Creates or renews the lease for worker_id."""
+
+        lease = cls.query.get(worker_id)
+        if not lease:
+            lease = cls(worker_id=worker_id)
+            db.session.add(lease)
+        lease.heartbeat_at = datetime.datetime.utcnow()
+        db.session.commit()
+        return lease
+
+    @classmethod
+    def get_live_worker_ids(cls, lease_seconds):
+        """Get the ids of workers that renewed their lease recently."""
+
+        cutoff = datetime.datetime.utcnow() - \
+            datetime.timedelta(seconds=lease_seconds)
+        leases = cls.query.filter(cls.heartbeat_at >= cutoff) \
+            .order_by(cls.worker_id).all()
+        return [lease.worker_id for lease in leases]
+
+    @classmethod
+    def release(cls, worker_id):
+        """Removes the lease so other workers take over right away."""
+
+        cls.query.filter_by(worker_id=worker_id).delete()
+        db.session.commit()
+
+    @classmethod
+    def remove_expired(cls, lease_seconds):
+        """Removes leases that haven't been renewed in lease_seconds."""
+
+        cutoff = datetime.datetime.utcnow() - \
+            datetime.timedelta(seconds=lease_seconds)
+        cls.query.filter(cls.heartbeat_at < cutoff) \
+            .delete(synchronize_session=False)
+        db.session.commit()
+
+
+class FailureCount(db.Model):
+    """Count of consecutive failures for a key, shared between processes
+    (see failure_counters.PostgresCounter)."""
+
+    __tablename__ = "failure_counts"
+
+    counter = db.Column(db.Text, primary_key=True)
+    key = db.Column(db.Text, primary_key=True)
+    count = db.Column(db.Integer, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        """Print helpful information."""
+
+        return "<FailureCount counter='{}', key='{}', count={}>" \
+            .format(self.counter, self.key, self.count)
+
+    @classmethod
+    def increment(cls, counter, key, amount=1):
+        """Atomically adds amount to a count. Returns the new count."""
+
+        now = datetime.datetime.utcnow()
+        table = cls.__table__
+        statement = pg_insert(table).values(counter=counter,
+                                            key=str(key),
+                                            count=amount,
+                                            updated_at=now)
+        statement = statement.on_conflict_do_update(
+            index_elements=["counter", "key"],
+            set_={"count": table.c.count + amount, "updated_at": now}
+        ).returning(table.c.count)
+
+        with db.engine.begin() as connection:
+            return connection.execute(statement).scalar()
+
+    @classmethod
+    def get_count(cls, counter, key):
+        """Gets a count; counts that were never incremented are 0."""
+
+        table = cls.__table__
+        count = db.session.query(table.c.count).filter(
+            table.c.counter == counter,
+            table.c.key == str(key)
+        ).scalar()
+        return count or 0
+
+    @classmethod
+    def reset(cls, counter, keys):
+        """Sets the counts for keys back to 0."""
+
+        table = cls.__table__
+        with db.engine.begin() as connection:
+            connection.execute(table.delete().where(
+                (table.c.counter == counter) &
+                table.c.key.in_([str(key) for key in keys])
+            ))
+
+
+class TweetOutbox(db.Model):
+    """Rendered tweet waiting to be posted by a publisher worker."""
+
+    __tablename__ = "tweet_outbox"
+
+    outbox_id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer,
+                        db.ForeignKey("users.user_id"),
+                        nullable=False)
+    contents = db.Column(db.Text, nullable=False)
+    clip_id = db.Column(db.Integer, db.ForeignKey("twitch_clips.clip_id"))
+    # Enqueueing the same key twice only stores the first tweet.
+    idempotency_key = db.Column(db.Text, nullable=False, unique=True)
+    # pending, sending, sent or failed
+    status = db.Column(db.Text, nullable=False, default="pending")
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False)
+    claimed_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False)
+    tweet_id = db.Column(db.Integer, db.ForeignKey("sent_tweets.tweet_id"))
+
+    def __repr__(self):
+        """Print helpful information."""
+
+        return "<TweetOutbox outbox_id={}, user_id={}, status='{}'>" \
+            .format(self.outbox_id, self.user_id, self.status)
+
+    @classmethod
+    def enqueue(cls, user_id, contents, clip_id=None, idempotency_key=None):
+        """Adds a tweet to the outbox. Returns False if a tweet with the
+        same idempotency_key was already queued."""
+
+        now = datetime.datetime.utcnow()
+        if idempotency_key is None:
+            idempotency_key = uuid.uuid4().hex
+
+        statement = pg_insert(cls.__table__).values(
+            user_id=user_id,
+            contents=contents,
+            clip_id=clip_id,
+            idempotency_key=idempotency_key,
+            status="pending",
+            attempts=0,
+            next_attempt_at=now,
+            created_at=now
+        ).on_conflict_do_nothing(index_elements=["idempotency_key"])
+
+        result = db.session.execute(statement)
+        db.session.commit()
+        return result.rowcount == 1
+
+    @classmethod
+    def claim_due(cls, limit, lease_seconds):
+        """Claims up to limit tweets that are due to be sent.
+
+        Rows locked by another publisher are skipped, so any number of
+        publishers can drain the outbox at once. Tweets left in sending by
+        a publisher that died are claimed again once lease_seconds pass."""
+
+        now = datetime.datetime.utcnow()
+        expired = now - datetime.timedelta(seconds=lease_seconds)
+        items = cls.query.filter(
+            ((cls.status == "pending") & (cls.next_attempt_at <= now)) |
+            ((cls.status == "sending") & (cls.claimed_at < expired))
+        ).order_by(cls.next_attempt_at) \
+            .limit(limit) \
+            .with_for_update(skip_locked=True) \
+            .all()
+
+        for item in items:
+            item.status = "sending"
+            item.claimed_at = now
+            item.attempts += 1
+        db.session.commit()
+        return items
+
+    def mark_sent(self, sent_tweet):
+        """Records that the tweet was posted."""
+
+        self.status = "sent"
+        self.tweet_id = sent_tweet.tweet_id
+        self.last_error = None
+        db.session.commit()
+
+    def mark_failed(self, error, retry_seconds=None):
+        """Schedules another attempt in retry_seconds, or gives up when
+        retry_seconds is None."""
+
+        self.last_error = error
+        if retry_seconds is None:
+            self.status = "failed"
+        else:
+            self.status = "pending"
+            self.next_attempt_at = datetime.datetime.utcnow() + \
+                datetime.timedelta(seconds=retry_seconds)
+        db.session.commit()
+
+    def defer(self, seconds):
+        """Puts the tweet back without counting an attempt."""
+
+        self.status = "pending"
+        self.attempts -= 1
+        self.next_attempt_at = datetime.datetime.utcnow() + \
+            datetime.timedelta(seconds=seconds)
+        db.session.commit()
+
+
+db.Index('ix_tweet_outbox_due',
+         TweetOutbox.status, TweetOutbox.next_attempt_at)
+
+
 ###############################################################################
 # HELPER FUNCTIONS
 ###############################################################################
@@ -561,6 +1159,13 @@ def dump_datetime(datetime):
     return int(datetime.replace(tzinfo=timezone.utc).timestamp())
 
 
+def bucket_start_for(timestamp, resolution):
+    """Floor a datetime to the start of its resolution-second bucket."""
+
+    seconds = int(timestamp.replace(tzinfo=timezone.utc).timestamp())
+    return datetime.datetime.utcfromtimestamp(seconds - seconds % resolution)
+
+
 def connect_to_db(app, db_uri="postgresql:///yattk", show_sql=True):
     """Connect the database to our Flask app."""
 
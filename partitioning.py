@@ -0,0 +1,60 @@
+"""Consistent-hash partitioning of users across worker processes."""
+
+import bisect
+import hashlib
+
+
+def hash_key(key):
+    """Return a stable integer hash for key."""
+
+    digest = hashlib.md5(str(key).encode("utf-8")).hexdigest()
+    return int(digest[:16], 16)
+
+
+class HashRing(object):
+    """Consistent-hash ring mapping keys to nodes.
+    Adding or removing a node only moves the keys that node owned."""
+
+    def __init__(self, nodes, replicas=64):
+        self.nodes = sorted(set(nodes))
+        self._ring = []
+        for node in self.nodes:
+            for replica in range(replicas):
+                self._ring.append((hash_key("{}#{}".format(node, replica)),
+                                   node))
+        self._ring.sort()
+        self._hashes = [point for point, _ in self._ring]
+
+    def node_for(self, key):
+        """Return the node that owns key, or None if the ring is empty."""
+
+        if not self._ring:
+            return None
+        index = bisect.bisect(self._hashes, hash_key(key)) % len(self._ring)
+        return self._ring[index][1]
+
+
+class Partition(object):
+    """The set of users owned by this process.
+    Until a ring is set (single-process mode), every user is owned."""
+
+    def __init__(self):
+        self.worker_id = None
+        self.ring = None
+
+    def owns(self, user_id):
+        """Return True if this process should run work for user_id."""
+
+        if self.ring is None:
+            return True
+        return self.ring.node_for(int(user_id)) == self.worker_id
+
+    def update(self, worker_ids):
+        """Rebuild the ring from the live workers.
+        Returns True if ownership changed."""
+
+        worker_ids = sorted(set(worker_ids) | {self.worker_id})
+        if self.ring is not None and self.ring.nodes == worker_ids:
+            return False
+        self.ring = HashRing(worker_ids)
+        return True
@@ -0,0 +1,192 @@
+"""Sharded in-memory scheduling engine for recurring per-user tasks.
+
+Rather than storing one APScheduler job per user per task, a small fixed
+set of tick jobs (one per shard) pops the users that are due from an
+in-memory heap and hands their work to a pool of task threads.
+
+Tasks scheduled together, e.g. after a restart or when many streams go live
+at once, are spread out: each user gets a deterministic slot within a
+window, plus optional random jitter, so their runs don't share a tick."""
+
+import os
+import time
+import zlib
+import heapq
+import random
+import threading
+
+SHARD_COUNT = int(os.environ.get("SCHEDULER_SHARDS", 4))
+TICK_SECONDS = int(os.environ.get("SCHEDULER_TICK_SECONDS", 5))
+# Width of the window a task's first run is spread over, capped at the
+# task's interval. 0 runs tasks exactly when asked.
+SPREAD_SECONDS = int(os.environ.get("SCHEDULER_SPREAD_SECONDS", 300))
+# Up to this many random seconds are added on top of the slot.
+JITTER_SECONDS = int(os.environ.get("SCHEDULER_JITTER_SECONDS", 0))
+# Threads that run due tasks, so a slow user doesn't hold up a shard's tick.
+TASK_WORKERS = int(os.environ.get("SCHEDULER_TASK_WORKERS", 8))
+
+
+class Shard(object):
+    """Due-time heap and task entries for a slice of users."""
+
+    def __init__(self):
+        # Heap of (due_at, task_type, user_id). Entries that were
+        # rescheduled or removed are skipped when popped.
+        self.heap = []
+        # (task_type, user_id) -> (due_at, interval)
+        self.entries = {}
+        self.lock = threading.Lock()
+
+
+class SchedulingEngine(object):
+    """Schedules recurring tasks for users across hash-sharded heaps."""
+
+    def __init__(self, shard_count=SHARD_COUNT, clock=time.time, spread=0,
+                 jitter=0):
+        self.shard_count = shard_count
+        self.shards = [Shard() for _ in range(shard_count)]
+        self.clock = clock
+        self.spread = spread
+        self.jitter = jitter
+
+    def shard_index(self, user_id):
+        """Return the shard that owns user_id."""
+
+        return int(user_id) % self.shard_count
+
+    @staticmethod
+    def slot(task_type, user_id, window):
+        """Return the user's offset, in seconds, within a window. The same
+        for every process and restart."""
+
+        key = "{}:{}".format(task_type, int(user_id)).encode("utf-8")
+        return zlib.crc32(key) % window
+
+    def spread_run(self, task_type, user_id, earliest, window):
+        """Return the first time at or after earliest that falls on the
+        user's slot in a repeating window."""
+
+        offset = self.slot(task_type, user_id, window)
+        return earliest + (offset - earliest) % window
+
+    def schedule(self, task_type, user_id, interval, first_run=None,
+                 spread=None):
+        """Run task_type for user_id every interval seconds.
+        Replaces any existing schedule for the same task and user.
+
+        The first run is moved to the user's slot within spread seconds
+        (the engine's spread by default) after first_run, then jittered."""
+
+        user_id = int(user_id)
+        if first_run is None:
+            first_run = self.clock() + interval
+
+        window = min(self.spread if spread is None else spread, interval)
+        if window > 0:
+            first_run = self.spread_run(task_type, user_id, first_run,
+                                        int(window))
+        if self.jitter:
+            first_run += random.uniform(0, min(self.jitter, interval))
+
+        shard = self.shards[self.shard_index(user_id)]
+        with shard.lock:
+            shard.entries[(task_type, user_id)] = (first_run, interval)
+            heapq.heappush(shard.heap, (first_run, task_type, user_id))
+
+    def unschedule(self, task_type, user_id):
+        """Stop running task_type for user_id. Returns True if it was
+        scheduled."""
+
+        user_id = int(user_id)
+        shard = self.shards[self.shard_index(user_id)]
+        with shard.lock:
+            return shard.entries.pop((task_type, user_id), None) is not None
+
+    def is_scheduled(self, task_type, user_id):
+        """Return True if task_type is scheduled for user_id."""
+
+        user_id = int(user_id)
+        shard = self.shards[self.shard_index(user_id)]
+        with shard.lock:
+            return (task_type, user_id) in shard.entries
+
+    def scheduled_user_ids(self, task_type):
+        """Return the set of user ids with task_type scheduled."""
+
+        user_ids = set()
+        for shard in self.shards:
+            with shard.lock:
+                user_ids.update(user_id
+                                for (entry_type, user_id) in shard.entries
+                                if entry_type == task_type)
+        return user_ids
+
+    @staticmethod
+    def run_slot(run_at, interval):
+        """Return the number of the interval-long slot run_at falls in."""
+
+        return int(run_at // interval)
+
+    def pop_due(self, shard_index, now=None):
+        """Collect the tasks that are due in a shard and reschedule them.
+        Returns a dictionary of task type to list of user ids."""
+
+        return {task_type: [user_id for user_id, _ in runs]
+                for task_type, runs in self.pop_due_runs(shard_index,
+                                                         now).items()}
+
+    def pop_due_runs(self, shard_index, now=None):
+        """Like pop_due, but lists (user_id, run_slot) for each run, where
+        run_slot numbers the interval the run was due in."""
+
+        if now is None:
+            now = self.clock()
+
+        shard = self.shards[shard_index]
+        due = {}
+        with shard.lock:
+            while shard.heap and shard.heap[0][0] <= now:
+                due_at, task_type, user_id = heapq.heappop(shard.heap)
+                entry = shard.entries.get((task_type, user_id))
+                # Skip heap entries left behind by unschedule/reschedule.
+                if entry is None or entry[0] != due_at:
+                    continue
+
+                interval = entry[1]
+                due.setdefault(task_type, []).append(
+                    (user_id, self.run_slot(due_at, interval)))
+
+                # Keep the user's phase; skip runs missed while down.
+                next_due = due_at + interval
+                if next_due <= now:
+                    missed = (now - due_at) // interval
+                    next_due = due_at + (missed + 1) * interval
+                shard.entries[(task_type, user_id)] = (next_due, interval)
+                heapq.heappush(shard.heap, (next_due, task_type, user_id))
+
+        return due
+
+    def load_by_second(self, horizon=60, now=None):
+        """Return how many task runs are due in each of the next horizon
+        seconds. Overdue runs count towards the first second."""
+
+        if now is None:
+            now = self.clock()
+
+        load = [0] * horizon
+        end = now + horizon
+        for shard in self.shards:
+            with shard.lock:
+                entries = list(shard.entries.values())
+            for due_at, interval in entries:
+                if due_at < now:
+                    # Runs once on the next tick, then keeps its phase.
+                    load[0] += 1
+                    due_at += ((now - due_at) // interval + 1) * interval
+                while due_at < end:
+                    load[int(due_at - now)] += 1
+                    due_at += interval
+        return load
+
+    def __len__(self):
+        return sum(len(shard.entries) for shard in self.shards)
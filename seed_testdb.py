@@ -15,15 +15,20 @@ def sample_data():
     BaseTemplate.query.delete()
     Template.query.delete()
     TwitchClip.query.delete()
+    StreamDataRollup.query.delete()
     StreamDatum.query.delete()
     StreamSession.query.delete()
+    TweetOutbox.query.delete()
+    FailureCount.query.delete()
     SentTweet.query.delete()
     User.query.delete()
     db.session.commit()
 
     # Execute raw SQL to import data from csv's in respective tables.
     project_path = os.getcwd()
-    fill_users = ("COPY users FROM '" + project_path +
+    fill_users = ("COPY users (user_id, email, twitch_displayname, "
+                  "twitch_username, twitch_id, twitter_id, tweet_interval, "
+                  "is_tweeting) FROM '" + project_path +
                   "/sql/users.csv' DELIMITER ','")
     fill_twitch_clips = ("COPY twitch_clips FROM '" +
                          project_path + "/sql/twitch_clips.csv'")
@@ -37,7 +42,8 @@ def sample_data():
                         project_path + "/sql/sent_tweets.csv'")
     fill_base_templates = ("COPY base_templates FROM '" +
                            project_path + "/sql/base_templates.csv'")
-    fill_twitch_tokens = ("COPY twitch_tokens FROM '" +
+    fill_twitch_tokens = ("COPY twitch_tokens (token_id, user_id, "
+                          "access_token, refresh_token, expires_in) FROM '" +
                           project_path + "/sql/twitch_tokens.csv'")
 
     db.session.execute(fill_base_templates)
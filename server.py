@@ -2,7 +2,6 @@
 
 import os
 import datetime
-from threading import Thread
 import flask
 from flask import (Flask, flash, get_template_attribute,
                    render_template, redirect,
@@ -13,12 +12,15 @@ from flask.json import jsonify
 from flask_debugtoolbar import DebugToolbarExtension
 import tweepy
 from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from apscheduler.jobstores.memory import MemoryJobStore
 from model import *
 # FOR APSCHEDULER
 import apscheduler_handlers as handler
 import template_helpers as temp_help
 import twitch_helpers
 import api_helpers
+from webhook_queue import WebhookQueue
+import user_loader
 
 app = Flask(__name__)
 
@@ -330,7 +332,8 @@ def get_stream_sessions_for_user_react():
 
 @app.route("/api/streams/data/<int:stream_id>")
 def get_stream_session_data_react(stream_id):
-    """Retrives data points for a given stream session. """
+    """Retrives data points for a given stream session.
+    Accepts an optional resolution of raw, 5m or 1h."""
 
     # Restrict access to logged in users.
     if not current_user.is_authenticated:
@@ -339,7 +342,19 @@ def get_stream_session_data_react(stream_id):
                 400,
                 {'ContentType': 'application/json'})
 
-    payload = api_helpers.create_streamdata_payload(current_user, stream_id)
+    # Optional; "5m" or "1h" returns aggregated points.
+    resolution = request.args.get("resolution")
+    if resolution == "raw":
+        resolution = None
+    if resolution and resolution not in StreamDataRollup.RESOLUTIONS:
+        error_message = "Bad request."
+        return (flask.json.dumps({"error": error_message}),
+                400,
+                {'ContentType': 'application/json'})
+
+    payload = api_helpers.create_streamdata_payload(current_user,
+                                                    stream_id,
+                                                    resolution)
     if not payload:
         error_message = "No data exists."
         return (flask.json.dumps({"error": error_message}),
@@ -387,24 +402,28 @@ def get_sent_tweets_for_user_react():
 
         started_at = datetime.datetime.utcfromtimestamp(started_at_ts)
         ended_at = datetime.datetime.utcfromtimestamp(ended_at_ts)
+
+        # Keyset pagination; cursor comes from the previous page's "next".
+        limit = int(request.args.get("limit",
+                                     api_helpers.SENT_TWEETS_PAGE_SIZE))
+        after = request.args.get("after")
+        if after:
+            after = api_helpers.decode_tweet_cursor(after)
     except ValueError:
         error_message = "Bad request."
         return (flask.json.dumps({"error": error_message}),
                 400,
                 {'ContentType': 'application/json'})
 
-    tweets = current_user.sent_tweets.filter(SentTweet.created_at.between(
-                  started_at, ended_at)).all()
-
-    print(f"STARTED AT: {started_at}")
-    print(f"ENDED AT: {ended_at}")
-
-    print(f"\nFOUND TWEETS: {tweets}")
+    # Sets a maximum page size
+    limit = max(1, min(limit, api_helpers.SENT_TWEETS_MAX_PAGE_SIZE))
 
     return(jsonify(api_helpers.create_senttweets_payload(
                    user=current_user,
                    started=started_at,
-                   ended=ended_at)))
+                   ended=ended_at,
+                   after=after,
+                   limit=limit)))
 
 
 @app.route("/api/hooks/streamstatus/<int:user_id>", methods=["POST"])
@@ -421,11 +440,16 @@ def test_webhook(user_id):
     body_json = request.get_json()
     body_raw = request.get_data()
 
-    t = Thread(target=process_webhook_request,
-               args=(user_id, body_json, body_raw, signature))
-    t.start()
+    # Only signed notifications are queued, so forged ones can't mark a
+    # real one as a duplicate.
+    if not twitch_helpers.is_auth_signature(body_raw, signature):
+        return ('', 403)
 
-    return ('', 200)
+    # Full queue: Twitch retries notifications that aren't accepted.
+    if not webhook_queue.submit(user_id, body_json, body_raw, signature):
+        return ('', 503)
+
+    return ('', 202)
 
 
 def process_webhook_request(user_id, body_json, body_raw, signature):
@@ -453,6 +477,23 @@ def process_webhook_request(user_id, body_json, body_raw, signature):
                 handler.stop_tweeting(user_id)
 
 
+# Processes webhook notifications on a fixed pool of threads.
+webhook_queue = WebhookQueue(process_webhook_request)
+
+
+@app.route("/api/hooks/stats")
+def webhook_stats():
+    """Returns webhook queue depth and processing latency."""
+
+    if not current_user.is_authenticated:
+        error_message = "You must be logged in to access."
+        return (flask.json.dumps({"error": error_message}),
+                400,
+                {'ContentType': 'application/json'})
+
+    return jsonify(webhook_queue.stats())
+
+
 @app.route("/api/hooks/streamstatus/<int:user_id>", methods=["GET"])
 def test_webhook_get(user_id):
     """Echos back challenge for subscribing."""
@@ -485,21 +526,20 @@ def process_user_registration():
     print(user_twitch_displayname)
     print(user_twitch_username)
 
-    new_user = User(email=user_twitch_email,
-                    twitch_id=user_twitch_id,
-                    twitch_username=user_twitch_username,
-                    twitch_displayname=user_twitch_displayname)
-
-    db.session.add(new_user)
-    db.session.commit()
+    # Registering twice, e.g. from two tabs, creates one user.
+    new_user, created = User.register_twitch_user(user_twitch_id,
+                                                  user_twitch_email,
+                                                  user_twitch_username,
+                                                  user_twitch_displayname)
 
-    # Add base templates for user.
-    temp_help.add_basic_templates(new_user)
+    if created:
+        # Add base templates for user.
+        temp_help.add_basic_templates(new_user)
 
-    # Subscribes to webhooks for user.
-    twitch_helpers.subscribe_to_user_stream_events(new_user)
-    # Starts job to renew subscription every 9 days.
-    handler.renew_webhook(new_user.user_id)
+        # Subscribes to webhooks for user.
+        twitch_helpers.subscribe_to_user_stream_events(new_user)
+        # Starts job to renew subscription every 9 days.
+        handler.renew_webhook(new_user.user_id)
 
     # Login new user
     login_user(new_user)
@@ -567,17 +607,17 @@ def authorize_twitch(resp):
         session["current_twitch_user"] = current_twitch_user.data["data"][0]
         current_twitch_user_id = session["current_twitch_user"]["id"]
 
-        # Get all Twitch IDs in db
-        twitch_ids = {user.twitch_id for user in User.query.all()}
+        # Look up the user by Twitch ID (unique, so indexed).
+        user = User.get_user_from_twitch_id(current_twitch_user_id)
 
         # If the user's Twitch ID is not found in db, create a user.
-        if current_twitch_user_id not in twitch_ids:
+        if user is None:
             return redirect("/register-twitch")
         # Else, login the user and overwrite current access token info in db.
         # And renew webhook subscription.
         else:
             print("Twitch ID recognized. Logging you in.")
-            login_user(User.get_user_from_twitch_id(current_twitch_user_id))
+            login_user(user)
             current_user.update_twitch_access_token(
                 access_token,
                 refresh_token,
@@ -674,8 +714,9 @@ def twitch_tokengetter():
 def load_user(user_id):
     """Loads user from db. user_id must be unicode."""
 
-    print("Found user {}".format(User.query.get(user_id)))
-    return User.query.get(user_id)
+    user = user_loader.load_user(user_id)
+    print("Found user {}".format(user))
+    return user
 
 
 def add_template_to_db(user, temp_contents):
@@ -698,7 +739,9 @@ if __name__ == "__main__":
         """Configuration for APScheduler."""
 
         SCHEDULER_JOBSTORES = {
-            'default': SQLAlchemyJobStore(url='postgresql:///yattk_jobstore')
+            'default': SQLAlchemyJobStore(url='postgresql:///yattk_jobstore'),
+            # Short-lived jobs, e.g. clip confirmations.
+            'memory': MemoryJobStore()
         }
 
         SCHEDULER_API_ENABLED = False
@@ -714,6 +757,8 @@ if __name__ == "__main__":
     # Enable scheduler
     scheduler.init_app(app)
     scheduler.start()
+    # Load per-user tasks and start the engine's tick jobs
+    handler.start_scheduling_engine()
 
     # Run the app
     app.run(port=7000, threaded=True, host='0.0.0.0')
@@ -0,0 +1,50 @@
+-- Brings a database created by an earlier version up to date.
+-- db.create_all() adds new tables but not new indexes or columns on
+-- existing tables. Safe to run more than once:
+--
+--     psql yattk -f sql/upgrade_existing_db.sql
+
+-- Counting and reading a session's data points (stream_data rollups).
+CREATE INDEX IF NOT EXISTS ix_stream_data_stream_timestamp
+    ON stream_data (stream_id, timestamp);
+
+-- Keyset pagination of a user's sent tweets (create_senttweets_payload).
+CREATE INDEX IF NOT EXISTS ix_sent_tweets_user_created
+    ON sent_tweets (user_id, created_at, tweet_id);
+
+-- Users waiting for their stream to show up (User.get_users_to_poll).
+ALTER TABLE users ADD COLUMN IF NOT EXISTS fetching_since timestamp;
+
+-- Twitch token expiry and refresh backoff (refresh_expiring_twitch_tokens).
+ALTER TABLE twitch_tokens ADD COLUMN IF NOT EXISTS expires_at timestamp;
+ALTER TABLE twitch_tokens
+    ADD COLUMN IF NOT EXISTS refresh_failures integer NOT NULL DEFAULT 0;
+ALTER TABLE twitch_tokens ADD COLUMN IF NOT EXISTS next_refresh_at timestamp;
+
+-- One open session per Twitch stream (save_stream_session upserts on
+-- ux_stream_sessions_open). Close all but the newest open session for each
+-- Twitch stream first, at its last data point, so the unique index can be
+-- built. The lock keeps a running app from opening another one meanwhile.
+BEGIN;
+LOCK TABLE stream_sessions IN SHARE ROW EXCLUSIVE MODE;
+
+UPDATE stream_sessions AS s
+SET ended_at = COALESCE(
+    (SELECT max(d.timestamp) FROM stream_data AS d
+     WHERE d.stream_id = s.stream_id),
+    s.started_at)
+WHERE s.ended_at IS NULL
+  AND EXISTS (SELECT 1 FROM stream_sessions AS newer
+              WHERE newer.twitch_session_id = s.twitch_session_id
+                AND newer.ended_at IS NULL
+                AND newer.stream_id > s.stream_id);
+
+CREATE UNIQUE INDEX IF NOT EXISTS ux_stream_sessions_open
+    ON stream_sessions (twitch_session_id) WHERE ended_at IS NULL;
+COMMIT;
+
+-- Lookups of a user's open sessions, and of sessions by Twitch stream.
+CREATE INDEX IF NOT EXISTS ix_stream_sessions_user_ended
+    ON stream_sessions (user_id, ended_at);
+CREATE INDEX IF NOT EXISTS ix_stream_sessions_twitch_session
+    ON stream_sessions (twitch_session_id);
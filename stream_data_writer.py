@@ -0,0 +1,161 @@
+"""Write-behind buffer for stream data points."""
+
+import queue
+import atexit
+import threading
+from sqlalchemy import exc
+from model import db, StreamDatum, StreamDataRollup
+
+
+class StreamDataWriter(object):
+    """Collects StreamDatum rows from polling jobs and inserts them with
+    multi-row INSERTs once max_rows are waiting or every flush_seconds.
+    Rollups for the rows are updated in the same transaction.
+
+    The queue is bounded: when it's full, the caller flushes inline before
+    adding its row, which slows producers down instead of dropping data.
+    When a batch fails, its rows are retried one at a time so a bad row
+    can't hold up the rest."""
+
+    def __init__(self, max_rows=500, flush_seconds=5, max_queue=10000,
+                 max_attempts=5):
+        self.max_rows = max_rows
+        self.flush_seconds = flush_seconds
+        self.max_attempts = max_attempts
+        self.app = None
+        self.rows_written = 0
+        self.rows_dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self, app):
+        """Start the background flush thread for app."""
+
+        self.app = app
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name="stream-data-writer",
+                                        daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Stop the flush thread and write everything still buffered."""
+
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout=30)
+            self._thread = None
+        self.flush()
+
+    def add(self, row):
+        """Buffer a row of stream_data column values."""
+
+        try:
+            self._queue.put_nowait((row, 0))
+        except queue.Full:
+            # Backpressure: make room by writing the buffer ourselves.
+            # If the db is down too, give up after a while (queue.Full).
+            self.flush()
+            self._queue.put((row, 0), timeout=self.flush_seconds)
+
+        if self._queue.qsize() >= self.max_rows:
+            self._wakeup.set()
+
+    def flush(self):
+        """Insert every buffered row. Returns the number of rows written."""
+
+        with self._flush_lock:
+            items = []
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if not items:
+                return 0
+
+            rows = [row for row, _ in items]
+            try:
+                self._write(rows)
+            except Exception as e:
+                print("Failed to write {} stream data points: {}. "
+                      "Writing them one at a time.".format(len(rows), e))
+                return self._write_each(items)
+
+            self.rows_written += len(rows)
+            return len(rows)
+
+    def pending(self):
+        """Return the number of buffered rows."""
+
+        return self._queue.qsize()
+
+    def _write(self, rows):
+        """Insert rows and update their rollups in one transaction."""
+
+        table = StreamDatum.__table__
+        # Use the engine directly: pushing an app context here would
+        # remove the caller's scoped session when it's popped, e.g.
+        # in the middle of a polling job's inline flush.
+        with db.get_engine(self.app).begin() as connection:
+            for start in range(0, len(rows), self.max_rows):
+                chunk = rows[start:start + self.max_rows]
+                connection.execute(table.insert().values(chunk))
+            StreamDataRollup.update_from_rows(connection, rows)
+
+    def _write_each(self, items):
+        """Insert (row, attempts) items one at a time after their batch
+        failed. Rows the db rejects, e.g. a missing game name or a title
+        too long for its column, are dropped. If the db can't be reached,
+        the rest are requeued. Returns the number of rows written."""
+
+        written = 0
+        for index, (row, attempts) in enumerate(items):
+            try:
+                self._write([row])
+            except (exc.OperationalError, exc.InterfaceError) as e:
+                print("Stream data db unavailable: {}".format(e))
+                self._requeue(items[index:])
+                break
+            except Exception as e:
+                print("Dropped stream data point {}: {}".format(row, e))
+                self.rows_dropped += 1
+                continue
+            written += 1
+
+        self.rows_written += written
+        return written
+
+    def _requeue(self, items):
+        """Put (row, attempts) items back to retry on the next flush, as
+        room allows. Rows already tried max_attempts times are dropped."""
+
+        for index, (row, attempts) in enumerate(items):
+            if attempts + 1 >= self.max_attempts:
+                print("Dropped stream data point after {} attempts: {}"
+                      .format(attempts + 1, row))
+                self.rows_dropped += 1
+                continue
+            try:
+                self._queue.put_nowait((row, attempts + 1))
+            except queue.Full:
+                print("Stream data buffer full; dropped {} data points."
+                      .format(len(items) - index))
+                self.rows_dropped += len(items) - index
+                return
+
+    def _run(self):
+        """Flush on the size or time threshold until stopped."""
+
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_seconds)
+            self._wakeup.clear()
+            self.flush()
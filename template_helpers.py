@@ -2,9 +2,16 @@
 
 import os
 import string
+import hashlib
 import tweepy
+from sqlalchemy import event
 import twitch_helpers as twitch
-from model import db, BaseTemplate, SentTweet, Template, User
+import apscheduler_handlers as ap_handlers
+from cache_helpers import TTLCache
+from twitter_client import TwitterClient
+from tweet_publisher import TweetPublisher
+from model import (db, BaseTemplate, SentTweet, Template, TweetOutbox,
+                   TwitterToken, User)
 
 ###############################################################################
 # Twitter Oauth Requirements
@@ -12,6 +19,11 @@ from model import db, BaseTemplate, SentTweet, Template, User
 TWITTER_CONSUMER_KEY = os.environ["TWITTER_CONSUMER_KEY"]
 TWITTER_CONSUMER_SECRET = os.environ["TWITTER_CONSUMER_SECRET"]
 
+# Authenticated TwitterClient per (user_id, token fingerprint). A token
+# replaced or removed in any process changes the key, so clients for old
+# tokens are never used again and just age out.
+TWITTER_CLIENT_CACHE = TTLCache(maxsize=1000, ttl=60 * 60)
+
 
 def add_basic_templates(user):
     """Add basic templates for user."""
@@ -35,7 +47,131 @@ def replace_nl_with_carriage(content):
     return joined_content
 
 
-def populate_tweet_template(contents, user_id):
+###############################################################################
+# Compiled Templates
+###############################################################################
+# Compiled templates keyed by template_id (or contents for unsaved ones).
+# Each entry stores the hash of the contents it was compiled from.
+COMPILED_TEMPLATE_CACHE = TTLCache(maxsize=20000, ttl=24 * 60 * 60)
+
+
+def compile_template(contents):
+    """Splits template contents into a list of segments.
+    Each segment is (text, None) for literal text or (raw, name) for a
+    placeholder, where raw is kept in case no value is given."""
+
+    segments = []
+    position = 0
+    for match in string.Template.pattern.finditer(contents):
+        if match.start() > position:
+            segments.append((contents[position:match.start()], None))
+        name = match.group("named") or match.group("braced")
+        if name is not None:
+            segments.append((match.group(), name))
+        elif match.group("escaped") is not None:
+            segments.append(("$", None))
+        else:
+            # Invalid placeholders are left as-is, like safe_substitute.
+            segments.append((match.group(), None))
+        position = match.end()
+    if position < len(contents):
+        segments.append((contents[position:], None))
+
+    return segments
+
+
+def get_compiled_template(contents, template_id=None):
+    """Returns the compiled segments for contents, compiling on a miss."""
+
+    content_hash = hashlib.sha1(contents.encode("utf-8")).hexdigest()
+    key = template_id if template_id is not None else content_hash
+
+    entry = COMPILED_TEMPLATE_CACHE.get(key)
+    if entry and entry[0] == content_hash:
+        return entry[1]
+
+    segments = compile_template(contents)
+    COMPILED_TEMPLATE_CACHE.set(key, (content_hash, segments))
+    return segments
+
+
+def render_segments(segments, data):
+    """Fills compiled segments with data; unknown placeholders stay as-is."""
+
+    return "".join(str(data[name]) if name in data else text
+                   for text, name in segments)
+
+
+def render_tweets(contents, contexts, template_id=None):
+    """Renders one template for many contexts, compiling it once.
+    Returns the tweets in the same order as contexts."""
+
+    segments = get_compiled_template(contents, template_id)
+    return [render_segments(segments, data) for data in contexts]
+
+
+def invalidate_compiled_template(template_id):
+    """Drops a template's compiled segments from the cache."""
+
+    COMPILED_TEMPLATE_CACHE.invalidate(template_id)
+
+
+@event.listens_for(Template, "after_insert")
+@event.listens_for(Template, "after_update")
+@event.listens_for(Template, "after_delete")
+def handle_template_change(mapper, connection, template):
+    """Invalidate cached segments whenever a template is added, edited
+    (User.edit_template) or deleted (User.delete_template)."""
+
+    invalidate_compiled_template(template.template_id)
+
+
+def get_twitter_client(user_id):
+    """Gets a cached, authenticated TwitterClient for user's current token.
+    Raises tweepy.TweepError if the user has no Twitter token."""
+
+    # Read the token every time; it's the client that's costly to build.
+    token = TwitterToken.query.filter_by(user_id=user_id).first()
+    if token is None:
+        raise tweepy.TweepError(
+            "User {} has no Twitter token.".format(user_id))
+
+    key = get_twitter_token_key(token)
+    client = TWITTER_CLIENT_CACHE.get(key)
+    if client is None:
+        client = TwitterClient(TWITTER_CONSUMER_KEY,
+                               TWITTER_CONSUMER_SECRET,
+                               token.access_token,
+                               token.access_token_secret)
+        TWITTER_CLIENT_CACHE.set(key, client)
+    return client
+
+
+def get_twitter_token_key(token):
+    """Returns the client cache key for a TwitterToken."""
+
+    secret = "{}:{}".format(token.access_token, token.access_token_secret)
+    fingerprint = hashlib.sha1(secret.encode("utf-8")).hexdigest()
+    return (token.user_id, fingerprint)
+
+
+def invalidate_twitter_client(user_id):
+    """Drops the cached client for user's current token."""
+
+    token = TwitterToken.query.filter_by(user_id=user_id).first()
+    if token is not None:
+        TWITTER_CLIENT_CACHE.invalidate(get_twitter_token_key(token))
+
+
+@event.listens_for(TwitterToken, "after_delete")
+def handle_twitter_token_delete(mapper, connection, token):
+    """Drop a removed token's client right away
+    (User.remove_twitter_access_token)."""
+
+    TWITTER_CLIENT_CACHE.invalidate(get_twitter_token_key(token))
+
+
+def populate_tweet_template(contents, user_id, template_id=None):
     """Inserts data into placeholders."""
     try:
         user = User.get_user_from_id(user_id)
@@ -50,9 +186,8 @@ def populate_tweet_template(contents, user_id):
             return None
 
         print("\n\nData for template.\n{}".format(data_for_template))
-        tweet_template = string.Template(contents)
-        populated_template = tweet_template.safe_substitute(
-            data_for_template)
+        populated_template = render_tweets(contents, [data_for_template],
+                                           template_id)[0]
 
         print("\n\nPopulated template:\n{}".format(populated_template))
 
@@ -66,7 +201,7 @@ def populate_tweet_template(contents, user_id):
 def get_twitch_template_data(user):
     """Creates a dictionary to use for tweet template filler."""
 
-    all_stream_data = twitch.serialize_twitch_stream_data(user)
+    all_stream_data = twitch.get_latest_stream_data(user)
     if all_stream_data:
         stream_template_data = {
             "url": all_stream_data["url"],
@@ -82,44 +217,74 @@ def get_twitch_template_data(user):
     return None
 
 
-def publish_to_twitter(contents, user_id):
-    """Publishes given content to a user's Twitter account."""
+def get_tweet_key(user_id, run_slot):
+    """Returns the idempotency key for a user's scheduled tweet, so runs for
+    the same slot (e.g. on two workers) queue one tweet."""
+
+    return "tweet-{}-{}".format(user_id, run_slot)
+
+
+def publish_to_twitter(contents, user_id, tweet_key=None):
+    """Publishes given content to a user's Twitter account.
+
+    Submits a Twitch Clip first; the tweet is queued by a deferred job once
+    the clip is confirmed or the confirmation deadline passes. A tweet_key
+    that was already used is not tweeted again."""
 
     # If given empty contents
     if not contents:
         return
 
-    # Set up Twitter requirements
-    user = User.get_user_from_id(user_id)
-    token = user.twitter_token
-    access_token = token.access_token
-    access_token_secret = token.access_token_secret
-
-    twitter_auth = tweepy.OAuthHandler(TWITTER_CONSUMER_KEY,
-                                       TWITTER_CONSUMER_SECRET)
-    twitter_auth.set_access_token(access_token, access_token_secret)
-    api = tweepy.API(twitter_auth)
-
-    # Clip id defaults to None.
-    clip_id = None
     # Try to generate a Twitch Clip
-    new_clip, clip_url = twitch.generate_twitch_clip(user_id)
+    clip_slug = twitch.generate_twitch_clip(user_id)
+
+    # If a clip was submitted, tweet once it's confirmed.
+    if clip_slug:
+        ap_handlers.schedule_clip_confirmation(contents, user_id, clip_slug,
+                                               tweet_key=tweet_key)
+        return
+
+    queue_tweet(contents, user_id, idempotency_key=tweet_key)
+
+
+def queue_tweet(contents, user_id, clip_id=None, idempotency_key=None):
+    """Adds a tweet to the outbox for the publisher workers to send.
+    Tweets with an idempotency_key that was already used are dropped."""
+
+    queued = TweetOutbox.enqueue(user_id, contents, clip_id=clip_id,
+                                 idempotency_key=idempotency_key)
+    if queued:
+        tweet_publisher.wake()
+    return queued
+
+
+def send_tweet(item):
+    """Sends a queued tweet to user's Twitter account and stores it.
+    Raises tweepy.TweepError if Twitter doesn't accept it."""
+
+    # Set up Twitter requirements
+    api = get_twitter_client(item.user_id)
 
-    # If new clip is created, append to tweet and save clip id.
-    if new_clip:
-        contents += "\n{}".format(clip_url)
-        clip_id = new_clip.clip_id
     print("\n\nABOUT TO SEND A TWEET!\n\n")
     try:
         # Send Tweet and catch response
-        response = api.update_status(contents)
-        # Store sent tweet data in db
-        SentTweet.store_sent_tweet(response, user_id, clip_id=clip_id)
-        print("TWEET TWEETED.")
-        return
+        response = api.update_status(item.contents)
     except tweepy.TweepError as error:
-        # TODO: Set up better handler for errors.
         print(error.reason)
+        # Token may have been revoked or replaced elsewhere.
+        if error.response is not None and error.response.status_code == 401:
+            invalidate_twitter_client(item.user_id)
+        raise
+
+    # Store sent tweet data in db
+    sent_tweet = SentTweet.store_sent_tweet(response, item.user_id,
+                                            clip_id=item.clip_id)
+    print("TWEET TWEETED.")
+    return sent_tweet
+
+
+# Publishes queued tweets; started with the scheduling engine.
+tweet_publisher = TweetPublisher(send_tweet)
 
 
 if __name__ == "__main__":
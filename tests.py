@@ -2,13 +2,17 @@
 from unittest import TestCase, mock
 from io import StringIO
 import datetime
+import string
 import sqlalchemy
+import tweepy
 import server as s
 import model as m
 from model import connect_to_db, db
 from seed_testdb import sample_data
 import template_helpers as temp_help
 import twitch_helpers
+import user_loader
+from stream_data_writer import StreamDataWriter
 
 
 ###############################################################################
@@ -86,6 +90,101 @@ class UserModelTestCase(TestCase):
         user = m.User.get_user_from_twitch_id(twitch_id)
         self.assertIsNone(user)
 
+    def test_get_users_to_poll(self):
+        """Users with an open session or waiting on their stream are
+        polled."""
+
+        # Case 1: Every sample session has ended.
+        m.StreamSession.query.update({"ended_at": datetime.datetime.utcnow()})
+        db.session.commit()
+        self.assertEqual(m.User.get_users_to_poll(), [])
+
+        # Case 2: A user who just went live is polled before Twitch lists
+        # their stream.
+        user = m.User.get_user_from_id(4)
+        user.update_fetching(True)
+        self.assertEqual(m.User.get_users_to_poll(), [user])
+
+        # Case 3: An open session keeps the user polled.
+        user.update_fetching(False)
+        user.sessions[-1].ended_at = None
+        db.session.commit()
+        self.assertEqual(m.User.get_users_to_poll(), [user])
+
+    def test_get_live_tweeting_users(self):
+        """Only the ids and intervals of live, tweeting users are read."""
+
+        m.StreamSession.query.update({"ended_at": datetime.datetime.utcnow()})
+        db.session.commit()
+        self.assertEqual(m.User.get_live_tweeting_users(), [])
+        self.assertEqual(m.User.get_tweeting_user_ids(), [4])
+
+        # Case 2: User 4 goes live.
+        user = m.User.get_user_from_id(4)
+        user.sessions[-1].ended_at = None
+        db.session.commit()
+        self.assertEqual(m.User.get_live_tweeting_users(), [(4, 300)])
+
+        # Case 3: User 4 stops tweeting.
+        user.update_is_tweeting(False)
+        self.assertEqual(m.User.get_live_tweeting_users(), [])
+        self.assertEqual(m.User.get_tweeting_user_ids(), [])
+
+    def test_register_twitch_user(self):
+        """Registers a Twitch account once."""
+
+        # Case 1: A new Twitch id creates a user.
+        user, created = m.User.register_twitch_user("1234",
+                                                    "new@testing",
+                                                    "newuser",
+                                                    "NewUser")
+        self.assertTrue(created)
+        self.assertEqual(user.twitch_username, "newuser")
+        self.assertTrue(user.is_tweeting)
+
+        # Case 2: Registering again returns the same user.
+        again, created = m.User.register_twitch_user("1234",
+                                                     "new@testing",
+                                                     "newuser",
+                                                     "NewUser")
+        self.assertFalse(created)
+        self.assertEqual(again.user_id, user.user_id)
+
+        # Case 3: An existing user isn't changed.
+        existing, created = m.User.register_twitch_user("29389795",
+                                                        "other@testing",
+                                                        "other",
+                                                        "Other")
+        self.assertFalse(created)
+        self.assertEqual(existing.user_id, 4)
+        self.assertEqual(existing.email, "testing@testing")
+
+    def test_load_user(self):
+        """Loads a user with tokens once per request, then from the cache."""
+
+        user_loader.USER_CACHE.clear()
+
+        # Case 1: Loaded once per request.
+        with s.app.test_request_context():
+            user = user_loader.load_user("4")
+            self.assertEqual(user.user_id, 4)
+            self.assertIs(user_loader.load_user(4), user)
+            self.assertEqual(user.twitch_token.user_id, 4)
+        self.assertEqual(user_loader.USER_CACHE.stats["size"], 1)
+
+        # Case 2: Later requests rebuild the user from the cache.
+        db.session.remove()
+        with s.app.test_request_context():
+            with mock.patch.object(m.User, "query") as mock_query:
+                user = user_loader.load_user("4")
+            mock_query.options.assert_not_called()
+            self.assertEqual(user.twitch_username, "pixxeltesting")
+            self.assertEqual(user.twitch_token.user_id, 4)
+
+            # Case 3: Updating the user drops the cached copy.
+            user.update_tweet_interval(15)
+        self.assertIsNone(user_loader.USER_CACHE.get(4))
+
     def test_update_tweet_interval(self):
         """Checks if tweet interval setting is updated correctly."""
 
@@ -157,6 +256,41 @@ class UserModelTestCase(TestCase):
         self.assertEqual(new_refresh_token, token.refresh_token)
         self.assertEqual(new_expires_in, token.expires_in)
 
+    def test_get_expiring_twitch_tokens(self):
+        """Tokens that keep failing to refresh don't crowd out the rest."""
+
+        current_user = m.User.query.first()
+        token = current_user.twitch_token
+
+        # Case 0: A token stored before expiry was tracked is refreshed to
+        # find out when it expires.
+        self.assertIsNone(token.expires_at)
+        self.assertIn(token, m.TwitchToken.get_expiring(900))
+
+        current_user.update_twitch_access_token("ExpiringToken",
+                                                "RefreshExpiring", 60)
+
+        # Case 1: The token expires soon, so it's due for a refresh.
+        self.assertIn(token, m.TwitchToken.get_expiring(900))
+
+        # Case 2: After a failed refresh it waits for its retry time.
+        token.mark_refresh_failed(300)
+        self.assertEqual(token.refresh_failures, 1)
+        self.assertNotIn(token, m.TwitchToken.get_expiring(900))
+
+        # Case 3: Once it's time to retry, it's due again unless it has
+        # failed too many times.
+        token.next_refresh_at = datetime.datetime.utcnow()
+        m.db.session.commit()
+        self.assertIn(token, m.TwitchToken.get_expiring(900))
+        self.assertNotIn(token,
+                         m.TwitchToken.get_expiring(900, max_failures=1))
+
+        # Case 4: Storing a new token clears the failures.
+        current_user.update_twitch_access_token("NewToken", "RefreshNew", 60)
+        self.assertEqual(token.refresh_failures, 0)
+        self.assertIsNone(token.next_refresh_at)
+
     def test_update_twitter_access_token(self):
         """Checks if Twitter tokens are updated correctly."""
 
@@ -377,6 +511,27 @@ class StreamSessionModelTestCase(TestCase):
         self.assertEqual(repeat_twitch_session, twitch_session)
         self.assertEqual(num_data, 2)
 
+        # Case 3: A new Twitch stream closes the open session.
+        stream_data["stream_id"] = "2"
+        new_twitch_session = m.StreamSession.save_stream_session(
+            user=user, stream_data=stream_data
+        )
+        self.assertNotEqual(new_twitch_session.stream_id,
+                            twitch_session.stream_id)
+        self.assertIsNotNone(twitch_session.ended_at)
+        self.assertIsNone(new_twitch_session.ended_at)
+
+        # Case 4: The ended stream comes back as a new session.
+        stream_data["stream_id"] = "1"
+        reopened_session = m.StreamSession.save_stream_session(
+            user=user, stream_data=stream_data
+        )
+        self.assertNotIn(reopened_session.stream_id,
+                         [twitch_session.stream_id,
+                          new_twitch_session.stream_id])
+        self.assertEqual(len(m.StreamSession.query.filter_by(
+            user_id=user.user_id, ended_at=None).all()), 1)
+
     def test_end_stream_session(self):
         """Checks if an open session is closed."""
 
@@ -422,6 +577,81 @@ class StreamSessionModelTestCase(TestCase):
         self.assertFalse(open_sessions)
 
 
+class StreamDataWriterTestCase(TestCase):
+    """Tests StreamDataWriter methods."""
+
+    def setUp(self):
+        """Before each test..."""
+
+        # Connect to test db
+        connect_to_db(s.app, "postgresql:///testdb", False)
+
+        # Create tables and add sample data
+        db.create_all()
+        db.session.commit()
+        sample_data()
+
+    def tearDown(self):
+        """After every test..."""
+
+        db.session.close()
+        db.reflect()
+        db.drop_all()
+
+    def test_buffered_stream_data(self):
+        """Checks that buffered data points are written in one flush."""
+
+        user = m.User.query.first()
+        writer = StreamDataWriter(max_rows=2, max_queue=3)
+        writer.app = s.app
+        stream_data = {"timestamp": datetime.datetime(2017, 2, 14, 12, 30),
+                       "stream_id": "1",
+                       "twitch_id": "pixxeltesting",
+                       "stream_title": "Best stream ever!",
+                       "viewer_count": 100,
+                       "started_at": datetime.datetime(2017, 2, 14, 12, 30),
+                       "game_id": "1",
+                       "game_name": "Stardew Valley",
+                       "url": "https://twitch.tv/pixxeltesting"}
+
+        # Case 1: Data points wait in the buffer.
+        twitch_session = m.StreamSession.save_stream_session(
+            user=user, stream_data=stream_data, writer=writer
+        )
+        m.StreamSession.save_stream_session(
+            user=user, stream_data=stream_data, writer=writer
+        )
+        self.assertEqual(writer.pending(), 2)
+        self.assertEqual(twitch_session.data.count(), 0)
+
+        # Case 2: Flushing writes them all, and leaves the caller's
+        # session alone.
+        self.assertEqual(writer.flush(), 2)
+        self.assertEqual(writer.pending(), 0)
+        self.assertIn(twitch_session, db.session)
+        self.assertEqual(twitch_session.data.count(), 2)
+
+        # Case 3: A full buffer is flushed by the caller.
+        for _ in range(4):
+            writer.add(m.StreamDatum.create_row(twitch_session.stream_id,
+                                                stream_data))
+        self.assertEqual(writer.pending(), 1)
+        self.assertEqual(twitch_session.data.count(), 5)
+
+        # Case 4: A bad row is dropped; the rest of its batch is written.
+        writer.flush()
+        bad_row = m.StreamDatum.create_row(twitch_session.stream_id,
+                                           stream_data)
+        bad_row["game_name"] = None
+        writer.add(bad_row)
+        writer.add(m.StreamDatum.create_row(twitch_session.stream_id,
+                                            stream_data))
+        self.assertEqual(writer.flush(), 1)
+        self.assertEqual(writer.pending(), 0)
+        self.assertEqual(writer.rows_dropped, 1)
+        self.assertEqual(twitch_session.data.count(), 7)
+
+
 class TwitchClipModelTestCase(TestCase):
     """Tests TwitchClip class methods."""
 
@@ -455,11 +685,12 @@ class TwitchClipModelTestCase(TestCase):
             slug, user_id
         )
 
-        self.assertEqual(saved_clip.stream_id, user.sessions[-1].stream_id)
+        # sessions is ordered newest first.
+        self.assertEqual(saved_clip.stream_id, user.sessions[0].stream_id)
 
         # Case 2: Most recent session is open.
         # Alter the most recent session so it's detected as 'open'
-        last_session = user.sessions[-1]
+        last_session = user.sessions[0]
         last_session.ended_at = None
         db.session.commit()
 
@@ -468,6 +699,37 @@ class TwitchClipModelTestCase(TestCase):
         )
         self.assertEqual(saved_clip.stream_id, last_session.stream_id)
 
+    def test_save_twitch_clip_long_history(self):
+        """Clips go to the latest session of a user with many sessions."""
+
+        user_id = m.User.query.first().user_id
+        m.StreamSession.end_all_user_sessions_now(m.User.query.first())
+        started_at = datetime.datetime(2017, 1, 1)
+        db.session.add_all([
+            m.StreamSession(user_id=user_id,
+                            twitch_session_id="history" + str(index),
+                            started_at=started_at +
+                            datetime.timedelta(days=index),
+                            ended_at=started_at +
+                            datetime.timedelta(days=index, hours=2))
+            for index in range(1000)
+        ])
+        db.session.commit()
+
+        # Case 1: All closed; the most recently started session is used.
+        latest = m.StreamSession.query.filter_by(
+            twitch_session_id="history999").one()
+        saved_clip = m.TwitchClip.save_twitch_clip("Slug1", user_id)
+        self.assertEqual(saved_clip.stream_id, latest.stream_id)
+
+        # Case 2: An open session is used even if a later one started.
+        open_session = m.StreamSession.query.filter_by(
+            twitch_session_id="history500").one()
+        open_session.ended_at = None
+        db.session.commit()
+        saved_clip = m.TwitchClip.save_twitch_clip("Slug2", user_id)
+        self.assertEqual(saved_clip.stream_id, open_session.stream_id)
+
 ###############################################################################
 # TEMPLATE HELPER TESTS
 ###############################################################################
@@ -525,6 +787,90 @@ class TemplateHelpersTestCase(TestCase):
         for content in base_template_contents:
             self.assertIn(content, added_template_contents)
 
+    def test_compiled_template_matches_safe_substitute(self):
+        """Compiled templates render the same as string.Template."""
+
+        data = {"game": "Stardew Valley", "url": "https://twitch.tv/me",
+                "viewers": 100}
+        contents_list = ["Playing ${game} at $url!",
+                         "$viewers viewers, costs $$5, ${unknown} $",
+                         "No placeholders here.",
+                         ""]
+
+        for contents in contents_list:
+            expected = string.Template(contents).safe_substitute(data)
+            segments = temp_help.compile_template(contents)
+            self.assertEqual(temp_help.render_segments(segments, data),
+                             expected)
+
+    def test_compiled_template_cache(self):
+        """Templates compile once for many contexts and recompile after
+        they're edited."""
+
+        user = m.User.query.first()
+        template = m.Template.query.filter_by(user_id=user.user_id).first()
+        template.contents = "Now playing ${game}!"
+        db.session.commit()
+        temp_help.COMPILED_TEMPLATE_CACHE.clear()
+
+        tweets = temp_help.render_tweets(template.contents,
+                                         [{"game": "Celeste"},
+                                          {"game": "Hollow Knight"}],
+                                         template.template_id)
+        self.assertEqual(tweets, ["Now playing Celeste!",
+                                  "Now playing Hollow Knight!"])
+        self.assertEqual(temp_help.COMPILED_TEMPLATE_CACHE.stats["misses"], 1)
+
+        # Rendering again reuses the compiled segments.
+        temp_help.render_tweets(template.contents, [{"game": "Celeste"}],
+                                template.template_id)
+        self.assertEqual(temp_help.COMPILED_TEMPLATE_CACHE.stats["hits"], 1)
+
+        # Editing the template invalidates its compiled segments.
+        user.edit_template(template.template_id, "Still playing ${game}.")
+        self.assertIsNone(temp_help.COMPILED_TEMPLATE_CACHE.get(
+            template.template_id))
+        template = m.Template.query.get(template.template_id)
+        self.assertEqual(temp_help.render_segments(
+            temp_help.get_compiled_template(template.contents,
+                                            template.template_id),
+            {"game": "Celeste"}), "Still playing Celeste.")
+
+    def test_get_twitter_client(self):
+        """Twitter clients are reused until the user's token changes."""
+
+        user = m.User.query.first()
+        user.update_twitter_access_token("myToken", "mySecret")
+        temp_help.TWITTER_CLIENT_CACHE.clear()
+
+        client = temp_help.get_twitter_client(user.user_id)
+        self.assertIs(temp_help.get_twitter_client(user.user_id), client)
+
+        # Case 2: New token; a new client is authenticated with it.
+        user.update_twitter_access_token("myNewToken", "myNewSecret")
+        new_client = temp_help.get_twitter_client(user.user_id)
+        self.assertIsNot(new_client, client)
+        self.assertEqual(new_client.oauth.client.resource_owner_key,
+                         "myNewToken")
+
+        # Case 3: Token replaced by another process, without this process
+        # seeing the change; the new token is still used.
+        table = m.TwitterToken.__table__
+        db.session.execute(table.update()
+                           .where(table.c.user_id == user.user_id)
+                           .values(access_token="otherToken"))
+        db.session.commit()
+        other_client = temp_help.get_twitter_client(user.user_id)
+        self.assertEqual(other_client.oauth.client.resource_owner_key,
+                         "otherToken")
+
+        # Case 4: Token removed; the client is dropped and not used.
+        token_key = temp_help.get_twitter_token_key(user.twitter_token)
+        user.remove_twitter_access_token()
+        self.assertIsNone(temp_help.TWITTER_CLIENT_CACHE.get(token_key))
+        with self.assertRaises(tweepy.TweepError):
+            temp_help.get_twitter_client(user.user_id)
+
     def test_get_twitch_template_data(self):
         """Checks thats twitch data is being transformed correctly."""
 
@@ -598,9 +944,9 @@ class TemplateHelpersTestCase(TestCase):
             """Tests creating and publishing a tweet."""
 
             # Case 1: Function is given no contents.
-            temp_help.tweepy.API.update_status = mock.MagicMock()
+            temp_help.TwitterClient.update_status = mock.MagicMock()
             self.assertIsNone(temp_help.publish_to_twitter(None, 4))
-            temp_help.tweepy.API.update_status.assert_not_called()
+            temp_help.TwitterClient.update_status.assert_not_called()
 
             ###################################################################
             # SET UP
@@ -628,15 +974,10 @@ class TemplateHelpersTestCase(TestCase):
             m.db.session.add(mock_clip)
             m.db.session.commit()
 
-            # temp_help.tweepy.API = mock.MagicMock()
-            temp_help.twitch.generate_twitch_clip = mock.MagicMock(
-                return_value=(m.TwitchClip(slug="MyCuteCat",
-                                           stream_id=18,
-                                           clip_id=100),
-                              "https://clipurl")
-            )
+            temp_help.ap_handlers.schedule_clip_confirmation = \
+                mock.MagicMock()
 
-            temp_help.tweepy.API.update_status = mock.MagicMock(
+            temp_help.TwitterClient.update_status = mock.MagicMock(
                 return_value=mock.MagicMock(
                     id_str="12345",
                     created_at=datetime.datetime(2017, 2, 14, 12, 30, 10),
@@ -647,17 +988,73 @@ class TemplateHelpersTestCase(TestCase):
                 )
             )
 
-            # Case 2: Twitter update posts successfully.
+            # Case 2: Clip is submitted; tweet waits for confirmation.
+            temp_help.twitch.generate_twitch_clip = mock.MagicMock(
+                return_value="MyCuteCat"
+            )
             temp_help.publish_to_twitter(
                 template_contents, user.user_id
             )
+            temp_help.ap_handlers.schedule_clip_confirmation \
+                .assert_called_with(template_contents, user.user_id,
+                                    "MyCuteCat", tweet_key=None)
+            temp_help.TwitterClient.update_status.assert_not_called()
+
+            # Case 3: Clip confirmed; tweet is queued once and a publisher
+            # posts it.
+            self.assertTrue(temp_help.queue_tweet(
+                template_contents, user.user_id, clip_id=100,
+                idempotency_key="clip-MyCuteCat"
+            ))
+            self.assertFalse(temp_help.queue_tweet(
+                template_contents, user.user_id, clip_id=100,
+                idempotency_key="clip-MyCuteCat"
+            ))
+            temp_help.TwitterClient.update_status.assert_not_called()
+
+            self.assertEqual(temp_help.tweet_publisher.publish_due(), 1)
             saved_tweet = m.SentTweet.query.filter_by(
                 message="I tweeted a thing!",
                 clip_id=100
             ).first()
             self.assertTrue(saved_tweet)
-            temp_help.twitch.generate_twitch_clip.assert_called()
-            temp_help.tweepy.API.update_status.assert_called()
+            outbox_item = m.TweetOutbox.query.filter_by(
+                idempotency_key="clip-MyCuteCat").one()
+            self.assertEqual(outbox_item.status, "sent")
+            self.assertEqual(outbox_item.tweet_id, saved_tweet.tweet_id)
+
+            # Case 4: Clip can't be submitted; tweet is queued right away.
+            temp_help.TwitterClient.update_status.reset_mock()
+            temp_help.twitch.generate_twitch_clip = mock.MagicMock(
+                return_value=None
+            )
+            temp_help.TwitterClient.update_status.return_value.id_str = "54321"
+            tweet_key = temp_help.get_tweet_key(user.user_id, 17)
+            temp_help.publish_to_twitter(
+                template_contents, user.user_id, tweet_key=tweet_key
+            )
+            self.assertEqual(temp_help.tweet_publisher.publish_due(), 1)
+            temp_help.TwitterClient.update_status.assert_called_with(
+                template_contents)
+
+            # A second run for the same slot doesn't tweet again.
+            temp_help.publish_to_twitter(
+                template_contents, user.user_id, tweet_key=tweet_key
+            )
+            self.assertEqual(temp_help.tweet_publisher.publish_due(), 0)
+            self.assertEqual(m.TweetOutbox.query.filter_by(
+                idempotency_key="tweet-{}-17".format(user.user_id)).count(),
+                1)
+
+            # Case 5: Twitter is down; the tweet is retried later.
+            temp_help.TwitterClient.update_status.side_effect = \
+                temp_help.tweepy.TweepError("Over capacity")
+            temp_help.queue_tweet(template_contents, user.user_id)
+            self.assertEqual(temp_help.tweet_publisher.publish_due(), 0)
+            outbox_item = m.TweetOutbox.query.filter_by(
+                status="pending").one()
+            self.assertEqual(outbox_item.attempts, 1)
+            self.assertEqual(outbox_item.last_error, "Over capacity")
 
         test_publish_to_twitter(self)
 
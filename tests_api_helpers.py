@@ -84,6 +84,45 @@ class APIHelpersTestCase(TestCase):
 
         self.assertEqual(expected_payload, returned_payload)
 
+    def test_create_senttweets_payload_pages(self):
+        """Tests paging through tweets with a cursor."""
+
+        user = m.User.query.get(4)
+        created_at = datetime.datetime(2018, 3, 1, 12, 0, 0)
+        for tweet_number in range(3):
+            m.db.session.add(m.SentTweet(
+                tweet_twtr_id="page-test-{}".format(tweet_number),
+                user_id=user.user_id,
+                created_at=created_at,
+                message="Tweet {}".format(tweet_number),
+                permalink="https://twitter.com/987/status/{}".format(
+                    tweet_number)
+            ))
+        m.db.session.commit()
+
+        # Case 1: First page is full and links to the next one.
+        first_page = api_helpers.create_senttweets_payload(
+            user, created_at, created_at, limit=2
+        )
+        self.assertEqual(len(first_page["tweets"]), 2)
+        self.assertIn("next", first_page)
+
+        # Case 2: Cursor from the first page returns the rest.
+        cursor = first_page["next"].split("after=")[1].split("&")[0]
+        second_page = api_helpers.create_senttweets_payload(
+            user, created_at, created_at,
+            after=api_helpers.decode_tweet_cursor(cursor), limit=2
+        )
+        self.assertEqual(len(second_page["tweets"]), 1)
+        self.assertNotIn("next", second_page)
+
+        seen_ids = [tweet["tweetId"] for tweet
+                    in first_page["tweets"] + second_page["tweets"]]
+        self.assertEqual(len(set(seen_ids)), 3)
+
+        # Case 3: Malformed cursors raise ValueError.
+        self.assertRaises(ValueError, api_helpers.decode_tweet_cursor, "oops")
+
     def test_create_streamdata_payload(self):
         """Tests creating payload of stream data points for given stream id."""
 
@@ -106,6 +145,66 @@ class APIHelpersTestCase(TestCase):
         returned_payload = api_helpers.create_streamdata_payload(user, 9000)
         self.assertEqual(expected_payload, returned_payload)
 
+    def test_create_streamdata_payload_rollups(self):
+        """Tests creating payload of aggregated data points."""
+
+        user = m.User.query.get(4)
+        data_points = m.StreamSession.query.get(18).data.all()
+        viewers = [data_point.viewer_count for data_point in data_points]
+
+        # Case 1: Hourly rollups cover every raw data point.
+        returned_payload = api_helpers.create_streamdata_payload(
+            user, 18, "1h"
+        )
+        rollups = m.StreamDataRollup.query.filter_by(stream_id=18,
+                                                     resolution=3600).all()
+        self.assertEqual(len(returned_payload["data"]), len(rollups))
+        self.assertEqual(sum(rollup.num_points for rollup in rollups),
+                         len(data_points))
+        self.assertEqual(max(point["maxViewers"]
+                             for point in returned_payload["data"]),
+                         max(viewers))
+        self.assertEqual(min(point["minViewers"]
+                             for point in returned_payload["data"]),
+                         min(viewers))
+
+        # Case 2: Five minute rollups have at least as many points.
+        returned_payload_5m = api_helpers.create_streamdata_payload(
+            user, 18, "5m"
+        )
+        self.assertGreaterEqual(len(returned_payload_5m["data"]),
+                                len(returned_payload["data"]))
+
+        # Case 3: New data points update existing rollups incrementally.
+        last_point = data_points[-1]
+        m.StreamDatum.save_stream_data(
+            m.StreamSession.query.get(18),
+            {"timestamp": last_point.timestamp,
+             "game_id": last_point.game_id,
+             "game_name": "A Brand New Game",
+             "stream_title": last_point.stream_title,
+             "viewer_count": max(viewers) + 10}
+        )
+        last_rollup = m.StreamDataRollup.query.filter_by(
+            stream_id=18, resolution=3600
+        ).order_by(m.StreamDataRollup.bucket_start.desc()).first()
+        self.assertEqual(last_rollup.max_viewers, max(viewers) + 10)
+        self.assertEqual(last_rollup.game_name, "A Brand New Game")
+        self.assertGreaterEqual(last_rollup.game_changes, 1)
+
+        # Case 4: Rollups missing the start of a session (live across the
+        # deploy that added rollups) are rebuilt.
+        first_rollup = m.StreamDataRollup.query.filter_by(
+            stream_id=18, resolution=3600
+        ).order_by(m.StreamDataRollup.bucket_start).first()
+        m.db.session.delete(first_rollup)
+        m.db.session.commit()
+        api_helpers.create_streamdata_payload(user, 18, "1h")
+        rollups = m.StreamDataRollup.query.filter_by(stream_id=18,
+                                                     resolution=3600).all()
+        self.assertEqual(sum(rollup.num_points for rollup in rollups),
+                         len(data_points) + 1)
+
     def test_create_clip_payload(self):
         """Tests creating payload of clip data for given clip id."""
 
@@ -0,0 +1,78 @@
+"""Tests for failure_counters."""
+from unittest import TestCase, mock
+import threading
+from failure_counters import LocalCounter, PostgresCounter, create_counter
+
+
+###############################################################################
+# FAILURE COUNTER TESTS
+###############################################################################
+
+
+class LocalCounterTestCase(TestCase):
+    """Tests LocalCounter methods."""
+
+    def setUp(self):
+        """Before each test..."""
+
+        self.counter = LocalCounter()
+
+    def test_increment_and_reset(self):
+        """Counts start at 0, go up and reset back to 0."""
+
+        self.assertEqual(self.counter.get(4), 0)
+        self.assertEqual(self.counter.increment(4), 1)
+        self.assertEqual(self.counter.increment(4), 2)
+        self.assertEqual(self.counter.increment(5), 1)
+
+        self.counter.reset(4)
+        self.assertEqual(self.counter.get(4), 0)
+        self.assertEqual(self.counter.get(5), 1)
+
+        # Case 2: reset_many resets every key, including ones never counted.
+        self.counter.increment(4)
+        self.counter.reset_many([4, 5, 6])
+        self.assertEqual(self.counter.get(4), 0)
+        self.assertEqual(self.counter.get(5), 0)
+
+    def test_concurrent_increments(self):
+        """No increments are lost when many threads count at once."""
+
+        def count():
+            for _ in range(1000):
+                self.counter.increment(4)
+
+        threads = [threading.Thread(target=count) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.counter.get(4), 8000)
+
+
+class CreateCounterTestCase(TestCase):
+    """Tests create_counter."""
+
+    def test_create_counter(self):
+        """The backend picks the counter class."""
+
+        table = mock.Mock()
+        table.increment.return_value = 3
+        counter = create_counter("check_stream_online", table, "postgres")
+
+        self.assertIsInstance(counter, PostgresCounter)
+        self.assertEqual(counter.increment(4), 3)
+        table.increment.assert_called_once_with("check_stream_online", 4, 1)
+
+        # Resetting no keys doesn't touch the db.
+        counter.reset_many([])
+        table.reset.assert_not_called()
+
+        self.assertIsInstance(create_counter("x", table, "local"),
+                              LocalCounter)
+
+
+if __name__ == "__main__":
+    import unittest
+    unittest.main()
@@ -0,0 +1,61 @@
+"""Tests for live_sessions."""
+from unittest import TestCase, mock
+from live_sessions import LiveSession, LiveSessionRegistry
+
+
+###############################################################################
+# LIVE SESSION TESTS
+###############################################################################
+
+
+class LiveSessionRegistryTestCase(TestCase):
+    """Tests LiveSessionRegistry methods."""
+
+    def setUp(self):
+        """Before each test..."""
+
+        self.registry = LiveSessionRegistry()
+
+    def test_open_and_close(self):
+        """Sessions are found by user and Twitch stream until closed."""
+
+        live_session = self.registry.open("4", 7, "123",
+                                          {"game_name": "Stardew Valley",
+                                           "viewer_count": 100})
+        self.assertEqual(live_session.game_name, "Stardew Valley")
+        self.assertEqual(live_session.viewer_count, 100)
+
+        # Case 1: Found for the same Twitch stream only.
+        self.assertIs(self.registry.get(4), live_session)
+        self.assertIs(self.registry.get_current(4, "123"), live_session)
+        self.assertIsNone(self.registry.get_current(4, "456"))
+
+        # Case 2: Closed sessions are gone.
+        self.registry.close(4)
+        self.assertIsNone(self.registry.get(4))
+
+        # Records are compact.
+        with self.assertRaises(AttributeError):
+            live_session.extra = True
+
+    def test_load(self):
+        """Loading keeps open sessions' values and drops ended ones."""
+
+        kept = self.registry.open(4, 7, "123", {"viewer_count": 100})
+        self.registry.open(5, 8, "456")
+
+        self.registry.load([mock.Mock(user_id=4, stream_id=7,
+                                      twitch_session_id="123"),
+                            mock.Mock(user_id=6, stream_id=9,
+                                      twitch_session_id="789")])
+
+        self.assertIs(self.registry.get(4), kept)
+        self.assertEqual(kept.viewer_count, 100)
+        self.assertIsNone(self.registry.get(5))
+        self.assertIsInstance(self.registry.get(6), LiveSession)
+        self.assertEqual(len(self.registry), 2)
+
+
+if __name__ == "__main__":
+    import unittest
+    unittest.main()
@@ -0,0 +1,70 @@
+"""Tests for partitioning."""
+from unittest import TestCase
+from partitioning import HashRing, Partition
+
+
+###############################################################################
+# PARTITIONING TESTS
+###############################################################################
+
+
+class PartitioningTestCase(TestCase):
+    """Tests HashRing and Partition methods."""
+
+    def test_node_for(self):
+        """Every key maps to one of the ring's nodes, the same way each
+        time."""
+
+        ring = HashRing(["worker-a", "worker-b", "worker-c"])
+        owners = [ring.node_for(user_id) for user_id in range(300)]
+
+        self.assertEqual(set(owners), {"worker-a", "worker-b", "worker-c"})
+        self.assertEqual(owners,
+                         [ring.node_for(user_id) for user_id in range(300)])
+
+        # Case 2: An empty ring owns nothing.
+        self.assertIsNone(HashRing([]).node_for(4))
+
+    def test_adding_a_node_moves_few_keys(self):
+        """Only keys claimed by a new node change owners."""
+
+        ring = HashRing(["worker-a", "worker-b", "worker-c"])
+        bigger_ring = HashRing(["worker-a", "worker-b", "worker-c",
+                                "worker-d"])
+
+        for user_id in range(1000):
+            new_owner = bigger_ring.node_for(user_id)
+            if new_owner != "worker-d":
+                self.assertEqual(new_owner, ring.node_for(user_id))
+
+    def test_partition_owns(self):
+        """Live workers split the users between them with no overlap."""
+
+        # Case 1: Without a ring (single process) every user is owned.
+        single = Partition()
+        self.assertTrue(single.owns(4))
+
+        # Case 2: Two workers own disjoint halves of the users.
+        worker_a = Partition()
+        worker_a.worker_id = "worker-a"
+        worker_b = Partition()
+        worker_b.worker_id = "worker-b"
+        self.assertTrue(worker_a.update(["worker-a", "worker-b"]))
+        self.assertTrue(worker_b.update(["worker-b", "worker-a"]))
+
+        for user_id in range(200):
+            self.assertNotEqual(worker_a.owns(user_id),
+                                worker_b.owns(user_id))
+
+        # Case 3: Same workers means no rebalance.
+        self.assertFalse(worker_a.update(["worker-b", "worker-a"]))
+
+        # Case 4: When the other worker leaves, everything moves here.
+        self.assertTrue(worker_a.update([]))
+        self.assertTrue(all(worker_a.owns(user_id)
+                            for user_id in range(200)))
+
+
+if __name__ == "__main__":
+    import unittest
+    unittest.main()
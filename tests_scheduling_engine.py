@@ -0,0 +1,146 @@
+"""Tests for scheduling_engine."""
+from unittest import TestCase
+from scheduling_engine import SchedulingEngine
+
+
+###############################################################################
+# SCHEDULING ENGINE TESTS
+###############################################################################
+
+
+class SchedulingEngineTestCase(TestCase):
+    """Tests SchedulingEngine methods."""
+
+    def setUp(self):
+        """Before each test..."""
+
+        self.now = 1000
+        self.engine = SchedulingEngine(shard_count=4, clock=lambda: self.now)
+
+    def pop_all_due(self):
+        """Pops due tasks from every shard into one dictionary."""
+
+        all_due = {}
+        for shard_index in range(self.engine.shard_count):
+            for task_type, user_ids in self.engine.pop_due(
+                    shard_index).items():
+                all_due.setdefault(task_type, []).extend(user_ids)
+        return all_due
+
+    def test_schedule_and_pop_due(self):
+        """Tasks run once their interval passes, then are rescheduled."""
+
+        self.engine.schedule("send_tweets", 4, 60)
+        self.engine.schedule("send_tweets", 5, 120)
+
+        # Case 1: Nothing is due yet.
+        self.assertEqual(self.pop_all_due(), {})
+
+        # Case 2: Only the shorter interval is due.
+        self.now = 1060
+        self.assertEqual(self.pop_all_due(), {"send_tweets": [4]})
+
+        # Case 3: Both are due; user 4 was rescheduled for 1120.
+        self.now = 1120
+        self.assertEqual(sorted(self.pop_all_due()["send_tweets"]), [4, 5])
+
+    def test_missed_runs_keep_phase(self):
+        """A task missed several times runs once and keeps its phase."""
+
+        self.engine.schedule("send_tweets", 4, 60)
+        self.now = 1250
+        self.assertEqual(self.pop_all_due(), {"send_tweets": [4]})
+
+        # Next run is at 1300, on the original 60 second grid.
+        self.now = 1299
+        self.assertEqual(self.pop_all_due(), {})
+        self.now = 1300
+        self.assertEqual(self.pop_all_due(), {"send_tweets": [4]})
+
+    def test_pop_due_runs(self):
+        """Each run is numbered by the interval slot it was due in."""
+
+        self.engine.schedule("send_tweets", 4, 60)
+        self.now = 1060
+        self.assertEqual(self.engine.pop_due_runs(0),
+                         {"send_tweets": [(4, 17)]})
+
+        # Case 1: A run popped late keeps its due slot.
+        self.now = 1150
+        self.assertEqual(self.engine.pop_due_runs(0),
+                         {"send_tweets": [(4, 18)]})
+
+        # Case 2: Slots match for runs due at the same time.
+        self.assertEqual(self.engine.run_slot(1120, 60), 18)
+
+    def test_unschedule(self):
+        """Unscheduled and replaced tasks are not run from stale entries."""
+
+        self.engine.schedule("send_tweets", 4, 60)
+        self.engine.schedule("renew_webhook", 4, 60)
+        self.engine.schedule("renew_webhook", 4, 600)
+
+        # Case 1: Unscheduling returns whether the task existed.
+        self.assertTrue(self.engine.unschedule("send_tweets", "4"))
+        self.assertFalse(self.engine.unschedule("send_tweets", 4))
+        self.assertFalse(self.engine.is_scheduled("send_tweets", 4))
+
+        # Case 2: Neither the removed nor the replaced entry runs.
+        self.now = 1060
+        self.assertEqual(self.pop_all_due(), {})
+        self.assertEqual(len(self.engine), 1)
+
+    def test_users_are_sharded(self):
+        """Users are split across shards."""
+
+        for user_id in range(8):
+            self.engine.schedule("send_tweets", user_id, 60)
+
+        shard_sizes = [len(shard.entries) for shard in self.engine.shards]
+        self.assertEqual(shard_sizes, [2, 2, 2, 2])
+
+    def test_spread_first_runs(self):
+        """Tasks scheduled together are spread over their slots."""
+
+        engine = SchedulingEngine(shard_count=4, clock=lambda: self.now,
+                                  spread=60)
+        for user_id in range(100):
+            engine.schedule("send_tweets", user_id, 600, first_run=self.now)
+
+        # Case 1: Every run is within the window, on the user's slot.
+        for shard in engine.shards:
+            for (task_type, user_id), (due_at, _) in shard.entries.items():
+                self.assertTrue(self.now <= due_at < self.now + 60)
+                self.assertEqual(due_at % 60,
+                                 engine.slot(task_type, user_id, 60))
+
+        # Case 2: The load is spread rather than all on one second.
+        load = engine.load_by_second(60)
+        self.assertEqual(sum(load), 100)
+        self.assertLess(max(load), 10)
+
+        # Case 3: Slots are the same after a restart.
+        restarted = SchedulingEngine(shard_count=4, clock=lambda: self.now,
+                                     spread=60)
+        restarted.schedule("send_tweets", 7, 600, first_run=self.now)
+        self.assertEqual(restarted.shards[3].entries,
+                         {("send_tweets", 7):
+                          engine.shards[3].entries[("send_tweets", 7)]})
+
+    def test_load_by_second(self):
+        """Load counts repeats within the horizon and overdue runs once."""
+
+        self.engine.schedule("send_tweets", 4, 20, first_run=1005)
+        self.engine.schedule("send_tweets", 5, 20, first_run=900)
+
+        load = self.engine.load_by_second(60)
+        # User 5 is overdue: it runs now, then at 1020 and 1040.
+        self.assertEqual(load[0], 1)
+        self.assertEqual([load[5], load[25], load[45]], [1, 1, 1])
+        self.assertEqual([load[20], load[40]], [1, 1])
+        self.assertEqual(sum(load), 6)
+
+
+if __name__ == "__main__":
+    import unittest
+    unittest.main()
@@ -0,0 +1,81 @@
+"""Tests for tweet_publisher."""
+from unittest import TestCase, mock
+from tweet_publisher import AccountRateLimiter, TweetPublisher, error_codes
+
+
+###############################################################################
+# TWEET PUBLISHER TESTS
+###############################################################################
+
+
+class AccountRateLimiterTestCase(TestCase):
+    """Tests AccountRateLimiter methods."""
+
+    def setUp(self):
+        """Before each test..."""
+
+        self.now = 1000.0
+        self.limiter = AccountRateLimiter(capacity=3, period=30,
+                                          clock=lambda: self.now)
+
+    def test_acquire(self):
+        """Each account gets capacity tweets, then waits for a refill."""
+
+        for _ in range(3):
+            self.assertEqual(self.limiter.acquire(4), 0)
+        self.assertAlmostEqual(self.limiter.acquire(4), 10)
+
+        # Case 2: Other accounts have their own bucket.
+        self.assertEqual(self.limiter.acquire(5), 0)
+
+        # Case 3: A token is back after period / capacity seconds.
+        self.now += 10
+        self.assertEqual(self.limiter.acquire(4), 0)
+        self.assertGreater(self.limiter.acquire(4), 0)
+
+    def test_block_until(self):
+        """A 429 from Twitter holds the account back."""
+
+        self.limiter.block_until(4, 60)
+        self.now += 59
+        self.assertGreater(self.limiter.acquire(4), 0)
+        self.now += 20
+        self.assertEqual(self.limiter.acquire(4), 0)
+
+
+
+class TweetPublisherTestCase(TestCase):
+    """Tests TweetPublisher methods."""
+
+    def test_error_codes(self):
+        """Twitter error codes are read however tweepy reports them."""
+
+        self.assertEqual(error_codes(mock.Mock(api_code=None)), [])
+        self.assertEqual(error_codes(mock.Mock(api_code=187)), [187])
+        self.assertEqual(error_codes(mock.Mock(api_code=[186, "187"])),
+                         [186, 187])
+        self.assertEqual(error_codes(mock.Mock(api_code=[{"code": 326}])),
+                         [326])
+
+    def test_handle_error_code_list(self):
+        """A permanent error reported in a list fails the tweet for good."""
+
+        publisher = TweetPublisher(send=None)
+        item = mock.Mock(attempts=1)
+        error = mock.Mock(response=mock.Mock(status_code=400),
+                          api_code=[187],
+                          reason="Status is a duplicate.")
+
+        publisher._handle_error(item, error)
+        item.mark_failed.assert_called_once_with("Status is a duplicate.")
+
+        # Case 2: Other errors are retried.
+        item.reset_mock()
+        error.api_code = [130]
+        publisher._handle_error(item, error)
+        item.mark_failed.assert_called_once_with("Status is a duplicate.", 30)
+
+
+if __name__ == "__main__":
+    import unittest
+    unittest.main()
@@ -2,11 +2,13 @@
 from unittest import TestCase, mock
 import os
 import datetime
+import requests
 import server as s
 import model as m
 from model import connect_to_db, db
 from seed_testdb import sample_data
 import twitch_helpers
+import twitch_client
 
 try:
     WEBHOOKS_BASE_URL = os.environ["WEBHOOKS_BASE_URL"]
@@ -38,6 +40,13 @@ class TwitchHelpersTestCase(TestCase):
         db.session.commit()
         sample_data()
 
+        # Start every test with empty Twitch caches.
+        twitch_helpers.GAME_NAME_CACHE.clear()
+        twitch_helpers.STREAMER_LOGIN_CACHE.clear()
+        twitch_helpers.STREAM_SNAPSHOTS.clear()
+        twitch_helpers.LIVE_SESSIONS.clear()
+        twitch_helpers.token_manager.clear()
+
     def tearDown(self):
         """After every test..."""
 
@@ -46,7 +55,9 @@ class TwitchHelpersTestCase(TestCase):
         db.drop_all()
 
     twitch_token = mock.Mock(spec=m.TwitchToken,
-                             access_token="imagreattoken")
+                             access_token="imagreattoken",
+                             expires_at=None,
+                             next_refresh_at=None)
 
     user = mock.Mock(spec=m.User,
                      twitch_token=twitch_token,
@@ -78,12 +89,72 @@ class TwitchHelpersTestCase(TestCase):
                           twitch_helpers.check_response_status,
                           bad_response)
 
-    @mock.patch("twitch_helpers.requests.get")
+    def test_twitch_client_request(self):
+        """Checks that Twitch requests are pooled and given a timeout."""
+
+        client = twitch_helpers.twitch_client
+        client.session.request = mock.Mock(
+            return_value=mock.Mock(status_code=200, headers={}))
+
+        client.get("https://api.twitch.tv/helix/streams")
+        client.session.request.assert_called_with(
+            "GET", "https://api.twitch.tv/helix/streams",
+            timeout=client.timeout
+        )
+        del client.session.request
+
+        # Twitch hosts share keep-alive connection pools.
+        adapter = client.session.get_adapter("https://api.twitch.tv/helix")
+        self.assertIs(adapter,
+                      client.session.get_adapter("https://api.twitch.tv/x"))
+
+    def test_rate_limiter(self):
+        """Requests are paced, prioritized and synced with Twitch's
+        Ratelimit headers."""
+
+        now = [1000.0]
+        limiter = twitch_client.RateLimiter(limit=60, window=60, burst=10,
+                                            clock=lambda: now[0])
+
+        # Case 1: Lookups leave headroom for clips and stream checks.
+        for _ in range(7):
+            self.assertEqual(
+                limiter.try_acquire(twitch_client.PRIORITY_LOOKUP), 0)
+        self.assertGreater(
+            limiter.try_acquire(twitch_client.PRIORITY_LOOKUP), 0)
+        self.assertEqual(
+            limiter.try_acquire(twitch_client.PRIORITY_STREAM), 0)
+        self.assertEqual(limiter.try_acquire(twitch_client.PRIORITY_CLIP), 0)
+
+        # Case 2: Once empty, tokens come back at the refill rate.
+        self.assertEqual(limiter.try_acquire(twitch_client.PRIORITY_CLIP), 0)
+        self.assertGreater(limiter.try_acquire(twitch_client.PRIORITY_CLIP),
+                           0)
+        now[0] += 1
+        self.assertEqual(limiter.try_acquire(twitch_client.PRIORITY_CLIP), 0)
+
+        # Case 3: A 429 holds every request until Twitch's reset time.
+        now[0] += 60
+        limiter.update({"Ratelimit-Remaining": "0",
+                        "Ratelimit-Reset": str(int(now[0]) + 5)}, 429)
+        self.assertEqual(limiter.try_acquire(twitch_client.PRIORITY_CLIP), 5)
+        now[0] += 5
+        self.assertEqual(limiter.try_acquire(twitch_client.PRIORITY_CLIP), 0)
+
+        # Case 4: Priorities come from the url.
+        self.assertEqual(twitch_client.priority_for(
+            "https://api.twitch.tv/helix/clips?broadcaster_id=1"),
+            twitch_client.PRIORITY_CLIP)
+        self.assertEqual(twitch_client.priority_for(
+            "https://api.twitch.tv/helix/games"),
+            twitch_client.PRIORITY_LOOKUP)
+
+    @mock.patch("twitch_helpers.twitch_client.get")
     def test_get_stream_info(self, get_streams):
         """Checks if getting stream info works."""
 
         get_streams.return_value = mock.Mock(
-            spec=twitch_helpers.requests.Response)
+            spec=requests.Response)
 
         twitch_helpers.get_stream_info(self.user)
         self.assertTrue(twitch_helpers.get_stream_info(self.user))
@@ -146,15 +217,15 @@ class TwitchHelpersTestCase(TestCase):
         self.assertFalse(twitch_helpers.handle_check_stream_online_failures(user_id))
         stop_fetch.assert_not_called()
         stop_tweet.assert_not_called()
-        self.assertEqual(twitch_helpers.CHECK_STREAM_ONLINE_FAILURES[user_id], 1)
+        self.assertEqual(twitch_helpers.CHECK_STREAM_ONLINE_FAILURES.get(user_id), 1)
 
         # Case 2: This is the second stream failure.
         twitch_helpers.handle_check_stream_online_failures(user_id)
         stop_fetch.assert_called()
         stop_tweet.assert_called()
-        self.assertEqual(twitch_helpers.CHECK_STREAM_ONLINE_FAILURES[user_id], 0)
+        self.assertEqual(twitch_helpers.CHECK_STREAM_ONLINE_FAILURES.get(user_id), 0)
 
-    @mock.patch("twitch_helpers.requests.get")
+    @mock.patch("twitch_helpers.twitch_client.get")
     def test_create_stream_url(self, requests_get):
         """Checks that url is constructed correctly."""
 
@@ -174,13 +245,52 @@ class TwitchHelpersTestCase(TestCase):
             expected_url
         )
 
-        # Case 2: Bad response
+        # Case 2: Login is served from the cache.
         mock_response.status_code = 401
+        self.assertEqual(
+            twitch_helpers.create_stream_url(twitch_id, self.user),
+            expected_url
+        )
+        requests_get.assert_called_once()
+
+        # Case 3: Bad response
+        twitch_helpers.STREAMER_LOGIN_CACHE.clear()
         self.assertIsNone(
             twitch_helpers.create_stream_url(twitch_id, self.user)
         )
 
-    @mock.patch("twitch_helpers.requests.get")
+    @mock.patch("twitch_helpers.twitch_client.get")
+    def test_refresh_twitch_logins(self, requests_get):
+        """Checks that stale logins are fetched together and saved."""
+
+        user = m.User.query.get(4)
+        other_user = m.User(twitch_id="1234", twitch_username="oldname")
+        db.session.add(other_user)
+        db.session.commit()
+
+        json = {"data": [{"id": str(user.twitch_id),
+                          "login": user.twitch_username},
+                         {"id": "1234", "login": "newname"}]}
+        mock_response = mock.Mock()
+        mock_response.status_code = 200
+        mock_response.json.return_value = json
+        requests_get.return_value = mock_response
+
+        twitch_helpers.refresh_twitch_logins([user, other_user])
+
+        # Case 1: Both users are looked up in one request.
+        requests_get.assert_called_once()
+
+        # Case 2: Changed login is written back to the db.
+        self.assertEqual(m.User.query.get(other_user.user_id)
+                         .twitch_username, "newname")
+        self.assertEqual(
+            twitch_helpers.create_stream_url("1234", other_user),
+            "https://www.twitch.tv/newname"
+        )
+        requests_get.assert_called_once()
+
+    @mock.patch("twitch_helpers.twitch_client.get")
     def test_get_twitch_game_data(self, requests_get):
         """Checks if game data is returned correctly."""
 
@@ -198,51 +308,100 @@ class TwitchHelpersTestCase(TestCase):
             game_id, self.user
         ), game_name)
 
-        # Case 2: Bad response
+        # Case 2: Game name is served from the cache.
         mock_response.status_code = 401
+        self.assertEqual(twitch_helpers.get_twitch_game_data(
+            game_id, self.user
+        ), game_name)
+        requests_get.assert_called_once()
+
+        # Case 3: Bad response
+        twitch_helpers.GAME_NAME_CACHE.clear()
         self.assertIsNone(twitch_helpers.get_twitch_game_data(
             game_id, self.user
         ))
 
-    @mock.patch("twitch_helpers.requests.post")
-    @mock.patch("twitch_helpers.get_clip_info")
-    def test_generate_twitch_clip(self, get_clip_info, requests_post):
+        # Case 4: Twitch can't be reached
+        requests_get.side_effect = requests.ConnectionError
+        self.assertIsNone(twitch_helpers.get_twitch_game_data(
+            game_id, self.user
+        ))
+
+    @mock.patch("twitch_helpers.twitch_client.get")
+    def test_get_twitch_games_data(self, requests_get):
+        """Checks that uncached games are resolved in a single request."""
+
+        twitch_helpers.GAME_NAME_CACHE.set("1", "Stardew Valley")
+        json = {"data": [{"id": "2", "name": "Celeste"},
+                         {"id": "3", "name": "Hollow Knight"}]}
+        mock_response = mock.Mock()
+        mock_response.status_code = 200
+        mock_response.json.return_value = json
+        requests_get.return_value = mock_response
+
+        game_names = twitch_helpers.get_twitch_games_data(
+            ["1", "2", "3", "2", ""], self.user
+        )
+
+        self.assertEqual(game_names, {"1": "Stardew Valley",
+                                      "2": "Celeste",
+                                      "3": "Hollow Knight"})
+        # Only the two uncached ids are requested.
+        requests_get.assert_called_once()
+        params = requests_get.call_args[1]["params"]
+        self.assertEqual(sorted(params), [("id", "2"), ("id", "3")])
+        self.assertEqual(twitch_helpers.GAME_NAME_CACHE.stats["hits"], 3)
+
+    @mock.patch("twitch_helpers.twitch_client.post")
+    def test_generate_twitch_clip(self, requests_post):
         """Test programmatic Twitch clip creation."""
 
         # Set up mock objects
         clip_slug = "ToastedPotatoPandas"
-        clip_url = "https://twitch.tv/clips/" + clip_slug
-        clip_data = {"url": clip_url}
         create_clip_json = {"data": [{"id": clip_slug}]}
         mock_response = mock.Mock()
         mock_response.status_code = 202
         mock_response.json.return_value = create_clip_json
 
         requests_post.return_value = mock_response
-        get_clip_info.return_value = clip_data
 
-        # Case 1: Creating a clip and getting info succeed.
-        new_clip, created_url = twitch_helpers.generate_twitch_clip(
-            self.user.user_id)
-        self.assertEqual(created_url, clip_url)
+        # Case 1: Creating a clip is accepted.
+        self.assertEqual(clip_slug, twitch_helpers.generate_twitch_clip(
+            self.user.user_id))
 
         # Case 2: Creating a clip fails.
-        get_clip_info.return_value = None
+        mock_response.status_code = 503
+        self.assertIsNone(twitch_helpers.generate_twitch_clip(
+            self.user.user_id))
+
+    @mock.patch("twitch_helpers.get_clip_info")
+    def test_confirm_twitch_clip(self, get_clip_info):
+        """Test confirming a submitted Twitch clip."""
+
+        clip_slug = "ToastedPotatoPandas"
+        clip_url = "https://twitch.tv/clips/" + clip_slug
+        get_clip_info.return_value = {"url": clip_url}
 
+        # Case 1: Clip exists; it's saved and its url is returned.
+        new_clip, created_url = twitch_helpers.confirm_twitch_clip(
+            clip_slug, self.user.user_id)
+        self.assertEqual(created_url, clip_url)
+        self.assertEqual(new_clip.slug, clip_slug)
+
+        # Case 2: Clip isn't available yet.
+        get_clip_info.return_value = None
         self.assertTupleEqual(
-            (None, None), twitch_helpers.generate_twitch_clip(
-                self.user.user_id
+            (None, None), twitch_helpers.confirm_twitch_clip(
+                clip_slug, self.user.user_id
             ))
 
-    @mock.patch("twitch_helpers.time.sleep")
-    @mock.patch("twitch_helpers.requests.get")
-    def test_get_clip_info(self, requests_get, sleep):
+    @mock.patch("twitch_helpers.twitch_client.get")
+    def test_get_clip_info(self, requests_get):
         """Tests getting clip info through Twitch API."""
 
         clip_id = "ToastedPotatoPandas"
         # Set up mock objects
         json = {"data": ["clip_info"]}
-        sleep = mock.Mock()
         mock_response = mock.Mock()
         mock_response.status_code = 200
         mock_response.json.return_value = json
@@ -253,12 +412,13 @@ class TwitchHelpersTestCase(TestCase):
         self.assertEqual(clip_info, twitch_helpers.get_clip_info(
             clip_id, self.user
         ))
-        # Case 2: Clip info fails
+        # Case 2: Clip info isn't available; returns without waiting.
         json = {"data": []}
         mock_response.json.return_value = json
         self.assertFalse(twitch_helpers.get_clip_info(
             clip_id, self.user
         ))
+        self.assertEqual(requests_get.call_count, 2)
 
     @mock.patch("twitch_helpers.handle_check_stream_online_failures")
     @mock.patch("twitch_helpers.create_stream_url")
@@ -346,7 +506,149 @@ class TwitchHelpersTestCase(TestCase):
         ))
         stream_failures.assert_called()
 
-    @mock.patch("twitch_helpers.requests.post")
+    @mock.patch("twitch_helpers.StreamSession.save_stream_session")
+    @mock.patch("twitch_helpers.serialize_twitch_stream_data")
+    def test_get_latest_stream_data(self, serialize, save_session):
+        """Tweets reuse the fetch job's snapshot while it's fresh."""
+
+        serialize.return_value = "fresh from twitch"
+
+        # Case 1: No snapshot; ask Twitch.
+        self.assertEqual(twitch_helpers.get_latest_stream_data(self.user),
+                         "fresh from twitch")
+
+        # Case 2: Fetch job stored a snapshot; Twitch isn't called.
+        serialize.reset_mock()
+        snapshot = {"stream_id": "1"}
+        twitch_helpers.write_twitch_stream_data(self.user, snapshot)
+        self.assertEqual(twitch_helpers.get_latest_stream_data(self.user),
+                         snapshot)
+        serialize.assert_not_called()
+
+        # Case 3: Stale snapshot; ask Twitch again.
+        twitch_helpers.STREAM_SNAPSHOTS.set(self.user.user_id, "snapshot",
+                                            ttl=-1)
+        self.assertEqual(twitch_helpers.get_latest_stream_data(self.user),
+                         "fresh from twitch")
+
+    @mock.patch("twitch_helpers.StreamDatum.save_stream_data")
+    @mock.patch("twitch_helpers.StreamSession.save_stream_session")
+    def test_write_twitch_stream_data(self, save_session, save_data):
+        """Only a stream's first poll looks up its session in the db."""
+
+        save_session.return_value = mock.Mock(stream_id=7,
+                                              twitch_session_id="1")
+        stream_data = {"stream_id": "1", "viewer_count": 10}
+
+        # Case 1: New stream; the session is saved and registered.
+        twitch_helpers.write_twitch_stream_data(self.user, stream_data)
+        save_session.assert_called_once_with(self.user, stream_data,
+                                             writer=None)
+        live_session = twitch_helpers.LIVE_SESSIONS.get(self.user.user_id)
+        self.assertEqual(live_session.stream_id, 7)
+
+        # Case 2: Same stream; only the data point is saved.
+        stream_data = {"stream_id": "1", "viewer_count": 20}
+        twitch_helpers.write_twitch_stream_data(self.user, stream_data)
+        self.assertEqual(save_session.call_count, 1)
+        save_data.assert_called_once_with(live_session, stream_data)
+        self.assertEqual(live_session.viewer_count, 20)
+
+        # Case 3: A different stream goes through the db again.
+        twitch_helpers.write_twitch_stream_data(self.user,
+                                                {"stream_id": "2"})
+        self.assertEqual(save_session.call_count, 2)
+
+    def test_chunk_list(self):
+        """Checks that lists are split into Helix-sized batches."""
+
+        items = list(range(250))
+        batches = twitch_helpers.chunk_list(items)
+
+        self.assertEqual([len(batch) for batch in batches], [100, 100, 50])
+        self.assertEqual(twitch_helpers.chunk_list([]), [])
+
+    @mock.patch("twitch_helpers.refresh_twitch_logins")
+    @mock.patch("twitch_helpers.get_twitch_games_data")
+    @mock.patch("twitch_helpers.handle_check_stream_online_failures")
+    @mock.patch("twitch_helpers.create_stream_data")
+    @mock.patch("twitch_helpers.get_streams_info")
+    def test_serialize_twitch_streams_data(self,
+                                           get_streams_info,
+                                           create_stream_data,
+                                           handle_failures,
+                                           get_games,
+                                           refresh_logins):
+        """Checks that many users' streams are fetched in one request."""
+
+        offline_user = mock.Mock(spec=m.User,
+                                 twitch_token=self.twitch_token,
+                                 twitch_id=1234,
+                                 user_id=5)
+        live_row = {"id": "27739018896", "user_id": "29389795"}
+
+        mock_response = mock.Mock()
+        mock_response.status_code = 200
+        mock_response.json.return_value = {"data": [live_row]}
+        get_streams_info.return_value = mock_response
+        create_stream_data.return_value = "foo"
+
+        all_stream_data = twitch_helpers.serialize_twitch_streams_data(
+            [self.user, offline_user]
+        )
+
+        # Case 1: Both users are looked up in a single request.
+        get_streams_info.assert_called_once_with([self.user, offline_user])
+
+        # Case 2: Live user gets stream data, offline user gets None.
+        self.assertEqual(all_stream_data, {4: "foo", 5: None})
+        create_stream_data.assert_called_once_with(live_row, self.user)
+        handle_failures.assert_called_once_with(5)
+        get_games.assert_called_once()
+        refresh_logins.assert_called_once_with([self.user])
+
+        # Case 3: Lookups that can't reach Twitch don't stop the poll.
+        get_games.side_effect = requests.Timeout
+        refresh_logins.side_effect = requests.ConnectionError
+        self.assertEqual(twitch_helpers.serialize_twitch_streams_data(
+            [self.user, offline_user]
+        ), {4: "foo", 5: None})
+
+    @mock.patch("twitch_helpers.refresh_users_token")
+    @mock.patch("twitch_helpers.handle_check_stream_online_failures")
+    @mock.patch("twitch_helpers.get_streams_info")
+    def test_request_streams_info(self,
+                                  get_streams_info,
+                                  handle_failures,
+                                  refresh_token):
+        """Checks that a batch isn't dropped when its token is revoked."""
+
+        other_user = mock.Mock(spec=m.User,
+                               twitch_token=self.twitch_token,
+                               twitch_id=1234,
+                               user_id=5)
+        live_row = {"id": "27739018896", "user_id": "1234"}
+        get_streams_info.side_effect = [
+            mock.Mock(status_code=401),
+            mock.Mock(status_code=200,
+                      **{"json.return_value": {"data": [live_row]}})
+        ]
+        refresh_token.return_value = None
+
+        users, rows = twitch_helpers.request_streams_info([self.user,
+                                                           other_user])
+
+        # Case 1: The user whose token failed to refresh is dropped and
+        # counted like an offline check.
+        refresh_token.assert_called_once_with(self.user)
+        handle_failures.assert_called_once_with(4)
+
+        # Case 2: The rest of the batch is sent with the next user's token.
+        get_streams_info.assert_called_with([other_user])
+        self.assertEqual(users, [other_user])
+        self.assertEqual(rows, [live_row])
+
+    @mock.patch("twitch_helpers.twitch_client.post")
     def test_token_refresh_request(self, mock_post):
         """Tests token refresh request."""
 
@@ -405,9 +707,14 @@ class TwitchHelpersTestCase(TestCase):
         """Tests processing a refresh token when receiving a bad response."""
         response = mock.Mock()
         response.status_code = 400
+        token = mock.Mock(spec=m.TwitchToken, refresh_failures=0)
+        user = mock.Mock(spec=m.User, twitch_token=token, user_id=4)
         # Case 2: Reponse status is not OK
         self.assertIsNone(twitch_helpers.process_refresh_token_response(
-                response, self.user))
+                response, user))
+        # Case 3: The token backs off for its first failed refresh.
+        token.mark_refresh_failed.assert_called_once_with(
+            twitch_helpers.refresh_retry_seconds(1))
 
     @mock.patch("twitch_helpers.send_refresh_token_request")
     @mock.patch("twitch_helpers.process_refresh_token_response")
@@ -459,7 +766,7 @@ class TwitchHelpersTestCase(TestCase):
             twitch_helpers.create_webhooks_payload(self.user)
         )
 
-    @mock.patch("twitch_helpers.requests.post")
+    @mock.patch("twitch_helpers.twitch_client.post")
     def test_subscribe_to_user_stream_events(self, mock_post):
         """Tests sending request to subscribe to stream events for user."""
         
@@ -0,0 +1,129 @@
+"""Tests for twitch_poller."""
+from unittest import TestCase, mock
+import model as m
+import twitch_helpers
+import twitch_poller
+
+
+class FakePoller(object):
+    """Answers get_many with canned responses per url."""
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    def get_many(self, requests):
+        self.requests.extend(requests)
+        return [self.responses[url].pop(0) for url, _, _ in requests]
+
+
+###############################################################################
+# TWITCH POLLER TESTS
+###############################################################################
+
+
+class TwitchPollerTestCase(TestCase):
+
+    def setUp(self):
+        """Before each test..."""
+
+        twitch_helpers.GAME_NAME_CACHE.clear()
+        twitch_helpers.STREAMER_LOGIN_CACHE.clear()
+        twitch_helpers.token_manager.clear()
+
+        twitch_token = mock.Mock(spec=m.TwitchToken,
+                                 access_token="imagreattoken",
+                                 expires_at=None)
+        self.user = mock.Mock(spec=m.User,
+                              twitch_token=twitch_token,
+                              twitch_username="pixxeltesting",
+                              twitch_id=29389795,
+                              user_id=4)
+        self.offline_user = mock.Mock(spec=m.User,
+                                      twitch_token=twitch_token,
+                                      twitch_id=1234,
+                                      user_id=5)
+
+    @mock.patch("twitch_helpers.handle_check_stream_online_failures")
+    def test_poll_twitch_streams_data(self, handle_failures):
+        """Streams, games and logins are fetched in batches and turned into
+        the same data as serialize_twitch_streams_data."""
+
+        live_row = {"id": "27739018896",
+                    "user_id": "29389795",
+                    "title": "Best stream ever!",
+                    "viewer_count": 10,
+                    "started_at": "2018-03-04T21:36:38Z",
+                    "game_id": "21779"}
+        poller = FakePoller({
+            twitch_poller.STREAMS_URL: [(200, {"data": [live_row]})],
+            twitch_poller.GAMES_URL: [
+                (200, {"data": [{"id": "21779", "name": "Celeste"}]})
+            ],
+            twitch_poller.USERS_URL: [
+                (200, {"data": [{"id": "29389795",
+                                 "login": "pixxeltesting"}]})
+            ]
+        })
+
+        all_stream_data = twitch_poller.poll_twitch_streams_data(
+            [self.user, self.offline_user], poller=poller
+        )
+
+        # Case 1: One request each for streams, games and logins.
+        self.assertEqual([url for url, _, _ in poller.requests],
+                         [twitch_poller.STREAMS_URL,
+                          twitch_poller.GAMES_URL,
+                          twitch_poller.USERS_URL])
+
+        # Case 2: Live user gets stream data, offline user gets None.
+        self.assertIsNone(all_stream_data[5])
+        handle_failures.assert_called_once_with(5)
+        stream_data = all_stream_data[4]
+        self.assertEqual(stream_data["game_name"], "Celeste")
+        self.assertEqual(stream_data["url"],
+                         "https://www.twitch.tv/pixxeltesting")
+        self.assertEqual(stream_data["viewer_count"], 10)
+
+    @mock.patch("twitch_helpers.refresh_users_token")
+    def test_poll_retries_expired_token(self, refresh_token):
+        """A batch answered with 401 is retried once with a new token."""
+
+        poller = FakePoller({
+            twitch_poller.STREAMS_URL: [(401, None), (200, {"data": []})]
+        })
+
+        with mock.patch("twitch_helpers.handle_check_stream_online_failures"):
+            all_stream_data = twitch_poller.poll_twitch_streams_data(
+                [self.offline_user], poller=poller
+            )
+
+        refresh_token.assert_called_once_with(self.offline_user)
+        self.assertEqual(all_stream_data, {5: None})
+
+    @mock.patch("twitch_helpers.refresh_users_token")
+    @mock.patch("twitch_helpers.handle_check_stream_online_failures")
+    @mock.patch("twitch_helpers.get_streams_info")
+    def test_poll_skips_revoked_token(self, get_streams_info, handle_failures,
+                                      refresh_token):
+        """A batch whose token can't be refreshed is sent again without
+        that user instead of being skipped."""
+
+        refresh_token.return_value = None
+        get_streams_info.return_value = mock.Mock(
+            status_code=200, **{"json.return_value": {"data": []}})
+        poller = FakePoller({twitch_poller.STREAMS_URL: [(401, None)]})
+
+        all_stream_data = twitch_poller.poll_twitch_streams_data(
+            [self.user, self.offline_user], poller=poller
+        )
+
+        get_streams_info.assert_called_once_with([self.offline_user])
+        self.assertEqual([call[0][0] for call in
+                          handle_failures.call_args_list], [4, 5])
+        self.assertEqual(all_stream_data, {5: None})
+
+
+if __name__ == "__main__":
+    import unittest
+    unittest.main()
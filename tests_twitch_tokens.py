@@ -0,0 +1,107 @@
+"""Tests for twitch_tokens."""
+from unittest import TestCase, mock
+import time
+import datetime
+import threading
+from twitch_tokens import (TwitchTokenManager, refresh_retry_seconds,
+                           MAX_REFRESH_RETRY_SECONDS)
+
+
+###############################################################################
+# TWITCH TOKEN TESTS
+###############################################################################
+
+
+class TwitchTokenManagerTestCase(TestCase):
+    """Tests TwitchTokenManager methods."""
+
+    def setUp(self):
+        """Before each test..."""
+
+        self.refreshes = 0
+        self.release = threading.Event()
+        self.release.set()
+        self.manager = TwitchTokenManager(self.fake_refresh)
+
+        in_an_hour = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        self.user = mock.Mock(user_id=4,
+                              twitch_token=mock.Mock(access_token="old",
+                                                     expires_at=in_an_hour,
+                                                     next_refresh_at=None))
+
+    def fake_refresh(self, user):
+        """Stands in for the Twitch refresh request."""
+
+        self.release.wait(5)
+        self.refreshes += 1
+        return mock.Mock(access_token="new{}".format(self.refreshes),
+                         expires_at=datetime.datetime.utcnow() +
+                         datetime.timedelta(hours=4))
+
+    def test_get_access_token(self):
+        """Tokens are read from the user once, then from memory."""
+
+        self.assertEqual(self.manager.get_access_token(self.user), "old")
+        self.user.twitch_token = None
+        self.assertEqual(self.manager.get_access_token(self.user), "old")
+        self.assertEqual(self.refreshes, 0)
+
+        # Case 2: After a refresh the new token is used.
+        self.assertEqual(self.manager.refresh(self.user), "new1")
+        self.assertEqual(self.manager.get_access_token(self.user), "new1")
+
+    def test_expiring_token_is_refreshed(self):
+        """A token about to expire is refreshed before it's used."""
+
+        self.user.twitch_token.expires_at = datetime.datetime.utcnow()
+        self.assertEqual(self.manager.get_access_token(self.user), "new1")
+        self.assertEqual(self.refreshes, 1)
+
+    def test_backing_off_token_is_not_refreshed(self):
+        """A token whose last refresh failed isn't refreshed on use until
+        its retry is due."""
+
+        now = datetime.datetime.utcnow()
+        self.user.twitch_token.expires_at = now
+        self.user.twitch_token.next_refresh_at = now + \
+            datetime.timedelta(minutes=5)
+        self.assertEqual(self.manager.get_access_token(self.user), "old")
+        self.assertIsNone(self.manager.refresh(self.user))
+        self.assertEqual(self.refreshes, 0)
+
+        # Case 2: Once the retry is due, the token is refreshed on use.
+        self.manager.invalidate(self.user.user_id)
+        self.user.twitch_token.next_refresh_at = now
+        self.assertEqual(self.manager.get_access_token(self.user), "new1")
+        self.assertEqual(self.refreshes, 1)
+
+    def test_concurrent_refreshes_are_coalesced(self):
+        """Threads refreshing the same user share one request."""
+
+        self.release.clear()
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(self.manager.refresh(self.user)))
+            for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        # Let every thread reach refresh before the first one finishes.
+        time.sleep(0.2)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.refreshes, 1)
+        self.assertEqual(results, ["new1"] * 5)
+
+    def test_refresh_retry_seconds(self):
+        """Failed refreshes back off exponentially, up to a cap."""
+
+        self.assertEqual([refresh_retry_seconds(failures)
+                          for failures in (1, 2, 3)], [300, 600, 1200])
+        self.assertEqual(refresh_retry_seconds(20), MAX_REFRESH_RETRY_SECONDS)
+
+
+if __name__ == "__main__":
+    import unittest
+    unittest.main()
@@ -0,0 +1,119 @@
+"""Tests for webhook_queue."""
+from unittest import TestCase
+import time
+import threading
+from webhook_queue import WebhookQueue
+
+
+###############################################################################
+# WEBHOOK QUEUE TESTS
+###############################################################################
+
+
+class WebhookQueueTestCase(TestCase):
+    """Tests WebhookQueue methods."""
+
+    def setUp(self):
+        """Before each test..."""
+
+        self.processed = []
+        self.release = threading.Event()
+        self.webhooks = WebhookQueue(self.fake_process, workers=1,
+                                     max_queue=2)
+
+    def tearDown(self):
+        """After each test..."""
+
+        self.release.set()
+        self.webhooks.stop()
+
+    def fake_process(self, user_id, body_json, body_raw, signature):
+        """Stands in for server.process_webhook_request."""
+
+        self.release.wait(5)
+        self.processed.append((user_id, body_json))
+
+    def test_duplicates_and_full_queue(self):
+        """Repeats are dropped and a full queue refuses notifications."""
+
+        online = {"data": [{"id": "1"}]}
+        offline = {"data": []}
+
+        # Case 1: The worker holds the first notification; a repeat of it
+        # is a duplicate.
+        self.assertTrue(self.webhooks.submit(4, online, b"", "sig"))
+        while self.webhooks.depth():
+            time.sleep(0.01)
+        self.assertTrue(self.webhooks.submit(4, online, b"", "sig"))
+        self.assertEqual(self.webhooks.duplicates, 1)
+
+        # Case 2: Two more fill the queue; the next is refused.
+        self.assertTrue(self.webhooks.submit(4, offline, b"", "sig"))
+        self.assertTrue(self.webhooks.submit(5, online, b"", "sig"))
+        self.assertFalse(self.webhooks.submit(6, online, b"", "sig"))
+        self.assertEqual(self.webhooks.stats()["rejected"], 1)
+
+        # Case 3: Everything accepted is processed once, in order.
+        self.release.set()
+        self.webhooks.stop()
+        self.assertEqual(self.processed,
+                         [(4, online), (4, offline), (5, online)])
+        stats = self.webhooks.stats()
+        self.assertEqual(stats["depth"], 0)
+        self.assertEqual(stats["processed"], 3)
+
+        # Case 4: The state a user is already in is a duplicate.
+        self.assertTrue(self.webhooks.submit(4, offline, b"", "sig"))
+        self.assertEqual(self.webhooks.duplicates, 2)
+
+
+    def test_users_keep_their_order(self):
+        """A user's notifications are processed in the order they came,
+        even with several workers."""
+
+        self.release.set()
+        webhooks = WebhookQueue(self.fake_process, workers=3, max_queue=60)
+        self.assertIs(webhooks.worker_queue(4), webhooks.worker_queue(4))
+
+        submitted = {4: [], 5: []}
+        for stream_id in range(10):
+            for user_id in submitted:
+                body_json = {"data": [{"id": str(stream_id)}]}
+                submitted[user_id].append(body_json)
+                self.assertTrue(webhooks.submit(user_id, body_json, b"",
+                                                "sig"))
+        webhooks.stop()
+
+        for user_id, bodies in submitted.items():
+            self.assertEqual([body_json for processed_id, body_json
+                              in self.processed if processed_id == user_id],
+                             bodies)
+
+
+    def test_duplicates_expire(self):
+        """A repeat of a processed notification is accepted again once it
+        can no longer be a redelivery."""
+
+        self.release.set()
+        webhooks = WebhookQueue(self.fake_process, workers=1,
+                                duplicate_seconds=0.05)
+        online = {"data": [{"id": "1"}]}
+
+        webhooks.submit(4, online, b"", "sig")
+        while webhooks.stats()["processed"] < 1:
+            time.sleep(0.01)
+        webhooks.submit(4, online, b"", "sig")
+        self.assertEqual(webhooks.duplicates, 1)
+
+        # Case 2: After the window, e.g. once a false offline closed the
+        # session, the same stream starts fetching again.
+        time.sleep(0.1)
+        webhooks.submit(4, online, b"", "sig")
+        webhooks.stop()
+        self.assertEqual(webhooks.duplicates, 1)
+        self.assertEqual(self.processed, [(4, online), (4, online)])
+
+
+if __name__ == "__main__":
+    import unittest
+    unittest.main()
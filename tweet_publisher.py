@@ -0,0 +1,212 @@
+"""Publisher workers that drain the tweet outbox."""
+
+import os
+import time
+import atexit
+import threading
+import tweepy
+from model import db, TweetOutbox
+
+PUBLISHER_THREADS = int(os.environ.get("TWEET_PUBLISHER_THREADS", 4))
+
+# Twitter allows 300 tweets per account every 3 hours.
+ACCOUNT_TWEET_LIMIT = int(os.environ.get("TWEETS_PER_ACCOUNT_LIMIT", 300))
+ACCOUNT_LIMIT_SECONDS = 3 * 60 * 60
+
+# Twitter error codes that won't succeed on retry:
+# 186 status too long, 187 duplicate status, 326 account locked.
+PERMANENT_ERROR_CODES = {186, 187, 326}
+
+
+def error_codes(error):
+    """Return a TweepError's Twitter error codes as a list of ints.
+    tweepy reports api_code as a single code, a list of codes, or a list
+    of {"code": ...} errors."""
+
+    api_code = error.api_code
+    if api_code is None:
+        return []
+    if not isinstance(api_code, (list, tuple)):
+        api_code = [api_code]
+
+    codes = []
+    for code in api_code:
+        if isinstance(code, dict):
+            code = code.get("code")
+        try:
+            codes.append(int(code))
+        except (TypeError, ValueError):
+            continue
+    return codes
+
+
+class AccountRateLimiter(object):
+    """Token bucket per account: up to capacity tweets at once, refilled
+    at capacity per period seconds."""
+
+    def __init__(self, capacity=ACCOUNT_TWEET_LIMIT,
+                 period=ACCOUNT_LIMIT_SECONDS, clock=time.monotonic):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.clock = clock
+        # user_id -> (tokens, updated_at)
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, user_id):
+        """Take a token for user_id. Returns 0 if one was taken, otherwise
+        the number of seconds until one is available."""
+
+        with self._lock:
+            now = self.clock()
+            tokens, updated_at = self._buckets.get(user_id,
+                                                   (self.capacity, now))
+            tokens = min(self.capacity,
+                         tokens + (now - updated_at) * self.rate)
+
+            if tokens >= 1:
+                self._buckets[user_id] = (tokens - 1, now)
+                return 0
+
+            self._buckets[user_id] = (tokens, now)
+            return (1 - tokens) / self.rate
+
+    def block_until(self, user_id, seconds):
+        """Empty user_id's bucket, e.g. after Twitter answers 429."""
+
+        with self._lock:
+            now = self.clock()
+            self._buckets[user_id] = (-seconds * self.rate, now)
+
+
+class TweetPublisher(object):
+    """Pool of threads that claim due tweets from the outbox and post them
+    with send(item), which returns the SentTweet or raises TweepError.
+
+    Failed tweets are retried with exponential backoff up to max_attempts.
+    Several processes can run publishers against the same outbox."""
+
+    def __init__(self, send, threads=PUBLISHER_THREADS, batch_size=5,
+                 poll_seconds=5, lease_seconds=120, max_attempts=5,
+                 retry_seconds=30, limiter=None):
+        self.send = send
+        self.threads = threads
+        self.batch_size = batch_size
+        self.poll_seconds = poll_seconds
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+        self.limiter = limiter or AccountRateLimiter()
+        self.app = None
+        self.tweets_sent = 0
+        self._count_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._workers = []
+
+    def start(self, app):
+        """Start the publisher threads for app."""
+
+        self.app = app
+        if any(worker.is_alive() for worker in self._workers):
+            return
+        self._stopped.clear()
+        self._workers = [threading.Thread(target=self._run,
+                                          name="tweet-publisher-{}"
+                                          .format(index),
+                                          daemon=True)
+                         for index in range(self.threads)]
+        for worker in self._workers:
+            worker.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Stop the publisher threads after their current batch.
+        Anything left in the outbox is sent on the next start."""
+
+        self._stopped.set()
+        self._wakeup.set()
+        for worker in self._workers:
+            worker.join(timeout=30)
+        self._workers = []
+
+    def wake(self):
+        """Check the outbox now rather than at the next poll."""
+
+        self._wakeup.set()
+
+    def publish_due(self):
+        """Claim and post one batch of due tweets. Call within an app
+        context. Returns the number of tweets posted."""
+
+        items = TweetOutbox.claim_due(self.batch_size, self.lease_seconds)
+        sent = 0
+        for item in items:
+            if self._publish(item):
+                sent += 1
+
+        with self._count_lock:
+            self.tweets_sent += sent
+        return sent
+
+    def _publish(self, item):
+        """Post a claimed tweet and record the outcome."""
+
+        wait = self.limiter.acquire(item.user_id)
+        if wait:
+            item.defer(wait)
+            return False
+
+        try:
+            sent_tweet = self.send(item)
+        except tweepy.TweepError as error:
+            self._handle_error(item, error)
+            return False
+        except Exception as e:
+            db.session.rollback()
+            item.mark_failed(str(e), self._backoff(item))
+            return False
+
+        item.mark_sent(sent_tweet)
+        return True
+
+    def _handle_error(self, item, error):
+        """Retry, defer or give up on a tweet Twitter didn't accept."""
+
+        response = error.response
+        status_code = response.status_code if response is not None else None
+
+        if status_code == 429:
+            reset = response.headers.get("x-rate-limit-reset")
+            wait = max(int(reset) - time.time(), 1) if reset \
+                else ACCOUNT_LIMIT_SECONDS / 12
+            self.limiter.block_until(item.user_id, wait)
+            item.defer(wait)
+        elif (status_code in (401, 403) or
+              PERMANENT_ERROR_CODES.intersection(error_codes(error))):
+            item.mark_failed(error.reason)
+        else:
+            item.mark_failed(error.reason, self._backoff(item))
+
+    def _backoff(self, item):
+        """Seconds until the next attempt, or None to give up."""
+
+        if item.attempts >= self.max_attempts:
+            return None
+        return self.retry_seconds * 2 ** (item.attempts - 1)
+
+    def _run(self):
+        """Drain the outbox until stopped, waiting between empty polls."""
+
+        while not self._stopped.is_set():
+            try:
+                with self.app.app_context():
+                    sent = self.publish_due()
+            except Exception as e:
+                print("Tweet publisher error: {}".format(e))
+                sent = 0
+
+            # Keep going while there's a backlog.
+            if not sent:
+                self._wakeup.wait(self.poll_seconds)
+                self._wakeup.clear()
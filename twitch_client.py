@@ -0,0 +1,167 @@
+"""Shared, pooled HTTP client for Twitch API calls."""
+
+import os
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Connections kept open per host. APScheduler's default pool has 10 threads,
+# so size the api.twitch.tv pool a little above that.
+API_POOL_SIZE = int(os.environ.get("TWITCH_API_POOL_SIZE", 20))
+ID_POOL_SIZE = int(os.environ.get("TWITCH_ID_POOL_SIZE", 4))
+
+# (connect, read) timeouts in seconds.
+DEFAULT_TIMEOUT = (3.05, 10)
+
+HELIX_URL = "https://api.twitch.tv/helix/"
+
+# Helix allows this many requests per minute, refilled continuously.
+RATE_LIMIT = int(os.environ.get("TWITCH_RATE_LIMIT", 800))
+RATE_LIMIT_WINDOW = 60
+# Requests that may go out at once. Anything past this is paced at the
+# refill rate, so jobs firing together don't empty the bucket.
+RATE_LIMIT_BURST = int(os.environ.get("TWITCH_RATE_LIMIT_BURST", 100))
+
+# Lower numbers go first. A request may only use the part of the bucket
+# above its headroom, which is kept for more important requests.
+PRIORITY_CLIP = 0
+PRIORITY_STREAM = 1
+PRIORITY_LOOKUP = 2
+PRIORITY_HEADROOM = {PRIORITY_CLIP: 0,
+                     PRIORITY_STREAM: 0.1,
+                     PRIORITY_LOOKUP: 0.25}
+
+# Times a request answered with 429 is queued again before giving up.
+RATE_LIMITED_RETRIES = 3
+
+
+def priority_for(url):
+    """Clip requests go before stream status, which goes before game and
+    user lookups."""
+
+    if url.startswith(HELIX_URL + "clips"):
+        return PRIORITY_CLIP
+    if url.startswith(HELIX_URL + "streams"):
+        return PRIORITY_STREAM
+    return PRIORITY_LOOKUP
+
+
+class RateLimiter(object):
+    """Token bucket for Helix requests, corrected by the Ratelimit-*
+    headers on each response.
+
+    Callers wait for a token rather than failing. Threads use acquire();
+    coroutines loop on try_acquire() and sleep for the time it returns."""
+
+    def __init__(self, limit=RATE_LIMIT, window=RATE_LIMIT_WINDOW,
+                 burst=RATE_LIMIT_BURST, clock=time.time):
+        self.capacity = min(burst, limit)
+        self.rate = limit / window
+        self.clock = clock
+        self.tokens = self.capacity
+        self.updated_at = clock()
+        self.blocked_until = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self, priority=PRIORITY_STREAM):
+        """Take a token if one is free at this priority. Returns 0 if one
+        was taken, otherwise the seconds to wait before trying again."""
+
+        with self._lock:
+            now = self.clock()
+            if now < self.blocked_until:
+                return self.blocked_until - now
+
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.updated_at) *
+                              self.rate)
+            self.updated_at = now
+
+            floor = self.capacity * PRIORITY_HEADROOM[priority]
+            if self.tokens - 1 >= floor:
+                self.tokens -= 1
+                return 0
+            return (floor + 1 - self.tokens) / self.rate
+
+    def acquire(self, priority=PRIORITY_STREAM):
+        """Block until a token is free at this priority."""
+
+        wait = self.try_acquire(priority)
+        while wait:
+            time.sleep(wait)
+            wait = self.try_acquire(priority)
+
+    def update(self, headers, status_code=None):
+        """Sync the bucket with Twitch's Ratelimit-* response headers."""
+
+        remaining = headers.get("Ratelimit-Remaining")
+        reset = headers.get("Ratelimit-Reset")
+        with self._lock:
+            if remaining is not None:
+                # Twitch counts requests from every process on this
+                # client id; trust it when it has fewer tokens than we do.
+                self.tokens = min(self.tokens, int(remaining))
+            if reset is not None and (status_code == 429 or
+                                      remaining == "0"):
+                self.blocked_until = max(self.blocked_until, int(reset))
+
+
+class TwitchClient(object):
+    """Keep-alive session for Twitch with per-host pools, timeouts and
+    retries with backoff."""
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, limiter=None):
+        self.timeout = timeout
+        self.limiter = limiter or RateLimiter()
+        self.session = requests.Session()
+
+        # Only idempotent requests are retried automatically; creating a
+        # clip twice would make two clips.
+        retries = Retry(total=3,
+                        backoff_factor=0.5,
+                        status_forcelist=(500, 502, 503, 504),
+                        method_whitelist=frozenset(["GET"]),
+                        raise_on_status=False)
+
+        self.session.mount("https://api.twitch.tv/",
+                           HTTPAdapter(pool_connections=1,
+                                       pool_maxsize=API_POOL_SIZE,
+                                       max_retries=retries))
+        self.session.mount("https://id.twitch.tv/",
+                           HTTPAdapter(pool_connections=1,
+                                       pool_maxsize=ID_POOL_SIZE,
+                                       max_retries=retries))
+
+    def request(self, method, url, **kwargs):
+        """Send a request through the pooled session with a timeout.
+        Helix requests wait for the rate limiter, and are queued again
+        when Twitch answers 429."""
+
+        kwargs.setdefault("timeout", self.timeout)
+        if not url.startswith(HELIX_URL):
+            return self.session.request(method, url, **kwargs)
+
+        priority = priority_for(url)
+        for _ in range(RATE_LIMITED_RETRIES + 1):
+            self.limiter.acquire(priority)
+            response = self.session.request(method, url, **kwargs)
+            self.limiter.update(response.headers, response.status_code)
+            if response.status_code != 429:
+                break
+            print("Twitch rate limit reached; queueing {}.".format(url))
+        return response
+
+    def get(self, url, **kwargs):
+        """Send a GET request."""
+
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        """Send a POST request."""
+
+        return self.request("POST", url, **kwargs)
+
+
+twitch_client = TwitchClient()
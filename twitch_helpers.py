@@ -2,11 +2,17 @@
 
 from datetime import datetime
 import os
-import time
 import hashlib
 import hmac
 import requests
-from model import StreamSession, TwitchClip, User
+from sqlalchemy import event
+from cache_helpers import TTLCache
+from twitch_client import twitch_client
+from twitch_tokens import TwitchTokenManager, refresh_retry_seconds
+from failure_counters import create_counter
+from live_sessions import LiveSessionRegistry
+from model import (FailureCount, StreamDatum, StreamSession, TwitchClip,
+                   TwitchToken, User)
 import apscheduler_handlers as ap_handlers
 
 
@@ -28,14 +34,36 @@ try:
 except KeyError:
     print("Please set the environment variables.")
 
-# Stores user_id and corresponding number of failures.
-CHECK_STREAM_ONLINE_FAILURES = {}
-TWITCH_API_FAILURES = {}
+# Counts consecutive offline checks per user_id.
+CHECK_STREAM_ONLINE_FAILURES = create_counter("check_stream_online",
+                                              FailureCount)
+
+# Maximum number of ids Helix accepts in a single request.
+HELIX_MAX_IDS = 100
+
+# Game names rarely change, so keep them around for a day.
+GAME_NAME_CACHE = TTLCache(maxsize=5000, ttl=24 * 60 * 60)
+
+# Streamer logins keyed by Twitch ID. Logins can be renamed, so entries go
+# stale after TWITCH_LOGIN_CACHE_SECONDS (default six hours).
+LOGIN_CACHE_SECONDS = int(os.environ.get("TWITCH_LOGIN_CACHE_SECONDS",
+                                         6 * 60 * 60))
+STREAMER_LOGIN_CACHE = TTLCache(maxsize=20000, ttl=LOGIN_CACHE_SECONDS)
+
+# Latest stream data per user_id written by the fetch_data job. Snapshots
+# older than a little over one fetch interval are considered stale.
+SNAPSHOT_MAX_AGE = 90
+STREAM_SNAPSHOTS = TTLCache(maxsize=20000, ttl=SNAPSHOT_MAX_AGE)
+
+# The session each live user is on, so polls of a known stream only append
+# data. Reloaded from open sessions before each batched poll writes, and by
+# apscheduler_handlers.sync_engine_tasks.
+LIVE_SESSIONS = LiveSessionRegistry()
 
 
 def create_header(user):
     """Creates a header for Twitch API calls."""
-    token = user.twitch_token.access_token
+    token = token_manager.get_access_token(user)
     header = {"Authorization": "Bearer {}".format(token)}
     return header
 
@@ -43,26 +71,35 @@ def create_header(user):
 def is_twitch_online(user):
     """Check if user's Twitch stream is live."""
 
-    user_id = user.user_id
+    try:
+        stream_data = request_stream_info(user)
+    except Unauthorized as e:
+        # Still rejected after a refresh; count it like an offline check.
+        print(e)
+        handle_check_stream_online_failures(user.user_id)
+        return False
+    except Exception as e:
+        print(e)
+        return False
+
+    # If stream_data has contents, the user is streaming.
+    return bool(stream_data)
+
+
+def request_stream_info(user):
+    """Get the Helix streams data for user. If the token is rejected, it's
+    refreshed and the request sent once more. Rate limits are handled by
+    twitch_client, which queues requests rather than failing them."""
+
     response = get_stream_info(user)
-    while TWITCH_API_FAILURES.get(user_id, 0) < 2:
-        try:
-            check_response_status(response, user)
-            stream_data = response.json().get("data")
-            # If stream_data has contents, the user is streaming.
-            if stream_data:
-                return True
-            # Otherwise, the stream is offline.
-            return False
-        except Unauthorized as e:
-            # If there are too many failures, stop retrying.
-            if handle_check_stream_online_failures(user_id):
-                return
-            print(e)
-            refresh_users_token(user)
-        except Exception as e:
-            print(e)
-            return False
+    try:
+        check_response_status(response, user)
+    except Unauthorized as e:
+        print(e)
+        refresh_users_token(user)
+        response = get_stream_info(user)
+        check_response_status(response, user)
+    return response.json().get("data")
 
 
 def check_response_status(response, user):
@@ -72,7 +109,6 @@ def check_response_status(response, user):
 
     if status_code == 200:
         print("Response OK.")
-        reset_twitch_api_fail_counter(user)
         return True
     elif status_code == 401:
         # TODO: Create custom exception
@@ -83,12 +119,6 @@ def check_response_status(response, user):
                         .format(status_code))
 
 
-def reset_twitch_api_fail_counter(user):
-    """Resets the Twitch API failure counter for user."""
-    user_id = user.user_id
-    TWITCH_API_FAILURES[user_id] = 0
-
-
 def get_stream_info(user):
     """Get user's stream info from Twitch API."""
 
@@ -97,86 +127,213 @@ def get_stream_info(user):
                        "first": 1,
                        "type": "live"}
 
-    response = requests.get("https://api.twitch.tv/helix/streams",
-                            params=payload_streams,
-                            headers=create_header(user))
+    response = twitch_client.get("https://api.twitch.tv/helix/streams",
+                                 params=payload_streams,
+                                 headers=create_header(user))
     return response
 
 
+def get_streams_info(users):
+    """Get stream info for a batch of up to 100 users from Twitch API."""
+
+    # Any user's token can be used to read public stream info.
+    response = twitch_client.get("https://api.twitch.tv/helix/streams",
+                                 params=create_streams_payload(users),
+                                 headers=create_header(users[0]))
+    return response
+
+
+def create_streams_payload(users):
+    """Creates the query for a batch of up to 100 users' live streams."""
+
+    payload_streams = [("user_id", str(user.twitch_id)) for user in users]
+    payload_streams.append(("first", str(HELIX_MAX_IDS)))
+    payload_streams.append(("type", "live"))
+    return payload_streams
+
+
+def chunk_list(items, size=HELIX_MAX_IDS):
+    """Splits a list into lists of at most size items."""
+
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
 def serialize_twitch_stream_data(user):
     """Get Twitch stream data for user's stream."""
     user_id = user.user_id
-    response = get_stream_info(user)
-    print(response.status_code)
 
-    while TWITCH_API_FAILURES.get(user_id, 0) < 2:
+    try:
+        all_stream_data = request_stream_info(user)
+    except Unauthorized as e:
+        # Still rejected after a refresh; count it like an offline check.
+        print(e)
+        handle_check_stream_online_failures(user_id)
+        return None
+    except Exception as e:
+        print(str(e))
+        return None
+
+    # If the stream is offline, data will be an empty array.
+    if not all_stream_data:
+        handle_check_stream_online_failures(user_id)
+        return None
+
+    try:
+        # If the stream is live...
+        stream_data = create_stream_data(all_stream_data[0], user)
+    except Exception as e:
+        print(str(e))
+        return None
+    # Reset stream failures counter to 0
+    CHECK_STREAM_ONLINE_FAILURES.reset(user_id)
+
+    return stream_data
+
+
+def serialize_twitch_streams_data(users):
+    """Get Twitch stream data for many users' streams.
+
+    Sends one request per batch of up to 100 users. Returns a dictionary
+    of user_id to stream data; offline users map to None. Users in a batch
+    that could not be fetched are left out."""
+
+    all_stream_data = {}
+
+    for batch in chunk_list(users):
+        try:
+            batch, rows = request_streams_info(batch)
+        except Exception as e:
+            print(str(e))
+            continue
+        if not batch:
+            continue
+
+        # Resolve every game and login in the batch at once so rows hit
+        # the caches.
         try:
-            check_response_status(response, user)
-            all_stream_data = response.json().get("data")
-            # If the stream is offline, data will be an empty array.
-            if not all_stream_data:
-                # We want to increment failure counter.
-                # Define a seperate function to handle that.
-                handle_check_stream_online_failures(user_id)
-                return None
-
-            # If the stream is live...
-            # print("Stream data: {}".format(all_stream_data))
-            all_stream_data = all_stream_data[0]
-            timestamp = datetime.utcnow()
-            stream_id = all_stream_data.get("id")
-            streamer_id = all_stream_data.get("user_id")
-            stream_title = all_stream_data.get("title")
-            stream_viewer_count = all_stream_data.get("viewer_count")
-            stream_started_at = all_stream_data.get("started_at")
-            stream_game_id = all_stream_data.get("game_id")
-
-            # Helper function to get game info
-            stream_game_title = get_twitch_game_data(stream_game_id, user)
-            # Helper function to construct stream url
-            stream_url = create_stream_url(streamer_id, user)
-            # Convert started_at str to datetime
-            datetime_format = "%Y-%m-%dT%H:%M:%SZ"
-            stream_started_at = datetime.strptime(stream_started_at,
-                                                  datetime_format)
-
-            stream_data = {"timestamp": timestamp,
-                           "stream_id": stream_id,
-                           "twitch_id": streamer_id,
-                           "stream_title": stream_title,
-                           "viewer_count": stream_viewer_count,
-                           "started_at": stream_started_at,
-                           "game_id": stream_game_id,
-                           "game_name": stream_game_title,
-                           "url": stream_url}
-            # Reset stream failures counter to 0
-            CHECK_STREAM_ONLINE_FAILURES[user_id] = 0
-
-            return stream_data
-        
+            get_twitch_games_data([row.get("game_id") for row in rows],
+                                  batch[0])
+        except requests.RequestException as e:
+            # Rows fall back to cached names, or none.
+            print("Game lookup failed: {}".format(e))
+        try:
+            refresh_twitch_logins(get_live_users(batch, rows))
+        except requests.RequestException as e:
+            # Rows fall back to cached logins, or no URL.
+            print("Login lookup failed: {}".format(e))
+
+        all_stream_data.update(create_streams_data(batch, rows))
+
+    return all_stream_data
+
+
+def request_streams_info(users):
+    """Get the Helix streams data for a batch of users, sent with the first
+    user's token. If the token is rejected, it's refreshed and the request
+    sent once more. A user whose token is still rejected is counted like an
+    offline check and the rest of the batch is sent with the next user's
+    token. Returns the users that were fetched and their streams rows."""
+
+    users = list(users)
+    refreshed = False
+    while users:
+        response = get_streams_info(users)
+        try:
+            check_response_status(response, users[0])
         except Unauthorized as e:
-            # If there are too many failures, stop retrying.
-            if handle_check_stream_online_failures(user.user_id):
-                return None
             print(e)
-            refresh_users_token(user)
-
+            if not refreshed and refresh_users_token(users[0]):
+                refreshed = True
+            else:
+                handle_check_stream_online_failures(users[0].user_id)
+                users = users[1:]
+                refreshed = False
+            continue
+        return users, response.json().get("data") or []
+    return users, []
+
+
+def get_live_users(users, rows):
+    """Get the users that have a row in a Helix streams response."""
+
+    live_twitch_ids = {row.get("user_id") for row in rows}
+    return [user for user in users if str(user.twitch_id) in live_twitch_ids]
+
+
+def create_streams_data(users, rows):
+    """Creates stream data for a batch of users from their Helix streams
+    rows. Returns a dictionary of user_id to stream data; offline users map
+    to None."""
+
+    rows_by_twitch_id = {row.get("user_id"): row for row in rows}
+    all_stream_data = {}
+
+    for user in users:
+        row = rows_by_twitch_id.get(str(user.twitch_id))
+        # If the user is missing from the response, they are offline.
+        if not row:
+            handle_check_stream_online_failures(user.user_id)
+            all_stream_data[user.user_id] = None
+            continue
+        try:
+            all_stream_data[user.user_id] = create_stream_data(row, user)
         except Exception as e:
             print(str(e))
-            return None
+
+    # Reset stream failure counters for every live user at once.
+    CHECK_STREAM_ONLINE_FAILURES.reset_many(
+        [user.user_id for user in users
+         if all_stream_data.get(user.user_id)])
+
+    return all_stream_data
+
+
+def create_stream_data(stream_row, user):
+    """Creates a dictionary of stream data from a Helix streams entry."""
+
+    timestamp = datetime.utcnow()
+    stream_id = stream_row.get("id")
+    streamer_id = stream_row.get("user_id")
+    stream_title = stream_row.get("title")
+    stream_viewer_count = stream_row.get("viewer_count")
+    stream_started_at = stream_row.get("started_at")
+    stream_game_id = stream_row.get("game_id")
+
+    # Helper function to get game info
+    stream_game_title = get_twitch_game_data(stream_game_id, user)
+    # Helper function to construct stream url
+    stream_url = create_stream_url(streamer_id, user)
+    # Convert started_at str to datetime
+    datetime_format = "%Y-%m-%dT%H:%M:%SZ"
+    stream_started_at = datetime.strptime(stream_started_at,
+                                          datetime_format)
+
+    stream_data = {"timestamp": timestamp,
+                   "stream_id": stream_id,
+                   "twitch_id": streamer_id,
+                   "stream_title": stream_title,
+                   "viewer_count": stream_viewer_count,
+                   "started_at": stream_started_at,
+                   "game_id": stream_game_id,
+                   "game_name": stream_game_title,
+                   "url": stream_url}
+    return stream_data
 
 
 def handle_check_stream_online_failures(user_id):
     """Handles stream offline events."""
 
-    CHECK_STREAM_ONLINE_FAILURES[user_id] = CHECK_STREAM_ONLINE_FAILURES.get(user_id, 0) + 1
-    stream_failures = CHECK_STREAM_ONLINE_FAILURES[user_id]
+    # Don't tweet from the last snapshot of a stream that may be over.
+    STREAM_SNAPSHOTS.invalidate(user_id)
+
+    # Atomic, so only one thread or process sees the second failure.
+    stream_failures = CHECK_STREAM_ONLINE_FAILURES.increment(user_id)
 
     if stream_failures > 1:
         print("User's {} stream is offline! \
               Ending session and jobs.".format(user_id))
         # Reset failure counter.
-        CHECK_STREAM_ONLINE_FAILURES[user_id] = 0
+        CHECK_STREAM_ONLINE_FAILURES.reset(user_id)
 
         ap_handlers.stop_fetching_twitch_data(user_id)
         print("\n\nENDED STREAM DATA FETCH.\n\n")
@@ -190,108 +347,254 @@ def handle_check_stream_online_failures(user_id):
         return False
 
 
-def write_twitch_stream_data(user, stream_data):
-    """Write stream data to db."""
-    StreamSession.save_stream_session(user, stream_data)
+def write_twitch_stream_data(user, stream_data, writer=None):
+    """Write stream data to db, through writer's buffer if given.
+    Also keeps it as the user's latest snapshot for composing tweets."""
+
+    live_session = LIVE_SESSIONS.get_current(user.user_id,
+                                             stream_data["stream_id"])
+    if live_session:
+        # Same stream as the last poll; only the data point is new.
+        if writer:
+            writer.add(StreamDatum.create_row(live_session.stream_id,
+                                              stream_data))
+        else:
+            StreamDatum.save_stream_data(live_session, stream_data)
+        live_session.update(stream_data)
+    else:
+        stream_session = StreamSession.save_stream_session(user, stream_data,
+                                                           writer=writer)
+        LIVE_SESSIONS.open(user.user_id, stream_session.stream_id,
+                           stream_session.twitch_session_id, stream_data)
+    STREAM_SNAPSHOTS.set(user.user_id, stream_data)
+
+
+def get_latest_stream_data(user):
+    """Get the user's latest stream data, from the fetch job's snapshot if
+    it's fresh, otherwise from Twitch."""
+
+    stream_data = STREAM_SNAPSHOTS.get(user.user_id)
+    if stream_data is not None:
+        return stream_data
+    return serialize_twitch_stream_data(user)
 
 
 def create_stream_url(twitch_id, user):
     """Construct a URL to Twitch stream for given twitch id.
-    Purposefully pulls current Twitch user data in case stored username
-    is out of date."""
+    Pulls current Twitch user data when the cached login is stale in case
+    stored username is out of date."""
 
-    # TODO: When this is triggered, also update stored value in db?
+    user_name = STREAMER_LOGIN_CACHE.get(str(twitch_id))
 
-    payload = {"id": twitch_id}
-    r_users = requests.get("https://api.twitch.tv/helix/users",
-                           params=payload,
-                           headers=create_header(user))
+    if user_name is None:
+        payload = {"id": twitch_id}
+        try:
+            r_users = twitch_client.get("https://api.twitch.tv/helix/users",
+                                        params=payload,
+                                        headers=create_header(user))
+        except requests.RequestException as e:
+            print("Login lookup failed: {}".format(e))
+            return None
 
-    # If OK response received, store Twitch username.
-    if r_users.status_code == 200:
-        user_name = r_users.json().get("data")[0].get("login")
-    else:
-        return None
+        # If OK response received, store Twitch username.
+        if r_users.status_code == 200:
+            user_name = r_users.json().get("data")[0].get("login")
+        else:
+            return None
+        store_twitch_login(twitch_id, user_name, user)
 
     url = "https://www.twitch.tv/{}".format(user_name)
     return url
 
 
+def store_twitch_login(twitch_id, login, user):
+    """Caches a freshly fetched login, updating the db if it changed."""
+
+    STREAMER_LOGIN_CACHE.set(str(twitch_id), login)
+
+    if str(user.twitch_id) == str(twitch_id) and \
+            user.twitch_username != login:
+        print("User {}'s Twitch login changed to {}.".format(user.user_id,
+                                                             login))
+        user.update_twitch_username(login)
+
+
+def refresh_twitch_logins(users):
+    """Fetches logins for users whose cached login is stale.
+    Sends one /helix/users request per batch of up to 100 users."""
+
+    users_by_twitch_id = {str(user.twitch_id): user for user in users}
+    stale_ids = STREAMER_LOGIN_CACHE.missing(list(users_by_twitch_id))
+
+    for batch in chunk_list(stale_ids):
+        payload = [("id", twitch_id) for twitch_id in batch]
+        r_users = twitch_client.get("https://api.twitch.tv/helix/users",
+                                    params=payload,
+                                    headers=create_header(
+                                        users_by_twitch_id[batch[0]]))
+        if r_users.status_code != 200:
+            print("Login lookup failed. Status code: {}"
+                  .format(r_users.status_code))
+            continue
+        store_twitch_logins(r_users.json().get("data") or [],
+                            users_by_twitch_id)
+
+
+def store_twitch_logins(users_data, users_by_twitch_id):
+    """Stores the logins from a Helix users response."""
+
+    for user_data in users_data:
+        twitch_id = user_data.get("id")
+        if twitch_id in users_by_twitch_id:
+            store_twitch_login(twitch_id,
+                               user_data.get("login"),
+                               users_by_twitch_id[twitch_id])
+
+
 def get_twitch_game_data(game_id, user):
     """Sends a request to Twitch API to retrieve game info from given id."""
 
+    game_name = GAME_NAME_CACHE.get(game_id)
+    if game_name is not None:
+        return game_name
+
     payload_games = {"id": game_id}
-    r_games = requests.get("https://api.twitch.tv/helix/games",
-                           params=payload_games,
-                           headers=create_header(user))
+    try:
+        r_games = twitch_client.get("https://api.twitch.tv/helix/games",
+                                    params=payload_games,
+                                    headers=create_header(user))
+    except requests.RequestException as e:
+        print("Game lookup failed: {}".format(e))
+        return None
     # If OK response received, save game data.
     if r_games.status_code == 200:
         game_data = r_games.json().get("data")[0]
     # Otherwise return None.
     else:
         return None
-    return game_data.get("name", "")
+    game_name = game_data.get("name", "")
+    GAME_NAME_CACHE.set(game_id, game_name)
+    return game_name
+
+
+def get_twitch_games_data(game_ids, user):
+    """Resolves many game ids to names, requesting only uncached ids.
+    Returns a dictionary of game id to name for the ids that resolved."""
+
+    game_ids = list({game_id for game_id in game_ids if game_id})
+
+    for batch in chunk_list(GAME_NAME_CACHE.missing(game_ids)):
+        payload_games = [("id", game_id) for game_id in batch]
+        r_games = twitch_client.get("https://api.twitch.tv/helix/games",
+                                    params=payload_games,
+                                    headers=create_header(user))
+        if r_games.status_code != 200:
+            print("Game lookup failed. Status code: {}"
+                  .format(r_games.status_code))
+            continue
+        store_twitch_games(r_games.json().get("data") or [])
+
+    game_names = {}
+    for game_id in game_ids:
+        game_name = GAME_NAME_CACHE.get(game_id)
+        if game_name is not None:
+            game_names[game_id] = game_name
+    return game_names
+
+
+def store_twitch_games(games_data):
+    """Caches the game names from a Helix games response."""
+
+    for game_data in games_data:
+        GAME_NAME_CACHE.set(game_data.get("id"), game_data.get("name", ""))
 
 
 def generate_twitch_clip(user_id):
-    """Generate a Twitch Clip from user's channel.
-       Returns the URL and new clip object on success."""
+    """Submit a request to create a Twitch Clip from user's channel.
+       Returns the clip's slug on success. The clip is not ready until
+       confirm_twitch_clip finds it."""
 
     user = User.get_user_from_id(user_id)
     twitch_id = str(user.twitch_id)
     payload_clips = {"broadcaster_id": TEST_ID or twitch_id}  # Edit this to test
-    r_clips = requests.post("https://api.twitch.tv/helix/clips",
-                            data=payload_clips,
-                            headers=create_header(user))
+    r_clips = twitch_client.post("https://api.twitch.tv/helix/clips",
+                                 data=payload_clips,
+                                 headers=create_header(user))
     if r_clips.status_code == 202:
         # Save the clip's slug; used as `id` in Twitch API
         clip_slug = r_clips.json().get("data")[0].get("id")
-        # Send a request to Get Clips to confirm clip was created.
+        return clip_slug
+
+    print("Clip request failed. Status code: {}".format(r_clips.status_code))
+    return None
+
+
+def confirm_twitch_clip(clip_slug, user_id):
+    """Check once whether a submitted clip was created.
+       Returns the new clip object and URL once the clip exists."""
+
+    user = User.get_user_from_id(user_id)
+    clip_info = get_clip_info(clip_slug, user)
+    if clip_info:
+        # Store the url
+        url = clip_info.get("url")
+        # Save clip to DB, in the session the user is live on if known.
+        live_session = LIVE_SESSIONS.get(user_id)
+        new_clip = TwitchClip.save_twitch_clip(
+            clip_slug, user_id,
+            stream_id=live_session.stream_id if live_session else None
+        )
+        return (new_clip, url)
 
-        clip_info = get_clip_info(clip_slug, user)
-        if clip_info:
-            # Store the url
-            url = clip_info.get("url")
-            # Save clip to DB
-            new_clip = TwitchClip.save_twitch_clip(clip_slug, user_id)
-            return (new_clip, url)
-
-    # TODO: If this fails, return None.
-    # Add better error handling.
     return None, None
 
 
 def get_clip_info(clip_id, user):
-    """Use given clip id to fetch info from Twitch API."""
+    """Use given clip id to fetch info from Twitch API.
+       Returns None if the clip isn't available yet."""
 
     # Note: Twitch recommends giving the API 15 seconds to fetch a newly
-    # created clip. If 15 seconds passes and we receive nothing, we can
-    # assume that no clip was created.
-    failures = 0
+    # created clip. Callers schedule repeat checks rather than waiting here.
     payload_get_clip = {"id": clip_id}
-    while failures < 3:
-        r_get_clip = requests.get("https://api.twitch.tv/helix/clips",
-                                  params=payload_get_clip,
-                                  headers=create_header(user))
-        if r_get_clip.status_code == 200:
-            clip_info = r_get_clip.json().get("data")
-            try:
-                clip_info = clip_info[0]
-                return clip_info
-            except IndexError:
-                failures += 1
-                time.sleep(5)
+    r_get_clip = twitch_client.get("https://api.twitch.tv/helix/clips",
+                                   params=payload_get_clip,
+                                   headers=create_header(user))
+    if r_get_clip.status_code == 200:
+        clip_info = r_get_clip.json().get("data")
+        if clip_info:
+            return clip_info[0]
     return None
 
 
 def refresh_users_token(user):
-    """Refresh user's token."""
+    """Refresh user's token. Threads refreshing the same user at once share
+    one request. Returns the new access token, or None on failure."""
+
+    return token_manager.refresh(user)
+
+
+def request_new_token(user):
+    """Sends the refresh request and stores the new token."""
 
     token_response = send_refresh_token_request(user)
     new_token = process_refresh_token_response(token_response, user)
     return new_token
 
 
+# Access tokens by user_id, refreshed before they expire.
+token_manager = TwitchTokenManager(request_new_token)
+
+
+@event.listens_for(TwitchToken, "after_insert")
+@event.listens_for(TwitchToken, "after_update")
+@event.listens_for(TwitchToken, "after_delete")
+def handle_twitch_token_change(mapper, connection, token):
+    """Drop a user's cached token when it's stored, e.g. after logging in
+    again (User.update_twitch_access_token)."""
+
+    token_manager.invalidate(token.user_id)
+
+
 def send_refresh_token_request(user):
     """Sends post request to refresh user's Twitch access token."""
     refresh_token = user.twitch_token.refresh_token
@@ -303,8 +606,8 @@ def send_refresh_token_request(user):
         "refresh_token": refresh_token
     }
 
-    response = requests.post("https://id.twitch.tv/oauth2/token",
-                             data=payload)
+    response = twitch_client.post("https://id.twitch.tv/oauth2/token",
+                                  data=payload)
 
     print("Sent request to refresh user's token.")
 
@@ -318,6 +621,10 @@ def process_refresh_token_response(response, user):
         check_response_status(response, user)
     except Exception as e:
         print(str(e))
+        # Back off so the refresh job doesn't keep retrying it first.
+        token = user.twitch_token
+        token.mark_refresh_failed(
+            refresh_retry_seconds((token.refresh_failures or 0) + 1))
         return
     token_data = response.json()
 
@@ -375,7 +682,7 @@ def subscribe_to_user_stream_events(user):
     payload = create_webhooks_payload(user)
     header = create_webhooks_header()
 
-    response = requests.post(endpoint, json=payload, headers=header)
+    response = twitch_client.post(endpoint, json=payload, headers=header)
     print(response.status_code)
 
     if response.status_code == 202:
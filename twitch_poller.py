@@ -0,0 +1,246 @@
+"""Asyncio engine for polling Twitch stream data.
+
+Requests for every due user are sent at once from a single event loop
+thread, bounded by a semaphore, instead of one at a time per scheduler
+thread. Parsing, caching and db writes stay in the calling thread and reuse
+the twitch_helpers functions, so results match serialize_twitch_streams_data.
+"""
+
+import os
+import atexit
+import asyncio
+import threading
+import twitch_helpers as twitch
+from twitch_client import (twitch_client, priority_for,
+                           RATE_LIMITED_RETRIES)
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+STREAMS_URL = "https://api.twitch.tv/helix/streams"
+GAMES_URL = "https://api.twitch.tv/helix/games"
+USERS_URL = "https://api.twitch.tv/helix/users"
+
+# Requests in flight at once across all users.
+POLL_CONCURRENCY = int(os.environ.get("TWITCH_POLL_CONCURRENCY", 50))
+# Seconds for a whole request, including reading the body.
+POLL_TIMEOUT = 15
+
+
+class AsyncTwitchPoller(object):
+    """Runs an event loop in a background thread with a keep-alive
+    aiohttp session. Other threads hand it batches of GET requests."""
+
+    def __init__(self, concurrency=POLL_CONCURRENCY, timeout=POLL_TIMEOUT,
+                 limiter=None):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        # Shares the Helix rate limit with the synchronous client.
+        self.limiter = limiter or twitch_client.limiter
+        self._loop = None
+        self._thread = None
+        self._session = None
+        self._semaphore = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the event loop thread if it isn't running."""
+
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._loop = asyncio.new_event_loop()
+            ready = threading.Event()
+            self._thread = threading.Thread(target=self._run,
+                                            args=(ready,),
+                                            name="twitch-poller",
+                                            daemon=True)
+            self._thread.start()
+            ready.wait()
+            atexit.register(self.stop)
+
+    def stop(self):
+        """Close the session and stop the event loop thread."""
+
+        with self._lock:
+            if not self._thread:
+                return
+            asyncio.run_coroutine_threadsafe(self._session.close(),
+                                             self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout=10)
+            self._thread = None
+
+    def get_many(self, requests):
+        """Send (url, params, headers) GET requests concurrently.
+        Returns a (status, json) tuple for each request, in order; status
+        is None if the request failed and json is None unless it was OK."""
+
+        if not requests:
+            return []
+        self.start()
+        future = asyncio.run_coroutine_threadsafe(self._get_many(requests),
+                                                  self._loop)
+        return future.result()
+
+    def _run(self, ready):
+        """Event loop thread."""
+
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(self._open_session())
+        ready.set()
+        self._loop.run_forever()
+        self._loop.close()
+
+    async def _open_session(self):
+        """Create the session and semaphore on the loop they're used on."""
+
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout)
+        )
+
+    async def _get_many(self, requests):
+        """Send every request, at most concurrency at a time."""
+
+        return await asyncio.gather(*[self._get(url, params, headers)
+                                      for url, params, headers in requests])
+
+    async def _get(self, url, params, headers):
+        """Send one request once the semaphore and rate limiter allow it.
+        Requests answered with 429 are queued again."""
+
+        priority = priority_for(url)
+        async with self._semaphore:
+            for _ in range(RATE_LIMITED_RETRIES + 1):
+                wait = self.limiter.try_acquire(priority)
+                while wait:
+                    await asyncio.sleep(wait)
+                    wait = self.limiter.try_acquire(priority)
+
+                try:
+                    async with self._session.get(url,
+                                                 params=params,
+                                                 headers=headers) as response:
+                        self.limiter.update(response.headers,
+                                            response.status)
+                        if response.status == 429:
+                            continue
+                        if response.status != 200:
+                            return response.status, None
+                        return response.status, await response.json()
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    print("Twitch request to {} failed: {!r}".format(url, e))
+                    return None, None
+            return 429, None
+
+
+twitch_poller = AsyncTwitchPoller()
+
+
+def poll_twitch_streams_data(users, poller=None):
+    """Get Twitch stream data for many users' streams concurrently.
+
+    Same result as twitch_helpers.serialize_twitch_streams_data, which is
+    used instead when aiohttp isn't installed."""
+
+    if poller is None:
+        if aiohttp is None:
+            return twitch.serialize_twitch_streams_data(users)
+        poller = twitch_poller
+
+    batches = twitch.chunk_list(users)
+    responses = poller.get_many([create_streams_request(batch)
+                                 for batch in batches])
+
+    # The token used for a batch expired; refresh and retry those once.
+    expired = [index for index, (status, _) in enumerate(responses)
+               if status == 401 and
+               twitch.refresh_users_token(batches[index][0])]
+    retried = poller.get_many([create_streams_request(batches[index])
+                               for index in expired])
+    for index, response in zip(expired, retried):
+        responses[index] = response
+
+    # Still rejected, so that user's token is no good. Send the rest of the
+    # batch with other users' tokens instead of skipping all of them.
+    for index, (status, _) in enumerate(responses):
+        if status != 401:
+            continue
+        print(twitch.Unauthorized())
+        twitch.handle_check_stream_online_failures(batches[index][0].user_id)
+        try:
+            batches[index], rows = twitch.request_streams_info(
+                batches[index][1:])
+        except Exception as e:
+            print(str(e))
+            continue
+        responses[index] = (200, {"data": rows})
+
+    fetched = []
+    for batch, (status, body) in zip(batches, responses):
+        if status != 200:
+            print("Reaching Twitch API failed. Status code: {}"
+                  .format(status))
+            continue
+        fetched.append((batch, body.get("data") or []))
+
+    # Resolve every game and login across all batches at once so rows hit
+    # the caches.
+    all_rows = [row for _, rows in fetched for row in rows]
+    live_users = [user for batch, rows in fetched
+                  for user in twitch.get_live_users(batch, rows)]
+    if live_users:
+        prefetch_twitch_games(poller, all_rows, live_users[0])
+        prefetch_twitch_logins(poller, live_users)
+
+    all_stream_data = {}
+    for batch, rows in fetched:
+        all_stream_data.update(twitch.create_streams_data(batch, rows))
+    return all_stream_data
+
+
+def create_streams_request(users):
+    """Creates the request for a batch of up to 100 users' live streams."""
+
+    return (STREAMS_URL,
+            twitch.create_streams_payload(users),
+            twitch.create_header(users[0]))
+
+
+def prefetch_twitch_games(poller, rows, user):
+    """Caches the names of games in rows that aren't cached yet."""
+
+    game_ids = list({row.get("game_id") for row in rows if row.get("game_id")})
+    header = twitch.create_header(user)
+    requests = [(GAMES_URL, [("id", game_id) for game_id in batch], header)
+                for batch in twitch.chunk_list(
+                    twitch.GAME_NAME_CACHE.missing(game_ids))]
+
+    for status, body in poller.get_many(requests):
+        if status != 200:
+            print("Game lookup failed. Status code: {}".format(status))
+            continue
+        twitch.store_twitch_games(body.get("data") or [])
+
+
+def prefetch_twitch_logins(poller, users):
+    """Fetches logins for users whose cached login is stale."""
+
+    users_by_twitch_id = {str(user.twitch_id): user for user in users}
+    stale_ids = twitch.STREAMER_LOGIN_CACHE.missing(list(users_by_twitch_id))
+    requests = [(USERS_URL,
+                 [("id", twitch_id) for twitch_id in batch],
+                 twitch.create_header(users_by_twitch_id[batch[0]]))
+                for batch in twitch.chunk_list(stale_ids)]
+
+    for status, body in poller.get_many(requests):
+        if status != 200:
+            print("Login lookup failed. Status code: {}".format(status))
+            continue
+        twitch.store_twitch_logins(body.get("data") or [],
+                                   users_by_twitch_id)
@@ -0,0 +1,141 @@
+"""In-memory Twitch access tokens, refreshed before they expire."""
+
+import datetime
+import threading
+from cache_helpers import TTLCache
+
+# Refresh tokens this long before Twitch says they expire. Must be longer
+# than the interval of the refresh job.
+REFRESH_MARGIN_SECONDS = 15 * 60
+
+# A failed refresh is retried after REFRESH_RETRY_SECONDS, doubling each
+# time up to MAX_REFRESH_RETRY_SECONDS. After MAX_REFRESH_FAILURES in a row
+# the token is only refreshed on use, until the user logs in again.
+REFRESH_RETRY_SECONDS = 5 * 60
+MAX_REFRESH_RETRY_SECONDS = 24 * 60 * 60
+MAX_REFRESH_FAILURES = 10
+
+# Tokens used within this many seconds of expiring are refreshed first.
+EXPIRY_GRACE_SECONDS = 60
+
+# Bounds how long a process keeps a token replaced by another process.
+TOKEN_CACHE_SECONDS = 60 * 60
+
+
+def refresh_retry_seconds(failures):
+    """Return how long to wait before retrying a token that failed to
+    refresh failures times in a row."""
+
+    return min(REFRESH_RETRY_SECONDS * 2 ** (failures - 1),
+               MAX_REFRESH_RETRY_SECONDS)
+
+
+class PendingRefresh(object):
+    """A refresh in flight that other threads can wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.access_token = None
+
+
+class TwitchTokenManager(object):
+    """Caches users' access tokens and expiry times so headers can be built
+    without the db, and refreshes tokens through refresh(user), which
+    stores and returns the user's new TwitchToken or None.
+
+    Concurrent refreshes for the same user share the request already in
+    flight instead of sending another."""
+
+    def __init__(self, refresh, maxsize=20000, wait_seconds=30):
+        self._refresh = refresh
+        self.wait_seconds = wait_seconds
+        # user_id -> (access_token, expires_at, next_refresh_at)
+        self._tokens = TTLCache(maxsize=maxsize, ttl=TOKEN_CACHE_SECONDS)
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def get_access_token(self, user):
+        """Get user's access token, refreshing it if it's about to
+        expire. While a failed refresh is backing off, the old token is
+        returned as is."""
+
+        access_token, expires_at, _ = self._get_entry(user)
+        if expires_at is not None and expires_at <= \
+                datetime.datetime.utcnow() + \
+                datetime.timedelta(seconds=EXPIRY_GRACE_SECONDS):
+            access_token = self.refresh(user) or access_token
+        return access_token
+
+    def _get_entry(self, user):
+        """Get user's cached token, reading it from the db if needed."""
+
+        entry = self._tokens.get(user.user_id)
+        if entry is None:
+            token = user.twitch_token
+            entry = (token.access_token, token.expires_at,
+                     token.next_refresh_at)
+            self._tokens.set(user.user_id, entry)
+        return entry
+
+    def is_backing_off(self, user):
+        """Check if user's last refresh failed and its retry isn't due."""
+
+        next_refresh_at = self._get_entry(user)[2]
+        return next_refresh_at is not None and \
+            next_refresh_at > datetime.datetime.utcnow()
+
+    def refresh(self, user):
+        """Refresh user's token, or wait for the refresh already running.
+        Returns the new access token, or None if the refresh failed or the
+        last failed refresh is still backing off."""
+
+        if self.is_backing_off(user):
+            return None
+
+        with self._lock:
+            pending = self._pending.get(user.user_id)
+            is_refreshing = pending is None
+            if is_refreshing:
+                pending = PendingRefresh()
+                self._pending[user.user_id] = pending
+
+        if not is_refreshing:
+            pending.done.wait(self.wait_seconds)
+            return pending.access_token
+
+        try:
+            token = self._refresh(user)
+            if token is not None:
+                pending.access_token = token.access_token
+                self._tokens.set(user.user_id,
+                                 (token.access_token, token.expires_at,
+                                  None))
+        finally:
+            with self._lock:
+                del self._pending[user.user_id]
+            pending.done.set()
+
+        return pending.access_token
+
+    def refresh_many(self, users):
+        """Refresh each user's token. Returns the number refreshed."""
+
+        refreshed = 0
+        for user in users:
+            try:
+                if self.refresh(user):
+                    refreshed += 1
+            except Exception as e:
+                print("Refreshing User {}'s token failed: {}"
+                      .format(user.user_id, e))
+        return refreshed
+
+    def invalidate(self, user_id):
+        """Drop user's cached token so it's read from the db next time."""
+
+        self._tokens.invalidate(user_id)
+
+    def clear(self):
+        """Drop every cached token."""
+
+        self._tokens.clear()
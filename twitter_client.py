@@ -0,0 +1,73 @@
+"""Authenticated Twitter clients sharing a pooled HTTP session."""
+
+import os
+import requests
+import tweepy
+from requests.adapters import HTTPAdapter
+
+UPDATE_STATUS_URL = "https://api.twitter.com/1.1/statuses/update.json"
+
+# Connections kept open to api.twitter.com, shared by every account.
+API_POOL_SIZE = int(os.environ.get("TWITTER_API_POOL_SIZE", 20))
+
+# (connect, read) timeouts in seconds.
+DEFAULT_TIMEOUT = (3.05, 20)
+
+
+def create_twitter_session():
+    """Create a keep-alive session for api.twitter.com.
+
+    Tweets aren't idempotent, so nothing is retried automatically."""
+
+    session = requests.Session()
+    session.mount("https://api.twitter.com/",
+                  HTTPAdapter(pool_connections=1,
+                              pool_maxsize=API_POOL_SIZE))
+    return session
+
+
+twitter_session = create_twitter_session()
+
+
+class TwitterClient(object):
+    """Twitter client for one account.
+
+    OAuth is set up once per client. Requests go through the shared
+    session, since tweepy.API opens a new session for every call."""
+
+    def __init__(self,
+                 consumer_key,
+                 consumer_secret,
+                 access_token,
+                 access_token_secret,
+                 session=twitter_session,
+                 timeout=DEFAULT_TIMEOUT):
+        auth = tweepy.OAuthHandler(consumer_key, consumer_secret)
+        auth.set_access_token(access_token, access_token_secret)
+        self.api = tweepy.API(auth)
+        self.oauth = auth.apply_auth()
+        self.session = session
+        self.timeout = timeout
+
+    def update_status(self, status):
+        """Post a tweet. Returns a tweepy Status, like
+        tweepy.API.update_status, or raises tweepy.TweepError."""
+
+        try:
+            response = self.session.post(UPDATE_STATUS_URL,
+                                         data={"status": status},
+                                         auth=self.oauth,
+                                         timeout=self.timeout)
+        except requests.RequestException as e:
+            raise tweepy.TweepError("Failed to send request: {}".format(e))
+
+        if response.status_code != 200:
+            try:
+                reason, api_code = self.api.parser.parse_error(response.text)
+            except Exception:
+                reason = "Twitter error response: status code = {}" \
+                    .format(response.status_code)
+                api_code = None
+            raise tweepy.TweepError(reason, response, api_code=api_code)
+
+        return tweepy.Status.parse(self.api, response.json())
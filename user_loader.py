@@ -0,0 +1,110 @@
+"""Loads the logged in user for flask-login.
+
+The user and their Twitch and Twitter tokens are fetched in one query,
+memoized for the request, and cached briefly across requests. Cached
+users are stored as column values and rebuilt in the request's session
+without a query. Changes to a user or their tokens drop the cached copy."""
+
+import os
+from flask import g
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.session import make_transient_to_detached
+from cache_helpers import TTLCache
+from model import db, TwitchToken, TwitterToken, User
+
+# Seconds a user may be served from the cache. Other processes only see
+# changes once their copy expires, so keep this short; 0 disables it.
+USER_CACHE_SECONDS = int(os.environ.get("USER_CACHE_SECONDS", 10))
+USER_CACHE = TTLCache(maxsize=10000, ttl=USER_CACHE_SECONDS)
+
+# Relationships loaded with the user, and their models.
+USER_TOKENS = {"twitch_token": TwitchToken, "twitter_token": TwitterToken}
+
+
+def load_user(user_id):
+    """Get the user for user_id with their tokens loaded, or None."""
+
+    user_id = int(user_id)
+    loaded_users = getattr(g, "loaded_users", None)
+    if loaded_users is None:
+        loaded_users = g.loaded_users = {}
+
+    if user_id not in loaded_users:
+        loaded_users[user_id] = get_user(user_id)
+    return loaded_users[user_id]
+
+
+def get_user(user_id):
+    """Get the user from the cache, or the db on a miss."""
+
+    if USER_CACHE_SECONDS:
+        columns = USER_CACHE.get(user_id)
+        if columns is not None:
+            return restore_user(columns)
+
+    user = User.query.options(*[joinedload(name) for name in USER_TOKENS]) \
+        .get(user_id)
+    if user is not None and USER_CACHE_SECONDS:
+        USER_CACHE.set(user_id, snapshot_user(user))
+    return user
+
+
+def get_columns(instance):
+    """Return a dictionary of an instance's column values."""
+
+    return {attr.key: getattr(instance, attr.key)
+            for attr in inspect(instance).mapper.column_attrs}
+
+
+def snapshot_user(user):
+    """Return the column values of user and their tokens."""
+
+    columns = {"user": get_columns(user)}
+    for name in USER_TOKENS:
+        token = getattr(user, name)
+        columns[name] = get_columns(token) if token else None
+    return columns
+
+
+def restore_user(columns):
+    """Rebuild a cached user and their tokens in the current session, as if
+    they had just been loaded."""
+
+    user = merge_loaded(User(**columns["user"]))
+    for name, model in USER_TOKENS.items():
+        token = None
+        if columns[name]:
+            token = merge_loaded(model(**columns[name]))
+        set_committed_value(user, name, token)
+    return user
+
+
+def merge_loaded(instance):
+    """Add an instance built from known db values to the session without
+    querying for it."""
+
+    make_transient_to_detached(instance)
+    return db.session.merge(instance, load=False)
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def handle_user_change(mapper, connection, user):
+    """Drop a cached user when they're changed, e.g. by the User.update_*
+    methods."""
+
+    USER_CACHE.invalidate(user.user_id)
+
+
+@event.listens_for(TwitchToken, "after_insert")
+@event.listens_for(TwitchToken, "after_update")
+@event.listens_for(TwitchToken, "after_delete")
+@event.listens_for(TwitterToken, "after_insert")
+@event.listens_for(TwitterToken, "after_update")
+@event.listens_for(TwitterToken, "after_delete")
+def handle_user_token_change(mapper, connection, token):
+    """Drop a cached user when one of their tokens is stored or removed."""
+
+    USER_CACHE.invalidate(token.user_id)
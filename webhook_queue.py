@@ -0,0 +1,144 @@
+"""Bounded queue for Twitch stream webhook notifications."""
+
+import time
+import queue
+import atexit
+import threading
+import collections
+from cache_helpers import TTLCache
+
+# Twitch redelivers a notification it isn't sure arrived within a few
+# minutes; repeats of a processed notification are dropped for this long.
+DUPLICATE_SECONDS = 5 * 60
+
+
+class WebhookQueue(object):
+    """Hands webhook notifications to a fixed pool of worker threads, so a
+    burst of notifications can't open more db connections than there are
+    workers. Each user's notifications go to the same worker, so they're
+    processed in the order they arrived.
+
+    A notification for the same user and stream state as one that is
+    queued, or was the last one processed within duplicate_seconds, is a
+    duplicate and is dropped.
+    When the queue is full, submit refuses the notification so Twitch
+    retries it later."""
+
+    def __init__(self, process, workers=4, max_queue=1000, clock=time.time,
+                 duplicate_seconds=DUPLICATE_SECONDS):
+        self.process = process
+        self.workers = workers
+        self.clock = clock
+        self.processed = 0
+        self.duplicates = 0
+        self.rejected = 0
+        # One queue per worker; max_queue is shared between them.
+        self._queues = [queue.Queue(maxsize=max(1, max_queue // workers))
+                        for _ in range(workers)]
+        # Keys of queued or running notifications, and the last key
+        # processed per user while it can still be redelivered.
+        self._pending = set()
+        self._last_keys = TTLCache(maxsize=20000, ttl=duplicate_seconds)
+        # Seconds from submit to done for recent notifications.
+        self._latencies = collections.deque(maxlen=100)
+        self._lock = threading.Lock()
+        self._threads = []
+
+    @staticmethod
+    def notification_key(user_id, body_json):
+        """Return (user_id, stream id), with None for an offline stream."""
+
+        data = (body_json or {}).get("data") or [{}]
+        return (user_id, data[0].get("id"))
+
+    def start(self):
+        """Start the worker threads if they aren't running."""
+
+        with self._lock:
+            if any(thread.is_alive() for thread in self._threads):
+                return
+            self._threads = [threading.Thread(target=self._run,
+                                              args=(self._queues[index],),
+                                              name="webhook-" + str(index),
+                                              daemon=True)
+                             for index in range(self.workers)]
+            for thread in self._threads:
+                thread.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        """Let the workers finish what's queued, then stop them."""
+
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for index, _ in enumerate(threads):
+            self._queues[index].put(None)
+        for thread in threads:
+            thread.join(timeout=30)
+
+    def submit(self, user_id, body_json, *args):
+        """Queue a notification to be passed to process. Returns False if
+        the queue is full, True otherwise (including duplicates)."""
+
+        self.start()
+        key = self.notification_key(user_id, body_json)
+        with self._lock:
+            if key in self._pending or self._last_keys.get(user_id) == key:
+                self.duplicates += 1
+                return True
+            try:
+                self.worker_queue(user_id).put_nowait(
+                    (key, self.clock(), (user_id, body_json) + args))
+            except queue.Full:
+                self.rejected += 1
+                return False
+            self._pending.add(key)
+        return True
+
+    def worker_queue(self, user_id):
+        """Return the queue of the worker that handles user_id."""
+
+        return self._queues[hash(user_id) % self.workers]
+
+    def depth(self):
+        """Return the number of queued notifications."""
+
+        return sum(worker_queue.qsize() for worker_queue in self._queues)
+
+    def stats(self):
+        """Return queue depth, counts and recent processing latency."""
+
+        with self._lock:
+            latencies = list(self._latencies)
+            return {
+                "depth": self.depth(),
+                "processed": self.processed,
+                "duplicates": self.duplicates,
+                "rejected": self.rejected,
+                "latency_avg": (sum(latencies) / len(latencies)
+                                if latencies else 0),
+                "latency_max": max(latencies or [0]),
+            }
+
+    def _run(self, worker_queue):
+        """Worker thread: process notifications until stopped."""
+
+        while True:
+            item = worker_queue.get()
+            if item is None:
+                return
+            key, submitted_at, args = item
+            try:
+                self.process(*args)
+                succeeded = True
+            except Exception as e:
+                print("Webhook for user {} failed: {}".format(key[0], e))
+                succeeded = False
+            with self._lock:
+                # The key stays pending while processing so a repeat sent
+                # meanwhile is dropped; a failed one may be retried.
+                self._pending.discard(key)
+                if succeeded:
+                    self._last_keys.set(key[0], key)
+                self.processed += 1
+                self._latencies.append(self.clock() - submitted_at)
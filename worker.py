@@ -0,0 +1,106 @@
+"""Worker entry point for Yet Another Twitch Toolkit.
+
+Runs the polling, clipping, tweeting and webhook renewal work for a
+consistent-hash partition of users, outside the web process. Workers
+coordinate through leases in the worker_leases table, so processes can be
+started on one machine or many and users rebalance as they come and go.
+
+Run the web process with SCHEDULE_IN_WORKERS=1, then start workers with:
+
+    SCHEDULE_IN_WORKERS=1 python worker.py [number_of_processes]
+"""
+
+import os
+import sys
+import time
+import socket
+import uuid
+import multiprocessing
+
+
+class WorkerConfig(object):
+    """Configuration for a worker's APScheduler.
+
+    Each worker keeps its jobs in memory; they are rebuilt from the db on
+    start and the shared Postgres jobstore is left to the single-process
+    setup."""
+
+    SCHEDULER_API_ENABLED = False
+    SCHEDULER_JOBSTORES = {
+        "default": {"type": "memory"},
+        "memory": {"type": "memory"}
+    }
+    SCHEDULER_EXECUTORS = {
+        "default": {"type": "threadpool", "max_workers": 20}
+    }
+
+
+def create_worker_id():
+    """Create an id unique to this process."""
+
+    return "{}-{}-{}".format(socket.gethostname(),
+                             os.getpid(),
+                             uuid.uuid4().hex[:6])
+
+
+def run_worker():
+    """Run a single worker process until interrupted."""
+
+    from server import app
+    from model import connect_to_db, WorkerLease
+    from app_globals import (scheduler, partition, stream_data_writer,
+                             engine_executor)
+    import apscheduler_handlers as handler
+    import apscheduler_jobs as jobs
+    import template_helpers
+
+    app.config.from_object(WorkerConfig())
+    connect_to_db(app, show_sql=False)
+
+    worker_id = create_worker_id()
+    partition.worker_id = worker_id
+
+    # Claim a share of users before loading any tasks.
+    with app.app_context():
+        handler.rebalance_partition()
+
+    scheduler.init_app(app)
+    scheduler.start()
+    handler.start_scheduling_engine()
+    scheduler.add_job(func=jobs.rebalance_workers,
+                      id="rebalance_workers",
+                      trigger="interval",
+                      replace_existing=True,
+                      coalesce=True,
+                      max_instances=1,
+                      seconds=handler.HEARTBEAT_SECONDS)
+    print("Worker {} started.".format(worker_id))
+
+    try:
+        while True:
+            time.sleep(1)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        scheduler.shutdown()
+        engine_executor.shutdown()
+        stream_data_writer.stop()
+        template_helpers.tweet_publisher.stop()
+        # Hand our users to the other workers right away.
+        with app.app_context():
+            WorkerLease.release(worker_id)
+        print("Worker {} stopped.".format(worker_id))
+
+
+if __name__ == "__main__":
+    num_processes = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+
+    if num_processes == 1:
+        run_worker()
+    else:
+        processes = [multiprocessing.Process(target=run_worker)
+                     for _ in range(num_processes)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
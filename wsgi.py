@@ -1,14 +1,18 @@
 from server import app
 from model import connect_to_db
-from app_globals import scheduler
+from app_globals import scheduler, SCHEDULE_IN_WORKERS
+import apscheduler_handlers as handler
 from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from apscheduler.jobstores.memory import MemoryJobStore
 
 
 class Config(object):
     """Configuration for APScheduler."""
 
     SCHEDULER_JOBSTORES = {
-        'default': SQLAlchemyJobStore(url='postgresql:///yattk_jobstore')
+        'default': SQLAlchemyJobStore(url='postgresql:///yattk_jobstore'),
+        # Short-lived jobs, e.g. clip confirmations.
+        'memory': MemoryJobStore()
     }
     SCHEDULER_API_ENABLED = False
 
@@ -17,6 +21,10 @@ app.config.from_object(Config())
 # Connect to db
 connect_to_db(app)
 
-# Enable scheduler
-scheduler.init_app(app)
-scheduler.start()
+# Enable scheduler, unless worker.py processes run the scheduled work
+if not SCHEDULE_IN_WORKERS:
+    scheduler.init_app(app)
+    scheduler.start()
+
+    # Load per-user tasks and start the engine's tick jobs
+    handler.start_scheduling_engine()